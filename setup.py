@@ -43,6 +43,9 @@ setup(
     include_package_data=True,
     package_data={"simfleet": ["templates"]},
     install_requires=requirements,
+    extras_require={
+        'arrow': ['pyarrow>=0.15'],
+    },
     license="MIT license",
     zip_safe=False,
     keywords='simfleet',
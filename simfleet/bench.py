@@ -0,0 +1,296 @@
+"""
+Benchmark module
+
+Runs a set of reference scenarios of increasing size against a stubbed route server and measures the throughput of
+the simulator. Every scenario runs in a fresh process, so SPADE starts clean and the memory peak is not shared.
+"""
+
+import asyncio
+import json
+import platform
+import statistics
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from pathlib import Path
+
+from aiohttp import web as aioweb
+from loguru import logger
+
+from . import __version__
+from .generator import ScenarioGenerator
+from .helpers import distance_in_meters
+from .metrics import registry as metrics, sample_loop_lag
+from .utils import unused_port
+
+try:
+    import resource
+except ImportError:  # pragma: no cover (not available on Windows)
+    resource = None
+
+REFERENCE_SCENARIOS = {
+    "tiny": {"fleets": 1, "transports": 5, "customers": 10, "stations": 1, "max_time": 60},
+    "small": {"fleets": 1, "transports": 50, "customers": 200, "stations": 5, "max_time": 120},
+    "medium": {"fleets": 2, "transports": 200, "customers": 1000, "stations": 20, "max_time": 180},
+    "large": {"fleets": 4, "transports": 1000, "customers": 5000, "stations": 50, "max_time": 300},
+}
+
+STUB_SPEED_MS = 10  # speed (m/s) used by the stub route server to estimate durations
+
+
+class StubRouteServer(object):
+    """
+    An OSRM-compatible route server that answers straight lines between the origin and the destination.
+    It runs in its own thread and event loop, so it never competes with the agents for the simulator loop.
+    """
+
+    def __init__(self, hostname="127.0.0.1", port=None, points=10):
+        """
+        Args:
+            hostname (str): the interface where the server listens
+            port (int, optional): the port of the server. An unused port is chosen if None
+            points (int): number of points of every path
+        """
+        self.hostname = hostname
+        self.port = port if port else unused_port(hostname)
+        self.points = points
+        self.requests = 0
+        self.loop = asyncio.new_event_loop()
+        self.runner = None
+        self.thread = None
+
+    @property
+    def url(self):
+        return "http://{}:{}/".format(self.hostname, self.port)
+
+    async def route_controller(self, request):
+        self.requests += 1
+        coords = [[float(c) for c in point.split(",")] for point in request.match_info["coords"].split(";")]
+        (src_lng, src_lat), (dst_lng, dst_lat) = coords[0], coords[-1]
+        steps = max(self.points - 1, 1)
+        geometry = [[src_lng + (dst_lng - src_lng) * i / steps, src_lat + (dst_lat - src_lat) * i / steps]
+                    for i in range(steps + 1)]
+        distance = distance_in_meters([src_lat, src_lng], [dst_lat, dst_lng])
+        return aioweb.json_response({
+            "code": "Ok",
+            "routes": [{
+                "geometry": {"type": "LineString", "coordinates": geometry},
+                "distance": distance,
+                "duration": distance / STUB_SPEED_MS
+            }]
+        })
+
+    async def _start(self):
+        app = aioweb.Application()
+        app.router.add_get("/route/v1/car/{coords}", self.route_controller)
+        self.runner = aioweb.AppRunner(app)
+        await self.runner.setup()
+        await aioweb.TCPSite(self.runner, self.hostname, self.port).start()
+
+    def start(self):
+        """
+        Starts the server in a background thread.
+        """
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self._start(), self.loop).result()
+        logger.info("Stub route server running at {}".format(self.url))
+
+    def stop(self):
+        """
+        Stops the server and its thread.
+        """
+        asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+def percentile(values, p):
+    """
+    Returns the p-th percentile of a list of values (nearest rank).
+
+    Args:
+        values (list): a list of numbers
+        p (float): the percentile (between 0 and 100)
+
+    Returns:
+        float: the percentile or None if the list is empty
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(int(round(p / 100 * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+
+def summarize(values):
+    return {
+        "mean": statistics.mean(values) if values else None,
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "max": max(values) if values else None,
+    }
+
+
+def summarize_histogram(histogram):
+    if histogram is None:
+        return None
+    data = histogram.to_json()
+    return {key: data[key] for key in ("count", "mean", "p50", "p95")}
+
+
+def run_scenario(name, params, host="127.0.0.1", seed=0):
+    """
+    Runs a benchmark scenario in the current process and returns its metrics.
+    This function is meant to be called in a fresh process (see ``run_benchmark``).
+
+    Args:
+        name (str): name of the scenario
+        params (dict): arguments for ``ScenarioGenerator`` plus the ``max_time`` of the simulation
+        host (str): the XMPP host
+        seed (int): the random seed of the scenario
+
+    Returns:
+        dict: the measured metrics
+    """
+    from spade import quit_spade
+
+    from .config import SimfleetConfig
+    from .simulator import SimulatorAgent
+
+    logger.remove()
+
+    params = dict(params)
+    max_time = params.pop("max_time")
+    router = StubRouteServer()
+    router.start()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = str(Path(tmp) / "{}.json".format(name))
+        generator = ScenarioGenerator(host=host, seed=seed, **params)
+        with open(filename, "w") as f:
+            generator.write(f, {"simulation_name": "bench_{}".format(name), "max_time": max_time, "host": host})
+
+        config = SimfleetConfig(filename, "bench_{}".format(name), max_time, 0)
+    config.route_host = router.url
+    config.headless = True
+    config.metrics = True
+
+    metrics.reset()
+    init = time.perf_counter()
+    simulator = SimulatorAgent(config=config, agentjid="simulator_bench_{}@{}".format(name, host))
+    simulator.start().result()
+
+    agents = [agent for agents in (simulator.manager_agents, simulator.transport_agents,
+                                   simulator.customer_agents, simulator.station_agents)
+              for agent in agents.values() if agent.is_launched]
+    while not all(agent.ready for agent in agents):
+        time.sleep(0.05)
+    startup_time = time.perf_counter() - init
+
+    lags = []
+    stop_sampling = threading.Event()
+    simulator.submit(sample_loop_lag(stop_sampling, samples=lags))
+
+    messages_at_start = metrics.total("messages_received_total")
+    routes_at_start = router.requests
+    start = time.perf_counter()
+    simulator.run()
+    while not simulator.is_simulation_finished():
+        time.sleep(0.1)
+    wall_time = time.perf_counter() - start
+    simulation_time = simulator.get_simulation_time()
+    messages = metrics.total("messages_received_total") - messages_at_start
+    routes = router.requests - routes_at_start
+
+    stop_sampling.set()
+    customers = list(simulator.customer_agents.values())
+    dispatch_times = [c.get_dispatch_time() for c in customers if c.get_dispatch_time() is not None]
+    delivered = len([c for c in customers if c.is_in_destination()])
+
+    simulator.stop().result()
+    router.stop()
+    quit_spade()
+
+    return {
+        "agents": len(agents),
+        "startup_time": startup_time,
+        "wall_time": wall_time,
+        "simulation_time": simulation_time,
+        "sim_seconds_per_wall_second": simulation_time / wall_time,
+        "messages": messages,
+        "messages_per_second": messages / wall_time,
+        "route_requests": routes,
+        "route_requests_per_second": routes / wall_time,
+        "dispatch_latency": summarize(dispatch_times),
+        "loop_lag": summarize(lags),
+        "route_latency": summarize_histogram(metrics.histogram("route_request_seconds", outcome="success")),
+        "customers_delivered": delivered,
+        "customers": len(customers),
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource else None,
+    }
+
+
+def run_benchmark(scenarios=None, host="127.0.0.1", seed=0):
+    """
+    Runs the reference scenarios, each one in its own process.
+
+    Args:
+        scenarios (list, optional): names of the scenarios to run. All of them if None
+        host (str): the XMPP host
+        seed (int): the random seed of the scenarios
+
+    Returns:
+        dict: the benchmark results with the metrics of every scenario
+    """
+    scenarios = scenarios or list(REFERENCE_SCENARIOS.keys())
+    results = {
+        "version": __version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "seed": seed,
+        "scenarios": {}
+    }
+    for name in scenarios:
+        logger.info("Running benchmark scenario {} {}".format(name, REFERENCE_SCENARIOS[name]))
+        with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as executor:
+            future = executor.submit(run_scenario, name, REFERENCE_SCENARIOS[name], host, seed)
+            try:
+                results["scenarios"][name] = future.result()
+            except Exception as e:
+                logger.exception("EXCEPTION running benchmark scenario {}: {}".format(name, e))
+                results["scenarios"][name] = {"error": str(e)}
+    return results
+
+
+def compare(results, baseline):
+    """
+    Builds a table with the relative change of the main metrics against a previous benchmark.
+
+    Args:
+        results (dict): the current benchmark results
+        baseline (dict): the previous benchmark results
+
+    Returns:
+        list: a list of rows (scenario, metric, baseline value, current value, change in %)
+    """
+    keys = ["startup_time", "messages_per_second", "route_requests_per_second", "sim_seconds_per_wall_second",
+            "peak_rss_kb"]
+    rows = []
+    for name, current in results["scenarios"].items():
+        previous = baseline.get("scenarios", {}).get(name)
+        if not previous or "error" in current or "error" in previous:
+            continue
+        for key in keys:
+            old, new = previous.get(key), current.get(key)
+            change = (new - old) / old * 100 if old and new is not None else None
+            rows.append([name, key, old, new, "{0:+.1f}%".format(change) if change is not None else "-"])
+    return rows
+
+
+def write_results(results, filename):
+    with open(filename, "w") as f:
+        json.dump(results, f, indent=4)
@@ -0,0 +1,202 @@
+"""
+Charging module
+
+Charging models of the stations. A model gives the charging power of a transport as a function of its state of charge,
+and computes in closed form how long a charge takes and how much a transport charged after some time, so a station
+schedules a single timeout per charge and only reschedules it when the power of the charge changes (e.g. when the
+power of the station is shared by more transports). No charge is simulated second by second.
+
+Levels and capacities are kilometers of autonomy and powers are kilometers of autonomy per second (the units of the
+``power`` of the stations). The model of a station is set with the ``charging`` field of the station in the config
+file:
+
+    * ``"linear"`` (default): the transport charges at constant power until it is full.
+    * ``"cccv"`` or ``{"model": "cccv", "taper_from": 0.8, "min_rate": 0.1}``: constant current, constant voltage.
+      The transport charges at constant power until its state of charge reaches ``taper_from`` and then the power
+      decreases linearly until it is ``min_rate`` times the constant power when the battery is full.
+
+The power of a charge is the power of the station (or its share of it if the station has ``"shared_power": true``),
+limited by the ``max_charge_rate`` of the transport.
+"""
+
+import math
+
+
+class ChargingModel(object):
+    """
+    Base class of the charging models.
+    """
+
+    def duration(self, level, target, capacity, power):
+        """
+        Returns the seconds needed to charge a transport.
+
+        Args:
+            level (float): the current level of the battery
+            target (float): the level to reach
+            capacity (float): the capacity of the battery
+            power (float): the charging power when the battery is not tapering
+
+        Returns:
+            float: the duration of the charge in seconds
+        """
+        raise NotImplementedError
+
+    def level_after(self, level, seconds, capacity, power):
+        """
+        Returns the level of a battery after charging it for some time.
+
+        Args:
+            level (float): the level at the start of the charge
+            seconds (float): the time charging
+            capacity (float): the capacity of the battery
+            power (float): the charging power when the battery is not tapering
+
+        Returns:
+            float: the level of the battery
+        """
+        raise NotImplementedError
+
+
+class LinearModel(ChargingModel):
+    """
+    Constant power until the battery is full.
+    """
+
+    def duration(self, level, target, capacity, power):
+        return max(target - level, 0.0) / power if power > 0 else math.inf
+
+    def level_after(self, level, seconds, capacity, power):
+        return min(level + power * seconds, capacity) if power > 0 else level
+
+
+class CCCVModel(ChargingModel):
+    """
+    Constant power until the state of charge reaches ``taper_from``, then a power that decreases linearly with the
+    state of charge down to ``min_rate`` times the constant power when the battery is full.
+    """
+
+    def __init__(self, taper_from=0.8, min_rate=0.1):
+        """
+        Args:
+            taper_from (float): the state of charge (0 to 1) where the power starts decreasing
+            min_rate (float): the fraction of the constant power when the battery is full (greater than 0)
+        """
+        if not 0 < min_rate <= 1:
+            raise ValueError("min_rate must be in (0, 1]")
+        self.taper_from = taper_from
+        self.min_rate = min_rate
+        self.slope = (1 - min_rate) / (1 - taper_from) if taper_from < 1 else 0.0
+
+    def duration(self, level, target, capacity, power):
+        if power <= 0:
+            return math.inf
+        if capacity <= 0 or target <= level:
+            return 0.0
+        start, end = level / capacity, min(target / capacity, 1.0)
+        cc_end = min(max(start, self.taper_from), end)
+        seconds = (cc_end - start) * capacity / power if start < self.taper_from else 0.0
+        start = max(start, self.taper_from)
+        if end > start:
+            if self.slope == 0:
+                seconds += (end - start) * capacity / power
+            else:
+                seconds += capacity / (power * self.slope) * math.log(self._factor(start) / self._factor(end))
+        return seconds
+
+    def level_after(self, level, seconds, capacity, power):
+        if capacity <= 0 or power <= 0:
+            return level
+        soc = level / capacity
+        if soc < self.taper_from:
+            cc_time = (self.taper_from - soc) * capacity / power
+            if seconds <= cc_time:
+                return level + power * seconds
+            seconds -= cc_time
+            soc = self.taper_from
+        if self.slope == 0:
+            soc += power * seconds / capacity
+        else:
+            soc = self.taper_from + (1 - self._factor(soc) * math.exp(-power * self.slope * seconds / capacity)) / \
+                self.slope
+        return min(soc, 1.0) * capacity
+
+    def _factor(self, soc):
+        return 1 - self.slope * (soc - self.taper_from)
+
+
+CHARGING_MODELS = {"linear": LinearModel, "cccv": CCCVModel}
+
+
+def create_charging_model(config=None):
+    """
+    Creates the charging model of a station from its config.
+
+    Args:
+        config (str or dict, optional): the name of the model or a dict with the ``model`` and its options.
+            Defaults to the linear model.
+
+    Returns:
+        ChargingModel: the model
+    """
+    if not config:
+        return LinearModel()
+    if isinstance(config, str):
+        config = {"model": config}
+    options = dict(config)
+    model = options.pop("model", "linear")
+    if model not in CHARGING_MODELS:
+        raise ValueError("Unknown charging model {} (choose from {})".format(model, ", ".join(CHARGING_MODELS)))
+    return CHARGING_MODELS[model](**options)
+
+
+def share_power(total, limits):
+    """
+    Shares the power of a station among the transports that charge in it. Every transport gets an equal share, and
+    the power a transport cannot take because of its maximum charge rate is shared among the other ones.
+
+    Args:
+        total (float): the power of the station
+        limits (list): the maximum charge rate of every transport (None if it has no limit)
+
+    Returns:
+        list: the power of every transport, in the order of ``limits``
+    """
+    powers = [0.0] * len(limits)
+    order = sorted(range(len(limits)), key=lambda i: math.inf if limits[i] is None else limits[i])
+    remaining = total
+    for position, index in enumerate(order):
+        share = remaining / (len(order) - position)
+        powers[index] = share if limits[index] is None else min(limits[index], share)
+        remaining -= powers[index]
+    return powers
+
+
+class ChargingSession(object):
+    """
+    A transport charging in a station. ``level`` is the level of the battery at ``since``, when the charge got its
+    current ``power``.
+    """
+
+    def __init__(self, transport, level, target, capacity, max_rate=None):
+        self.transport = transport
+        self.level = level
+        self.target = target
+        self.capacity = capacity
+        self.max_rate = max_rate
+        self.power = None
+        self.since = None
+        self.end = None
+        self.behaviour = None
+
+    def advance(self, model, now):
+        """
+        Updates the level of the battery to the current time with the current power of the charge.
+
+        Args:
+            model (ChargingModel): the charging model of the station
+            now (float): the current timestamp
+        """
+        if self.power is not None:
+            self.level = min(model.level_after(self.level, now - self.since, self.capacity, self.power), self.target)
+        self.since = now
@@ -0,0 +1,307 @@
+"""
+Checkpoint module
+
+Periodic snapshots of a running simulation, so a long simulation can be resumed (``simfleet --resume``) after a crash
+or be used as the warm start of the variants of a sweep.
+
+A checkpoint is a gzipped JSON document with the simulation clock, the scenario of the simulation (with the agents
+located where they were) and the state of every transport, customer and station: status, position, remaining path,
+station queues and the counters of their statistics. The states are stored in the same order as the agents of the
+scenario, so they still match the agents when their names are prefixed (e.g. by a sweep). Times are stored relative to
+the start of the simulation.
+
+When a simulation is resumed the agents are created in bulk at their checkpointed positions, their counters and times
+are restored and the simulation clock continues from the checkpoint. Trips that were in progress are not resumed
+midway: customers that had not arrived to their destination request a transport again from where they were and
+transports start waiting for a new assignment.
+"""
+
+import gzip
+import json
+import os
+import time
+
+from loguru import logger
+from spade.behaviour import PeriodicBehaviour
+
+from .energy import fleet as fleet_energy
+from .utils import CUSTOMER_IN_DEST, CUSTOMER_WAITING, TRANSPORT_WAITING, FREE_STATION, BUSY_STATION
+
+VERSION = 1
+AGENT_KEYS = ["transports", "customers", "stations"]
+# Fields of the config replaced by the ones of the checkpoint when a simulation is resumed
+SCENARIO_KEYS = ["fleets", "transports", "customers", "stations", "coords", "zoom", "transport_strategy",
+                 "customer_strategy", "fleetmanager_strategy", "directory_strategy", "station_strategy", "route_host"]
+
+
+def write_checkpoint(filename, snapshot):
+    """
+    Writes a snapshot to a file. The file is replaced atomically, so a crash while writing never leaves a broken
+    checkpoint.
+
+    Args:
+        filename (str): the checkpoint file (gzipped JSON)
+        snapshot (dict): the snapshot of the simulation
+    """
+    tmp = "{}.tmp".format(filename)
+    with gzip.open(tmp, "wt") as f:
+        json.dump(snapshot, f, separators=(",", ":"))
+    os.replace(tmp, filename)
+
+
+def read_checkpoint(filename):
+    """
+    Reads a snapshot written by ``write_checkpoint``.
+
+    Args:
+        filename (str): the checkpoint file
+
+    Returns:
+        dict: the snapshot of the simulation
+    """
+    with gzip.open(filename, "rt") as f:
+        snapshot = json.load(f)
+    if snapshot.get("version") != VERSION:
+        raise ValueError("{} is not a SimFleet checkpoint (version {})".format(filename, VERSION))
+    return snapshot
+
+
+def resume_config(config, filename):
+    """
+    Replaces the scenario of a config with the one of a checkpoint and marks the config to be resumed from it.
+    The simulation name and the max time of the checkpoint are used only if the config has none.
+
+    Args:
+        config (SimfleetConfig): the config of the simulation
+        filename (str): the checkpoint file
+
+    Returns:
+        dict: the snapshot of the simulation
+    """
+    snapshot = read_checkpoint(filename)
+    scenario = snapshot["config"]
+    config.update({key: scenario[key] for key in SCENARIO_KEYS if key in scenario})
+    for key in ["simulation_name", "max_time"]:
+        if config[key] is None:
+            config.update({key: scenario.get(key)})
+    config.resume = filename
+    return snapshot
+
+
+def _relative(timestamp, start):
+    return timestamp - start if timestamp is not None else None
+
+
+def _absolute(seconds, start):
+    return seconds + start if seconds is not None else None
+
+
+def transport_state(transport, start):
+    """
+    Returns the state of a transport agent.
+
+    Args:
+        transport (TransportAgent): the transport
+        start (float): the timestamp of the start of the simulation
+
+    Returns:
+        dict: the state of the transport
+    """
+    return {
+        "status": transport.status,
+        "position": transport.get("current_pos"),
+        "dest": transport.dest,
+        "path": transport.get("path"),
+        "customer": transport.get("current_customer"),
+        "assignments": transport.num_assignments,
+        "distance": sum(transport.distances),
+        "duration": sum(transport.durations),
+        "autonomy": transport.current_autonomy_km,
+        "max_autonomy": transport.max_autonomy_km,
+        "consumed_autonomy": float(fleet_energy.consumed[transport.energy_index]),
+        "shared_trips": transport.shared_trips,
+        "charges": transport.num_charges,
+        "waiting_in_station_time": transport.total_waiting_time,
+        "charging_time": transport.total_charging_time,
+    }
+
+
+def restore_transport(transport, state, start):
+    """
+    Restores the state of a transport agent. The transport waits for a new assignment from its checkpointed position.
+
+    Args:
+        transport (TransportAgent): the transport
+        state (dict): the state returned by ``transport_state``
+        start (float): the timestamp of the start of the resumed simulation
+    """
+    transport.set("current_pos", state["position"])
+    transport.num_assignments = state["assignments"]
+    transport.distances = [state["distance"]] if state["distance"] else []
+    transport.durations = [state["duration"]] if state["duration"] else []
+    transport.set_autonomy(state["max_autonomy"], state["autonomy"])
+    fleet_energy.consumed[transport.energy_index] = state.get("consumed_autonomy", 0.0)
+    transport.shared_trips = state.get("shared_trips", 0)
+    transport.num_charges = state["charges"]
+    transport.total_waiting_time = state["waiting_in_station_time"]
+    transport.total_charging_time = state["charging_time"]
+    transport.status = TRANSPORT_WAITING
+
+
+def customer_state(customer, start):
+    """
+    Returns the state of a customer agent.
+
+    Args:
+        customer (CustomerAgent): the customer
+        start (float): the timestamp of the start of the simulation
+
+    Returns:
+        dict: the state of the customer
+    """
+    return {
+        "status": customer.status,
+        "position": customer.current_pos,
+        "dest": customer.dest,
+        "transport": str(customer.transport_assigned) if customer.transport_assigned else None,
+        "init_time": _relative(customer.init_time, start),
+        "waiting_for_pickup_time": _relative(customer.waiting_for_pickup_time, start),
+        "assignment_time": _relative(customer.assignment_time, start),
+        "pickup_time": _relative(customer.pickup_time, start),
+        "end_time": _relative(customer.end_time, start),
+    }
+
+
+def restore_customer(customer, state, start):
+    """
+    Restores the state of a customer agent. Customers that had arrived keep their times. The other ones keep the time
+    of their first request and request a transport again from their checkpointed position.
+
+    Args:
+        customer (CustomerAgent): the customer
+        state (dict): the state returned by ``customer_state``
+        start (float): the timestamp of the start of the resumed simulation
+    """
+    customer.current_pos = state["position"]
+    customer.init_time = _absolute(state["init_time"], start)
+    if state["status"] == CUSTOMER_IN_DEST:
+        customer.waiting_for_pickup_time = _absolute(state["waiting_for_pickup_time"], start)
+        customer.assignment_time = _absolute(state["assignment_time"], start)
+        customer.pickup_time = _absolute(state["pickup_time"], start)
+        customer.end_time = _absolute(state["end_time"], start)
+        customer.status = CUSTOMER_IN_DEST
+    else:
+        customer.status = CUSTOMER_WAITING
+
+
+def station_state(station, start):
+    """
+    Returns the state of a station agent.
+
+    Args:
+        station (StationAgent): the station
+        start (float): the timestamp of the start of the simulation
+
+    Returns:
+        dict: the state of the station
+    """
+    return {
+        "status": station.status,
+        "available_places": station.available_places,
+        "queue": [str(transport) for transport in station.waiting_list],
+        "charged_transports": station.charged_transports,
+        "max_queue_length": station.max_queue_length,
+        "total_busy_time": station.total_busy_time,
+        "queue_times": station.queue_times,
+        "queued_transports": station.queued_transports,
+    }
+
+
+def restore_station(station, state, start):
+    """
+    Restores the counters of a station agent. The transports of its queue and its places request them again, so the
+    station starts with all its places free.
+
+    Args:
+        station (StationAgent): the station
+        state (dict): the state returned by ``station_state``
+        start (float): the timestamp of the start of the resumed simulation
+    """
+    station.charged_transports = state["charged_transports"]
+    station.max_queue_length = state["max_queue_length"]
+    station.total_busy_time = state["total_busy_time"] or 0.0
+    station.queue_times = state.get("queue_times", {})
+    station.queued_transports = state.get("queued_transports", 0)
+    station.set_status(FREE_STATION if station.get_available_places() else BUSY_STATION)
+
+
+STATES = {"transports": (transport_state, restore_transport), "customers": (customer_state, restore_customer),
+          "stations": (station_state, restore_station)}
+
+
+def take_snapshot(simulator):
+    """
+    Takes a snapshot of a running simulation.
+
+    Args:
+        simulator (SimulatorAgent): the simulator
+
+    Returns:
+        dict: the snapshot (clock, scenario and state of every agent)
+    """
+    start = simulator.simulation_init_time or time.time()
+    config = simulator.config.to_dict()
+    agents = {"transports": simulator.transport_agents, "customers": simulator.customer_agents,
+              "stations": simulator.station_agents}
+    snapshot = {"version": VERSION, "time": simulator.get_simulation_time(), "created": time.time()}
+    for key in AGENT_KEYS:
+        get_state = STATES[key][0]
+        states, scenario = [], []
+        for agent_config in config[key]:
+            agent = agents[key].get(agent_config["name"])
+            state = get_state(agent, start) if agent is not None and agent.is_launched else None
+            states.append(state)
+            if state is not None and state.get("position"):
+                agent_config = dict(agent_config, position=state["position"])
+            scenario.append(agent_config)
+        snapshot[key] = states
+        config[key] = scenario
+    snapshot["config"] = config
+    return snapshot
+
+
+def restore_snapshot(simulator, snapshot):
+    """
+    Restores the agents of a simulator (created from the scenario of the snapshot) and moves the simulation clock to
+    the time of the snapshot.
+
+    Args:
+        simulator (SimulatorAgent): the simulator
+        snapshot (dict): the snapshot returned by ``read_checkpoint``
+
+    Returns:
+        float: the timestamp of the start of the resumed simulation
+    """
+    start = time.time() - snapshot["time"]
+    agents = {"transports": simulator.transport_agents, "customers": simulator.customer_agents,
+              "stations": simulator.station_agents}
+    restored = 0
+    for key in AGENT_KEYS:
+        restore = STATES[key][1]
+        for agent_config, state in zip(simulator.config[key], snapshot[key]):
+            agent = agents[key].get(agent_config["name"])
+            if agent is not None and state is not None:
+                restore(agent, state, start)
+                restored += 1
+    logger.info("Restored {} agents from the checkpoint at {:.1f} seconds".format(restored, snapshot["time"]))
+    return start
+
+
+class CheckpointBehaviour(PeriodicBehaviour):
+    """
+    Periodically writes a checkpoint of the simulation.
+    """
+
+    async def run(self):
+        if self.agent.simulation_running:
+            self.agent.write_checkpoint()
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 """Console script for SimFleet."""
+import json
 import logging
 import sys
 import time
@@ -8,25 +9,22 @@ import time
 import click
 from loguru import logger
 from spade import quit_spade
+from tabulate import tabulate
 
+from .bench import REFERENCE_SCENARIOS, run_benchmark, compare, write_results
+from .checkpoint import resume_config
 from .config import SimfleetConfig
+from .generator import ScenarioGenerator, UniformDistribution, HotspotDistribution, GeoJSONDistribution, \
+    parse_arrival_rates
+from .replay import Replay, set_replay
+from .shards import PARTITIONS, fetch_shard_config, launch_workers
 from .simulator import SimulatorAgent
+from .sweep import parse_param, run_sweep, write_results as write_sweep_results
+from .trajectory import run_playback_server
+from .utils import unused_port
 
 
-@click.command()
-@click.option('-n', '--name', help="Name of the simulation execution.")
-@click.option('-o', '--output', help="Filename to save simulation results.")
-@click.option('-of', '--oformat', help="Output format used to save simulation results. (default: json)",
-              type=click.Choice(['json', 'excel']), default="json")
-@click.option('-mt', '--max-time', help="Maximum simulation time (in seconds).", type=int)
-@click.option('-r', '--autorun', help="Run simulation as soon as the agents are ready.", is_flag=True)
-@click.option('-c', '--config', help="Filename of JSON file with initial config.")
-@click.option('-v', '--verbose', count=True,
-              help="Show verbose debug level: -v level 1, -vv level 2, -vvv level 3, -vvvv level 4")
-def main(name, output, oformat, max_time, autorun, config, verbose):
-    """
-    Console script for SimFleet.
-    """
+def setup_logging(verbose):
     if verbose > 0:
         logger.remove()
         logger.add(sys.stderr, level="DEBUG")
@@ -46,14 +44,91 @@ def main(name, output, oformat, max_time, autorun, config, verbose):
     else:
         logging.getLogger("aioxmpp").setLevel(logging.WARNING)
 
+
+@click.group(invoke_without_command=True)
+@click.option('-n', '--name', help="Name of the simulation execution.")
+@click.option('-o', '--output', help="Filename to save simulation results.")
+@click.option('-of', '--oformat', help="Output format used to save simulation results. (default: json)",
+              type=click.Choice(['json', 'excel', 'parquet', 'arrow']), default="json")
+@click.option('-mt', '--max-time', help="Maximum simulation time (in seconds).", type=int)
+@click.option('-r', '--autorun', help="Run simulation as soon as the agents are ready.", is_flag=True)
+@click.option('-c', '--config', help="Filename of JSON file with initial config.")
+@click.option('--headless', help="Run without the web interface (implies --autorun).", is_flag=True)
+@click.option('-ws', '--warm-start', help="Register the agents directly, without registration messages.", is_flag=True)
+@click.option('--shards', help="Split the transports, customers and stations among this number of worker processes.",
+              type=int, default=0)
+@click.option('--partition', help="How agents are split among shards. (default: geography)",
+              type=click.Choice(PARTITIONS), default="geography")
+@click.option('--no-launch', help="Do not launch the shard workers (start them with 'simfleet worker').",
+              is_flag=True)
+@click.option('-m', '--metrics', help="Enable the instrumentation of the simulation (see /metrics).", is_flag=True)
+@click.option('-mo', '--metrics-output', help="Filename to save the metrics at the end of the simulation.")
+@click.option('-el', '--event-log', help="Filename (.csv, .jsonl or .arrow) to stream the events of every trip.")
+@click.option('-tr', '--trajectory', help="Filename to save the positions of the transports (see 'simfleet playback').")
+@click.option('--record', help="Filename to record the simulation to replay it later (see 'simfleet replay').")
+@click.option('--seed', help="Seed of the random generator.", type=int)
+@click.option('-cp', '--checkpoint', help="Filename (.json.gz) to periodically save a checkpoint of the simulation.")
+@click.option('-ci', '--checkpoint-interval', help="Seconds between checkpoints. (default: 300)", type=float)
+@click.option('--resume', help="Checkpoint to resume the simulation from (see --checkpoint).")
+@click.option('-v', '--verbose', count=True,
+              help="Show verbose debug level: -v level 1, -vv level 2, -vvv level 3, -vvvv level 4")
+@click.pass_context
+def main(ctx, name, output, oformat, max_time, autorun, config, headless, warm_start, shards, partition, no_launch,
+         metrics, metrics_output, event_log, trajectory, record, seed, checkpoint, checkpoint_interval, resume,
+         verbose):
+    """
+    Console script for SimFleet.
+    """
+    setup_logging(verbose)
+
+    if ctx.invoked_subcommand is not None:
+        return
+
     simfleet_config = SimfleetConfig(config, name, max_time, verbose)
+    if headless:
+        simfleet_config.headless = True
+        if simfleet_config.max_time is None:
+            logger.warning("Running headless without --max-time. The simulation will only stop with Ctrl+C.")
+    if warm_start:
+        simfleet_config.warm_start = True
+    if shards:
+        simfleet_config.shards = shards
+        simfleet_config.partition = partition
+    if metrics or metrics_output:
+        simfleet_config.metrics = True
+    if metrics_output:
+        simfleet_config.metrics_output = metrics_output
+    if event_log:
+        simfleet_config.event_log = event_log
+    if trajectory:
+        simfleet_config.trajectory = trajectory
+    if record:
+        if simfleet_config.shards:
+            raise click.UsageError("Distributed simulations (--shards) can not be recorded.")
+        simfleet_config.record = record
+    if seed is not None:
+        simfleet_config.seed = seed
+    if checkpoint:
+        simfleet_config.checkpoint = checkpoint
+    if checkpoint_interval:
+        simfleet_config.checkpoint_interval = checkpoint_interval
+    if resume:
+        resume_config(simfleet_config, resume)
+    if simfleet_config.shards and (simfleet_config.checkpoint or simfleet_config.resume):
+        raise click.UsageError("Distributed simulations (--shards) do not support checkpoints.")
 
     simulator_name = "simulator_{}@{}".format(name, simfleet_config.host)
 
     simulator = SimulatorAgent(config=simfleet_config, agentjid=simulator_name)
-    simulator.start()
+    future = simulator.start()
 
-    if autorun:
+    workers = []
+    if simfleet_config.shards and not no_launch:
+        future.result()  # the workers download their config from the web interface of the coordinator
+        coordinator = "http://{}:{}/".format(simfleet_config.http_ip, simfleet_config.http_port)
+        workers = launch_workers(simfleet_config.shards, coordinator, verbose)
+
+    if autorun or simfleet_config.headless:
         simulator.run()
 
     while not simulator.is_simulation_finished():
@@ -66,10 +141,243 @@ def main(name, output, oformat, max_time, autorun, config, verbose):
     if output:
         simulator.write_file(output, oformat)
 
+    for process in workers:
+        process.wait()
+
+    quit_spade()
+
+    sys.exit(0)
+
+
+@main.command()
+@click.option('--coordinator', help="URL of the web interface of the coordinator simulator.", required=True)
+@click.option('--shard', help="Index of the shard run by this worker.", type=int, required=True)
+@click.option('--http-ip', help="IP of the web interface of this worker (reachable by the coordinator).",
+              default="127.0.0.1", show_default=True)
+@click.pass_context
+def worker(ctx, coordinator, shard, http_ip):
+    """
+    Runs a shard of a simulation started with --shards.
+    """
+    if not coordinator.endswith("/"):
+        coordinator += "/"
+    data = fetch_shard_config(coordinator, shard)
+
+    simfleet_config = SimfleetConfig(verbose=ctx.parent.params["verbose"])
+    simfleet_config.update(data)
+    simfleet_config.update({"shard": shard, "coordinator": coordinator, "http_ip": http_ip,
+                            "http_port": unused_port(http_ip)})
+
+    simulator_name = "simulator_{}_shard{}@{}".format(simfleet_config.simulation_name, shard, simfleet_config.host)
+    simulator = SimulatorAgent(config=simfleet_config, agentjid=simulator_name)
+    simulator.start()
+
+    while not simulator.shard_quit.is_set():
+        try:
+            time.sleep(0.5)
+        except KeyboardInterrupt:
+            break
+
+    simulator.stop().result()
+    quit_spade()
+
+    sys.exit(0)
+
+
+@main.command()
+@click.argument('log')
+@click.option('-o', '--output', help="Filename to save simulation results.")
+@click.option('-of', '--oformat', help="Output format used to save simulation results. (default: json)",
+              type=click.Choice(['json', 'excel', 'parquet', 'arrow']), default="json")
+@click.option('-m', '--metrics', help="Enable the instrumentation of the replayed simulation.", is_flag=True)
+@click.pass_context
+def replay(ctx, log, output, oformat, metrics):
+    """
+    Replays a simulation recorded with --record, without XMPP and route servers.
+    """
+    recorded = Replay(log)
+    set_replay(recorded)
+
+    simfleet_config = SimfleetConfig(verbose=ctx.parent.params["verbose"])
+    simfleet_config.update(recorded.config)
+    simfleet_config.update({"headless": True, "record": None, "max_time": None, "metrics": metrics})
+
+    simulator_name = "simulator_{}@{}".format(simfleet_config.simulation_name, simfleet_config.host)
+    simulator = SimulatorAgent(config=simfleet_config, agentjid=simulator_name)
+    start = time.time()
+    simulator.start().result()
+    simulator.submit(recorded.drive(simulator)).result()
+    elapsed = time.time() - start
+
+    simulator.stop().result()
+    logger.info("Replayed {} messages of {} in {:.2f} seconds.".format(recorded.delivered, log, elapsed))
+    if output:
+        simulator.write_file(output, oformat)
+
     quit_spade()
 
     sys.exit(0)
 
 
+@main.command()
+@click.argument('trajectory')
+@click.option('--ip', help="IP of the web interface.", default="127.0.0.1", show_default=True)
+@click.option('-p', '--port', help="Port of the web interface.", type=int, default=9000, show_default=True)
+def playback(trajectory, ip, port):
+    """
+    Plays back in the browser a trajectory file written with --trajectory.
+    """
+    run_playback_server(trajectory, ip, port)
+
+
+def parse_bbox(ctx, param, value):
+    if value is None:
+        return None
+    try:
+        bbox = [float(coord) for coord in value.split(",")]
+    except ValueError:
+        raise click.BadParameter("bounding box must be min_lat,min_lng,max_lat,max_lng")
+    if len(bbox) != 4:
+        raise click.BadParameter("bounding box must be min_lat,min_lng,max_lat,max_lng")
+    return bbox
+
+
+def parse_rates(ctx, param, value):
+    if value is None:
+        return None
+    try:
+        return parse_arrival_rates(value)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+
+@main.command()
+@click.option('-o', '--output', help="Filename of the generated config file.", required=True)
+@click.option('--fleets', help="Number of fleet managers.", type=int, default=1, show_default=True)
+@click.option('--transports', help="Number of transports.", type=int, default=10, show_default=True)
+@click.option('--customers', help="Number of customers.", type=int, default=10, show_default=True)
+@click.option('--stations', help="Number of charging stations.", type=int, default=0, show_default=True)
+@click.option('--fleet-type', help="Fleet type of fleets, transports and customers.", default="taxi",
+              show_default=True)
+@click.option('--demand', help="Spatial distribution of customer origins.",
+              type=click.Choice(['uniform', 'hotspot', 'geojson']), default="uniform", show_default=True)
+@click.option('--destinations', help="Spatial distribution of customer destinations.",
+              type=click.Choice(['uniform', 'hotspot', 'geojson']), default="uniform", show_default=True)
+@click.option('--geojson', help="GeoJSON file with points or polygons (for the geojson distribution).")
+@click.option('--bbox', help="Area of the scenario as min_lat,min_lng,max_lat,max_lng. (default: Valencia)",
+              callback=parse_bbox)
+@click.option('--hotspots', help="Number of hotspots (for the hotspot distribution).", type=int, default=5,
+              show_default=True)
+@click.option('--hotspot-radius', help="Radius of the hotspots in meters.", type=float, default=500,
+              show_default=True)
+@click.option('--arrival-rate', help="Customer arrival rates as start:customers_per_second pairs "
+                                     "(e.g. 0:0.5,600:2). All customers start at once if not set.",
+              callback=parse_rates)
+@click.option('--speed', help="Speed of the transports.", type=float)
+@click.option('--autonomy', help="Autonomy of the transports (in km).", type=int)
+@click.option('--places', help="Places of every station.", type=int, default=4, show_default=True)
+@click.option('--power', help="Power of every station.", type=int, default=50, show_default=True)
+@click.option('--host', help="XMPP host of the simulation.", default="127.0.0.1", show_default=True)
+@click.option('-mt', '--max-time', help="Maximum simulation time (in seconds).", type=int)
+@click.option('-n', '--name', help="Name of the simulation.")
+@click.option('--seed', help="Random seed.", type=int)
+def generate(output, fleets, transports, customers, stations, fleet_type, demand, destinations, geojson, bbox,
+             hotspots, hotspot_radius, arrival_rate, speed, autonomy, places, power, host, max_time, name, seed):
+    """
+    Generates a synthetic scenario config file.
+    """
+
+    def distribution(kind):
+        if kind == "hotspot":
+            return HotspotDistribution(bbox, hotspots=hotspots, radius=hotspot_radius)
+        elif kind == "geojson":
+            if not geojson:
+                raise click.BadParameter("--geojson is required for the geojson distribution")
+            return GeoJSONDistribution(geojson)
+        return UniformDistribution(bbox)
+
+    generator = ScenarioGenerator(fleets=fleets, transports=transports, customers=customers, stations=stations,
+                                  fleet_type=fleet_type, host=host, demand=distribution(demand),
+                                  destinations=distribution(destinations), supply=UniformDistribution(bbox),
+                                  arrival_rates=arrival_rate,
+                                  speed=speed, autonomy=autonomy, places=places, power=power, seed=seed)
+    settings = {"host": host}
+    if name:
+        settings["simulation_name"] = name
+    if max_time:
+        settings["max_time"] = max_time
+    if bbox:
+        settings["coords"] = [(bbox[0] + bbox[2]) / 2, (bbox[1] + bbox[3]) / 2]
+
+    with open(output, "w") as f:
+        generator.write(f, settings)
+    logger.info("Scenario written to {}".format(output))
+
+
+@main.command()
+@click.option('-s', '--scenario', help="Reference scenario to run (can be repeated). (default: all)",
+              type=click.Choice(list(REFERENCE_SCENARIOS.keys())), multiple=True)
+@click.option('-o', '--output', help="Filename to save the benchmark results.", default="bench.json",
+              show_default=True)
+@click.option('-b', '--baseline', help="Results file of a previous benchmark to compare with.")
+@click.option('--host', help="XMPP host of the simulation.", default="127.0.0.1", show_default=True)
+@click.option('--seed', help="Random seed of the scenarios.", type=int, default=0, show_default=True)
+def bench(scenario, output, baseline, host, seed):
+    """
+    Runs the reference benchmark scenarios against a stub route server.
+    """
+    results = run_benchmark(list(scenario), host=host, seed=seed)
+    write_results(results, output)
+
+    rows = [[name, r.get("agents"), r.get("startup_time"), r.get("messages_per_second"),
+             r.get("route_requests_per_second"), (r.get("dispatch_latency") or {}).get("p95"),
+             (r.get("loop_lag") or {}).get("p95"), r.get("peak_rss_kb"), r.get("error")]
+            for name, r in results["scenarios"].items()]
+    print(tabulate(rows, headers=["scenario", "agents", "startup (s)", "msg/s", "routes/s", "dispatch p95 (s)",
+                                  "loop lag p95 (s)", "peak RSS (KB)", "error"], tablefmt="fancy_grid"))
+    if baseline:
+        with open(baseline) as f:
+            rows = compare(results, json.load(f))
+        print(tabulate(rows, headers=["scenario", "metric", "baseline", "current", "change"], tablefmt="fancy_grid"))
+    logger.info("Benchmark results written to {}".format(output))
+
+
+@main.command()
+@click.option('-c', '--config', help="Filename of JSON file with the scenario.")
+@click.option('-g', '--grid', help="Filename of a JSON file with a list of values for every config parameter.")
+@click.option('-p', '--param', help="A config parameter and its values as key=value1,value2 (can be repeated).",
+              multiple=True)
+@click.option('-j', '--jobs', help="Number of parallel simulations. (default: number of CPUs)", type=int)
+@click.option('-o', '--output', help="Filename of the merged results (CSV or JSON).", default="sweep.csv",
+              show_default=True)
+@click.option('-d', '--output-dir', help="Directory for the results of every run and the route cache.",
+              default="sweep", show_default=True)
+@click.option('-mt', '--max-time', help="Maximum simulation time of every run (in seconds).", type=int)
+@click.option('--route-cache', help="Route cache shared by the runs. (default: routes.sqlite in the output dir)")
+@click.option('--resume', help="Checkpoint used as the warm start of every run (replaces the scenario).")
+def sweep(config, grid, param, jobs, output, output_dir, max_time, route_cache, resume):
+    """
+    Runs a scenario with every combination of a parameter grid in parallel processes.
+    """
+    if not config and not resume:
+        raise click.UsageError("Missing option '-c' / '--config' (or '--resume').")
+    values = {}
+    if grid:
+        with open(grid) as f:
+            values.update(json.load(f))
+    for item in param:
+        try:
+            key, items = parse_param(item)
+        except ValueError as e:
+            raise click.BadParameter(str(e))
+        values[key] = items
+
+    results = run_sweep(config, values, jobs=jobs, output_dir=output_dir, max_time=max_time,
+                        route_cache=route_cache, resume=resume)
+    write_sweep_results(results, output)
+    print(tabulate(results, headers="keys", showindex=False, tablefmt="fancy_grid"))
+    logger.info("Sweep results written to {}".format(output))
+
+
 if __name__ == "__main__":
     main()
@@ -61,6 +61,16 @@ class SimfleetConfig(object):
         self.__config["route_host"] = self.__config.get("route_host", "http://router.project-osrm.org/")
         self.__config["route_name"] = self.__config.get("route_name", "route")
         self.__config["route_password"] = self.__config.get("route_passwd", "route_passwd")
+        self.__config["route_cache"] = self.__config.get("route_cache", None)
+        self.__config["route_policy"] = self.__config.get("route_policy", None)
+        self.__config["event_log"] = self.__config.get("event_log", None)
+        self.__config["record"] = self.__config.get("record", None)
+        self.__config["trajectory"] = self.__config.get("trajectory", None)
+        self.__config["trajectory_interval"] = self.__config.get("trajectory_interval", 1.0)
+        self.__config["seed"] = self.__config.get("seed", None)
+        self.__config["checkpoint"] = self.__config.get("checkpoint", None)
+        self.__config["checkpoint_interval"] = self.__config.get("checkpoint_interval", 300)
+        self.__config["resume"] = self.__config.get("resume", None)
         self.__config["directory_name"] = self.__config.get("directory_name", "directory")
         self.__config["directory_password"] = self.__config.get("directory_passwd", "directory_passwd")
 
@@ -69,6 +79,19 @@ class SimfleetConfig(object):
         self.__config["http_port"] = self.__config.get("http_port", 9000)
         self.__config["http_ip"] = self.__config.get("http_ip", "127.0.0.1")
 
+        self.__config["headless"] = self.__config.get("headless", False)
+        self.__config["warm_start"] = self.__config.get("warm_start", False)
+        self.__config["charging_dispatch"] = self.__config.get("charging_dispatch", None)
+        self.__config["rebalancing"] = self.__config.get("rebalancing", None)
+
+        self.__config["shards"] = self.__config.get("shards", 0)
+        self.__config["partition"] = self.__config.get("partition", "geography")
+        self.__config["shard"] = self.__config.get("shard", None)
+        self.__config["coordinator"] = self.__config.get("coordinator", None)
+
+        self.__config["metrics"] = self.__config.get("metrics", False)
+        self.__config["metrics_output"] = self.__config.get("metrics_output", None)
+
         logger.debug("Config loaded: {}".format(self))
 
     def load_config(self, filename):
@@ -76,6 +99,22 @@ class SimfleetConfig(object):
             logger.info("Reading config {}".format(filename))
             self.__config.update(json.load(f))
 
+    def to_dict(self):
+        """
+        Returns:
+            dict: a copy of all the fields of the config
+        """
+        return dict(self.__config)
+
+    def update(self, values):
+        """
+        Overrides fields of the config (e.g. the parameters of a sweep variant).
+
+        Args:
+            values (dict): the fields to be overridden
+        """
+        self.__config.update(values)
+
     @property
     def num_managers(self):
         try:
@@ -8,14 +8,17 @@ from spade.behaviour import CyclicBehaviour
 from spade.message import Message
 from spade.template import Template
 
+from .eventlog import ACCEPT, PICKUP, REFUSE, REQUEST, log_event
 from .helpers import random_position
+from .metrics import InstrumentedAgentMixin, registry as metrics
 from .protocol import REQUEST_PROTOCOL, TRAVEL_PROTOCOL, REQUEST_PERFORMATIVE, ACCEPT_PERFORMATIVE, REFUSE_PERFORMATIVE, \
     QUERY_PROTOCOL
+from .replay import ReplayAgentMixin
 from .utils import CUSTOMER_WAITING, CUSTOMER_IN_DEST, TRANSPORT_MOVING_TO_CUSTOMER, CUSTOMER_IN_TRANSPORT, \
     TRANSPORT_IN_CUSTOMER_PLACE, CUSTOMER_LOCATION, StrategyBehaviour, request_path, status_to_str
 
 
-class CustomerAgent(Agent):
+class CustomerAgent(ReplayAgentMixin, InstrumentedAgentMixin, Agent):
     def __init__(self, agentjid, password):
         super().__init__(agentjid, password)
         self.agent_id = None
@@ -25,6 +28,7 @@ class CustomerAgent(Agent):
         self.fleet_type = None
         self.fleetmanagers = None
         self.route_host = None
+        self._status = None
         self.status = CUSTOMER_WAITING
         self.current_pos = None
         self.dest = None
@@ -32,6 +36,7 @@ class CustomerAgent(Agent):
         self.transport_assigned = None
         self.init_time = None
         self.waiting_for_pickup_time = None
+        self.assignment_time = None
         self.pickup_time = None
         self.end_time = None
         self.stopped = False
@@ -41,6 +46,15 @@ class CustomerAgent(Agent):
         self.directory_id = None
         self.type_service = "taxi"
 
+    @property
+    def status(self):
+        return self._status
+
+    @status.setter
+    def status(self, status):
+        metrics.move("customers", status_to_str(self._status) if self._status else None, status_to_str(status))
+        self._status = status
+
     async def setup(self):
         try:
             template = Template()
@@ -123,7 +137,7 @@ class CustomerAgent(Agent):
         if coords:
             self.current_pos = coords
         else:
-            self.current_pos = random_position()
+            self.current_pos = random_position(self.name)
         logger.debug("Customer {} position is {}".format(self.agent_id, self.current_pos))
 
     def get_position(self):
@@ -146,7 +160,7 @@ class CustomerAgent(Agent):
         if coords:
             self.dest = coords
         else:
-            self.dest = random_position()
+            self.dest = random_position(self.name)
         logger.debug("Customer {} target position is {}".format(self.agent_id, self.dest))
 
     def is_in_destination(self):
@@ -211,6 +225,17 @@ class CustomerAgent(Agent):
             return t
         return None
 
+    def get_dispatch_time(self):
+        """
+        Returns the time since the customer was activated until a transport was assigned to pick it up.
+
+        Returns:
+            float: The time the customer was waiting for an assignment.
+        """
+        if self.init_time and self.assignment_time:
+            return self.assignment_time - self.init_time
+        return None
+
     def get_pickup_time(self):
         """
         Returns the time that the customer was waiting to be picked up since it has been assigned to a transport.
@@ -279,10 +304,12 @@ class TravelBehaviour(CyclicBehaviour):
                 if status == TRANSPORT_MOVING_TO_CUSTOMER:
                     logger.info("Customer {} waiting for transport.".format(self.agent.name))
                     self.agent.waiting_for_pickup_time = time.time()
+                    self.agent.assignment_time = self.agent.waiting_for_pickup_time
                 elif status == TRANSPORT_IN_CUSTOMER_PLACE:
                     self.agent.status = CUSTOMER_IN_TRANSPORT
                     logger.info("Customer {} in transport.".format(self.agent.name))
                     self.agent.pickup_time = time.time()
+                    log_event(PICKUP, self.agent.name, self.agent.transport_assigned, self.agent.current_pos)
                 elif status == CUSTOMER_IN_DEST:
                     self.agent.status = CUSTOMER_IN_DEST
                     self.agent.end_time = time.time()
@@ -313,7 +340,8 @@ class CustomerStrategyBehaviour(StrategyBehaviour):
         Initializes the logger and timers. Call to parent method if overloaded.
         """
         logger.debug("Strategy {} started in customer {}".format(type(self).__name__, self.agent.name))
-        self.agent.init_time = time.time()
+        if self.agent.init_time is None:  # a customer resumed from a checkpoint keeps the time of its first request
+            self.agent.init_time = time.time()
 
     async def send_get_managers(self, content=None):
         """
@@ -346,7 +374,7 @@ class CustomerStrategyBehaviour(StrategyBehaviour):
             content (dict): Optional content dictionary
         """
         if not self.agent.dest:
-            self.agent.dest = random_position()
+            self.agent.dest = random_position(self.agent.name)
         if content is None or len(content) == 0:
             content = {
                 "customer_id": str(self.agent.jid),
@@ -361,6 +389,7 @@ class CustomerStrategyBehaviour(StrategyBehaviour):
                 msg.set_metadata("performative", REQUEST_PERFORMATIVE)
                 msg.body = json.dumps(content)
                 await self.send(msg)
+            log_event(REQUEST, self.agent.name, position=self.agent.current_pos)
             logger.info("Customer {} asked for a transport to {}.".format(self.agent.name, self.agent.dest))
         else:
             logger.warning("Customer {} has no fleet managers.".format(self.agent.name))
@@ -385,6 +414,7 @@ class CustomerStrategyBehaviour(StrategyBehaviour):
         reply.body = json.dumps(content)
         await self.send(reply)
         self.agent.transport_assigned = str(transport_id)
+        log_event(ACCEPT, self.agent.name, transport_id, self.agent.current_pos)
         logger.info("Customer {} accepted proposal from transport {}".format(self.agent.name, transport_id))
 
     async def refuse_transport(self, transport_id):
@@ -407,6 +437,7 @@ class CustomerStrategyBehaviour(StrategyBehaviour):
         reply.body = json.dumps(content)
 
         await self.send(reply)
+        log_event(REFUSE, self.agent.name, transport_id, self.agent.current_pos)
         logger.info("Customer {} refused proposal from transport {}".format(self.agent.name,
                                                                             transport_id))
 
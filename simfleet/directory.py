@@ -1,23 +1,213 @@
 import json
+import math
 from asyncio import CancelledError
+from collections import defaultdict
 
 from loguru import logger
 from spade.agent import Agent
 from spade.message import Message
 from spade.template import Template
 
+from .helpers import distance_in_meters
+from .metrics import InstrumentedAgentMixin, registry as metrics
 from .protocol import REGISTER_PROTOCOL, INFORM_PERFORMATIVE, ACCEPT_PERFORMATIVE, \
-    CANCEL_PERFORMATIVE, REQUEST_PERFORMATIVE, QUERY_PROTOCOL
+    CANCEL_PERFORMATIVE, REQUEST_PERFORMATIVE, QUERY_PROTOCOL, SUBSCRIBE_PERFORMATIVE, UNSUBSCRIBE_PERFORMATIVE, \
+    UPDATE_PERFORMATIVE
+from .replay import ReplayAgentMixin
 from .utils import StrategyBehaviour, CyclicBehaviour
 
+CELL_SIZE = 0.01  # degrees of the cells of the spatial index (about 1 km)
+KM_PER_DEGREE = 111.32
 
-class DirectoryAgent(Agent):
+
+def parse_query(body):
+    """
+    Parses the body of a query to the directory. A query is the type of service (e.g. ``"station"``) or a JSON object
+    with the type and the filters of the query::
+
+        {"type": "station", "position": [39.47, -0.37], "radius": 2.5, "status": "FREE_STATION", "limit": 5}
+
+    Args:
+        body (str): the body of the message
+
+    Returns:
+        str, dict: the type of service and the filters (``position``, ``radius`` in km, ``status`` and ``limit``)
+    """
+    try:
+        query = json.loads(body)
+    except (TypeError, ValueError):
+        return body, {}
+    if not isinstance(query, dict):
+        return body, {}
+    service_type = query.pop("type", None)
+    return service_type, query
+
+
+def matches(content, filters):
+    """
+    Checks whether a service matches the filters of a query.
+
+    Args:
+        content (dict): the registration of the service
+        filters (dict): the filters of the query
+
+    Returns:
+        bool: whether the service matches
+    """
+    status = filters.get("status")
+    if status is not None:
+        if content.get("status") not in (status if isinstance(status, list) else [status]):
+            return False
+    if filters.get("radius") is not None and filters.get("position") is not None:
+        if content.get("position") is None:
+            return False
+        return distance_in_meters(filters["position"], content["position"]) <= filters["radius"] * 1000
+    return True
+
+
+class ServiceIndex(object):
+    """
+    The services (managers and stations) registered in the directory, indexed by type and by position, and the
+    subscriptions to every type of service.
+    """
+
+    def __init__(self):
+        self.by_type = {}  # type -> {jid: registration}
+        self.cells = defaultdict(lambda: defaultdict(set))  # type -> {cell: set of jids}
+        self.subscriptions = defaultdict(dict)  # type -> {subscriber: filters}
+
+    @staticmethod
+    def cell(position):
+        return int(math.floor(position[0] / CELL_SIZE)), int(math.floor(position[1] / CELL_SIZE))
+
+    def add(self, content):
+        """
+        Adds (or replaces) a service.
+
+        Args:
+            content (dict): the registration of the service, with its ``jid`` and ``type``
+
+        Returns:
+            dict, dict: the previous registration of the service (None if new) and the new one
+        """
+        services = self.by_type.setdefault(content["type"], {})
+        old = self.remove(content["type"], content["jid"]) if content["jid"] in services else None
+        services[content["jid"]] = content
+        if content.get("position"):
+            self.cells[content["type"]][self.cell(content["position"])].add(content["jid"])
+        return old, content
+
+    def update(self, service_type, jid, values):
+        """
+        Updates some fields (e.g. the status) of a registered service.
+
+        Args:
+            service_type (str): the type of the service
+            jid (str): the jid of the service
+            values (dict): the new values
+
+        Returns:
+            dict, dict: the previous registration of the service and the new one (Nones if it is not registered)
+        """
+        old = self.by_type.get(service_type, {}).get(jid)
+        if old is None:
+            return None, None
+        return self.add(dict(old, **values))
+
+    def remove(self, service_type, jid):
+        """
+        Removes a service.
+
+        Returns:
+            dict: the registration of the removed service (None if it was not registered)
+        """
+        content = self.by_type.get(service_type, {}).pop(jid, None)
+        if content is not None and content.get("position"):
+            self.cells[service_type][self.cell(content["position"])].discard(jid)
+        return content
+
+    def candidates(self, service_type, filters):
+        services = self.by_type.get(service_type, {})
+        position, radius = filters.get("position"), filters.get("radius")
+        if position is None or radius is None:
+            return services.values()
+        dlat = radius / KM_PER_DEGREE
+        dlon = radius / (KM_PER_DEGREE * max(math.cos(math.radians(position[0])), 0.01))
+        (lat0, lon0), (lat1, lon1) = self.cell([position[0] - dlat, position[1] - dlon]), \
+            self.cell([position[0] + dlat, position[1] + dlon])
+        if (lat1 - lat0 + 1) * (lon1 - lon0 + 1) > len(services):
+            return services.values()
+        cells = self.cells[service_type]
+        return [services[jid] for lat in range(lat0, lat1 + 1) for lon in range(lon0, lon1 + 1)
+                for jid in cells.get((lat, lon), ())]
+
+    def query(self, service_type, filters=None):
+        """
+        Returns the services of a type that match the filters of a query. If the query has a position the services
+        are sorted by distance and services without position are left out.
+
+        Args:
+            service_type (str): the type of the services
+            filters (dict, optional): the filters of the query (see ``parse_query``)
+
+        Returns:
+            dict: the registration of every matching service by jid
+        """
+        filters = filters or {}
+        result = [content for content in self.candidates(service_type, filters) if matches(content, filters)]
+        if filters.get("position") is not None:
+            result = sorted((content for content in result if content.get("position")),
+                            key=lambda content: distance_in_meters(filters["position"], content["position"]))
+        if filters.get("limit"):
+            result = result[:filters["limit"]]
+        return {content["jid"]: content for content in result}
+
+    def subscribe(self, subscriber, service_type, filters=None):
+        self.subscriptions[service_type][subscriber] = filters or {}
+
+    def unsubscribe(self, subscriber, service_type=None):
+        for key in [service_type] if service_type else list(self.subscriptions):
+            self.subscriptions[key].pop(subscriber, None)
+
+    def changes(self, service_type, old, new):
+        """
+        Computes the notifications for the subscribers of a type of service when a service changes.
+
+        Args:
+            service_type (str): the type of the service
+            old (dict): the previous registration of the service (None if it is new)
+            new (dict): the new registration of the service (None if it was removed)
+
+        Returns:
+            list: a (subscriber, notification) tuple for every subscriber that has to be notified. A notification has
+            the ``added`` and ``updated`` services (by jid) and the jids of the ``removed`` ones
+        """
+        notifications = []
+        jid = (new or old)["jid"]
+        for subscriber, filters in self.subscriptions.get(service_type, {}).items():
+            was = old is not None and matches(old, filters)
+            now = new is not None and matches(new, filters)
+            notification = {"added": {}, "updated": {}, "removed": []}
+            if now and not was:
+                notification["added"][jid] = new
+            elif was and not now:
+                notification["removed"].append(jid)
+            elif now and old != new:
+                notification["updated"][jid] = new
+            else:
+                continue
+            notifications.append((subscriber, notification))
+        return notifications
+
+
+class DirectoryAgent(ReplayAgentMixin, InstrumentedAgentMixin, Agent):
     def __init__(self, agentjid, password):
         super().__init__(jid=agentjid, password=password)
         self.strategy = None
         self.agent_id = None
 
-        self.set("service_agents", {})
+        self.services = ServiceIndex()
+        self.set("service_agents", self.services.by_type)
         self.stopped = False
 
     def set_id(self, agent_id):
@@ -29,6 +219,68 @@ class DirectoryAgent(Agent):
         """
         self.agent_id = agent_id
 
+    def register_service(self, content):
+        """
+        Adds a new service (a manager or a station) to the store.
+
+        Args:
+            content (dict): the registration of the service, with its ``jid`` and ``type``
+
+        Returns:
+            list: the notifications for the subscribers (see ``notify_subscribers``)
+        """
+        return self.services.changes(content["type"], *self.services.add(content))
+
+    def update_service(self, content):
+        """
+        Updates the registration of a service (e.g. a station that informs of its new status).
+
+        Args:
+            content (dict): the ``jid`` and ``type`` of the service and the fields that changed
+
+        Returns:
+            list: the notifications for the subscribers (see ``notify_subscribers``)
+        """
+        values = {key: value for key, value in content.items() if key not in ["jid", "type"]}
+        old, new = self.services.update(content["type"], content["jid"], values)
+        if new is None:
+            return []
+        return self.services.changes(content["type"], old, new)
+
+    def deregister_service(self, service_type, jid):
+        """
+        Removes a service from the store.
+
+        Args:
+            service_type (str): the type of the service
+            jid (str): the jid of the service
+
+        Returns:
+            list: the notifications for the subscribers (see ``notify_subscribers``)
+        """
+        old = self.services.remove(service_type, jid)
+        if old is None:
+            return []
+        logger.debug("Deregistration of {} for service {}".format(jid, service_type))
+        return self.services.changes(service_type, old, None)
+
+    async def notify_subscribers(self, notifications):
+        """
+        Sends the incremental changes of a type of service to its subscribers.
+
+        Args:
+            notifications (list): (subscriber, notification) tuples
+        """
+        for subscriber, notification in notifications:
+            msg = Message()
+            msg.to = str(subscriber)
+            msg.set_metadata("protocol", QUERY_PROTOCOL)
+            msg.set_metadata("performative", UPDATE_PERFORMATIVE)
+            msg.body = json.dumps(notification)
+            await self.send(msg)
+            if metrics.enabled:
+                metrics.inc("directory_notifications_total")
+
     def run_strategy(self):
         """
         Runs the strategy for the directory agent.
@@ -56,29 +308,24 @@ class RegistrationBehaviour(CyclicBehaviour):
     async def on_start(self):
         logger.debug("Strategy {} started in directory".format(type(self).__name__))
 
-    def add_service(self, content):
+    async def add_service(self, content):
         """
-        Adds a new service to the store.
+        Adds a new service to the store and notifies the subscribers.
 
         Args:
             content (dict): content to be added
         """
-        service = self.get("service_agents")
-        if content["type"] in service:
-            service[content["type"]][content["jid"]] = content
-        else:
-            service[content["type"]] = {content["jid"]: content}
+        await self.agent.notify_subscribers(self.agent.register_service(content))
 
-    def remove_service(self, service_type, agent):
+    async def remove_service(self, service_type, agent):
         """
-        Erase a service from the store.
+        Erase a service from the store and notifies the subscribers.
 
         Args:
             service_type (str): the service type to be erased
             agent (str): an str with the jid of the agent to be erased
         """
-        del (self.get("service_agents")[service_type][agent])
-        logger.debug("Deregistration of the Manager {} for service {}".format(agent, service_type))
+        await self.agent.notify_subscribers(self.agent.deregister_service(service_type, agent))
 
     async def send_confirmation(self, agent_id):
         """
@@ -98,9 +345,14 @@ class RegistrationBehaviour(CyclicBehaviour):
                 performative = msg.get_metadata("performative")
                 if performative == REQUEST_PERFORMATIVE:
                     content = json.loads(msg.body)
-                    self.add_service(content)
-                    logger.debug("Registration in the dictionary {}".format(self.agent.name))
                     await self.send_confirmation(agent_id)
+                    await self.add_service(content)
+                    logger.debug("Registration in the dictionary {}".format(self.agent.name))
+                elif performative == INFORM_PERFORMATIVE:
+                    await self.agent.notify_subscribers(self.agent.update_service(json.loads(msg.body)))
+                elif performative == CANCEL_PERFORMATIVE:
+                    content = json.loads(msg.body)
+                    await self.remove_service(content["type"], content["jid"])
         except CancelledError:
             logger.debug("Cancelling async tasks...")
         except Exception as e:
@@ -115,19 +367,23 @@ class DirectoryStrategyBehaviour(StrategyBehaviour):
     async def on_start(self):
         logger.debug("Strategy {} started in directory".format(type(self).__name__))
 
-    async def send_services(self, agent_id, type_service):
+    async def send_services(self, agent_id, type_service, filters=None):
         """
         Send a message to the customer or transport with the current information of the type of service they need.
 
         Args:
             agent_id (str): the id of the manager/station
             type_service (str): the type of service
+            filters (dict, optional): the filters of the query (see ``parse_query``)
         """
         reply = Message()
         reply.to = str(agent_id)
         reply.set_metadata("protocol", QUERY_PROTOCOL)
         reply.set_metadata("performative", INFORM_PERFORMATIVE)
-        reply.body = json.dumps(self.get("service_agents")[type_service])
+        if filters:
+            reply.body = json.dumps(self.agent.services.query(type_service, filters))
+        else:
+            reply.body = json.dumps(self.get("service_agents").get(type_service, {}))
         await self.send(reply)
 
     async def send_negative(self, agent_id):
@@ -149,11 +405,17 @@ class DirectoryStrategyBehaviour(StrategyBehaviour):
         if msg:
             performative = msg.get_metadata("performative")
             agent_id = msg.sender
-            request = msg.body
+            request, filters = parse_query(msg.body)
             if performative == REQUEST_PERFORMATIVE:
                 logger.debug("Directory {} received message from customer/transport {}".format(self.agent.name,
                                                                                               agent_id))
                 if request in self.get("service_agents"):
-                    await self.send_services(agent_id, msg.body)
+                    await self.send_services(agent_id, request, filters)
                 else:
                     await self.send_negative(agent_id)
+            elif performative == SUBSCRIBE_PERFORMATIVE:
+                logger.debug("Agent {} subscribed to {} in directory {}".format(agent_id, request, self.agent.name))
+                self.agent.services.subscribe(str(agent_id), request, filters)
+                await self.send_services(agent_id, request, filters)
+            elif performative == UNSUBSCRIBE_PERFORMATIVE:
+                self.agent.services.unsubscribe(str(agent_id), request)
@@ -0,0 +1,142 @@
+"""
+Energy module
+
+The energy consumption of the transports. An energy model gives the kilometers of autonomy a transport consumes to
+drive a distance (optionally depending on its speed), and the autonomy of all the transports of the simulation is kept
+in the arrays of a single ``FleetEnergy`` (``fleet``), so strategies and the fleet managers can read the state of
+charge of the whole fleet at once.
+
+Transports debit the energy of a route as they move along it: the consumption of the route (from the distance given by
+the route server) is split among the steps of its path, so no distance is computed again while driving.
+
+The consumption of a transport is set with the ``energy`` field of the transport in the config file, e.g.
+``{"consumption": 1.2, "speed_factor": 0.3, "reference_speed": 50}``.
+"""
+
+import numpy as np
+
+
+class EnergyModel(object):
+    """
+    The consumption of a transport: ``consumption`` km of autonomy per km driven at ``reference_speed``. With a
+    ``speed_factor`` the consumption grows with the square of the speed (as the aerodynamic drag does).
+    """
+
+    def __init__(self, consumption=1.0, speed_factor=0.0, reference_speed=50.0):
+        """
+        Args:
+            consumption (float): km of autonomy consumed per km driven at the reference speed
+            speed_factor (float): weight of the speed in the consumption (0 to ignore the speed)
+            reference_speed (float): the speed (in km/h) of the nominal consumption
+        """
+        self.consumption = consumption
+        self.speed_factor = speed_factor
+        self.reference_speed = reference_speed
+
+    def km(self, meters, speed_in_kmh=None):
+        """
+        Returns the autonomy consumed to drive a distance.
+
+        Args:
+            meters (float): the distance in meters
+            speed_in_kmh (float, optional): the speed of the transport
+
+        Returns:
+            float: the km of autonomy consumed
+        """
+        factor = self.consumption
+        if self.speed_factor and speed_in_kmh:
+            factor *= 1 + self.speed_factor * ((speed_in_kmh / self.reference_speed) ** 2 - 1)
+        return max(factor, 0.0) * meters / 1000
+
+
+def create_energy_model(config=None):
+    """
+    Creates the energy model of a transport from its config.
+
+    Args:
+        config (dict, optional): the parameters of the model (see ``EnergyModel``). Defaults to 1 km per km.
+
+    Returns:
+        EnergyModel: the model
+    """
+    return EnergyModel(**(config or {}))
+
+
+class FleetEnergy(object):
+    """
+    The autonomy of every transport, stored in numpy arrays indexed by the position of the transport.
+    """
+
+    def __init__(self, size=64):
+        self.names = []
+        self.indexes = {}
+        self.level = np.zeros(size)
+        self.capacity = np.zeros(size)
+        self.consumed = np.zeros(size)
+
+    def __len__(self):
+        return len(self.names)
+
+    def register(self, name, level, capacity):
+        """
+        Adds a transport (or resets it if it was already added).
+
+        Args:
+            name (str): the jid of the transport
+            level (float): its autonomy in km
+            capacity (float): its maximum autonomy in km
+
+        Returns:
+            int: the index of the transport in the arrays
+        """
+        index = self.indexes.get(name)
+        if index is None:
+            index = len(self.names)
+            if index == len(self.level):
+                self.level, self.capacity, self.consumed = (np.resize(array, 2 * len(array)) for array in
+                                                            (self.level, self.capacity, self.consumed))
+            self.names.append(name)
+            self.indexes[name] = index
+        self.level[index], self.capacity[index], self.consumed[index] = level, capacity, 0.0
+        return index
+
+    def debit(self, index, km):
+        """
+        Debits the autonomy consumed by a transport. The autonomy never goes below zero.
+
+        Args:
+            index (int): the index of the transport
+            km (float): the km of autonomy consumed
+        """
+        self.consumed[index] += km
+        self.level[index] = max(self.level[index] - km, 0.0)
+
+    def soc(self):
+        """
+        Returns the state of charge (0 to 1) of every transport, in the order they were added.
+
+        Returns:
+            numpy.ndarray: the states of charge
+        """
+        size = len(self.names)
+        capacity = self.capacity[:size]
+        return np.divide(self.level[:size], capacity, out=np.zeros(size), where=capacity > 0)
+
+    def below(self, soc):
+        """
+        Returns the transports whose state of charge is below a threshold.
+
+        Args:
+            soc (float): the threshold (0 to 1)
+
+        Returns:
+            list: the jids of the transports
+        """
+        return [self.names[index] for index in np.flatnonzero(self.soc() < soc)]
+
+    def reset(self):
+        self.__init__()
+
+
+fleet = FleetEnergy()
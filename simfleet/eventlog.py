@@ -0,0 +1,206 @@
+"""
+Event log module
+
+An append-only log of the events of every trip (requests, proposals, pickups, dropoffs, charges, ...) written to disk
+while the simulation runs. Events are buffered in memory and written in batches by a background thread, so the agents
+never wait for the disk and long simulations do not need to keep their history in memory.
+
+The format is chosen by the extension of the file: ``.csv``, ``.jsonl`` or ``.arrow`` (Arrow IPC stream, requires
+pyarrow). Every event has the simulation time (seconds since the simulation was started), the kind of event, the name of
+the agent that produced it, the name of the other agent involved (if any) and the coordinates of the agent.
+"""
+
+import csv
+import json
+import queue
+import threading
+import time
+from pathlib import Path
+
+from loguru import logger
+
+from .metrics import registry as metrics
+
+REQUEST = "request"
+PROPOSAL = "proposal"
+ACCEPT = "accept"
+REFUSE = "refuse"
+PICKUP = "pickup"
+DROPOFF = "dropoff"
+CHARGE_START = "charge_start"
+CHARGE_END = "charge_end"
+
+COLUMNS = ["time", "event", "agent", "peer", "latitude", "longitude"]
+FORMATS = {".csv": "csv", ".jsonl": "jsonl", ".arrow": "arrow"}
+
+_log = None
+
+
+class EventLog(object):
+    """
+    Buffers events and writes them in batches from a background thread.
+    """
+
+    def __init__(self, filename, buffer_size=1000):
+        """
+        Args:
+            filename (str): the file of the log. Its extension sets the format (.csv, .jsonl or .arrow)
+            buffer_size (int): number of events kept in memory before they are sent to the writer thread
+        """
+        self.filename = filename
+        self.format = FORMATS.get(Path(filename).suffix.lower())
+        if self.format is None:
+            raise ValueError("Unknown event log format {}. Use one of: {}".format(filename, ", ".join(FORMATS)))
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.start_time = None
+        self.count = 0
+        self.batches = queue.Queue()
+        self.writer = _WRITERS[self.format](filename)
+        self.thread = threading.Thread(target=self._write_batches, name="eventlog", daemon=True)
+        self.thread.start()
+
+    def start(self, start_time=None):
+        """
+        Sets the moment the simulation started. Event times are relative to it.
+
+        Args:
+            start_time (float, optional): a timestamp (``time.time()``). Now if None
+        """
+        self.start_time = start_time or time.time()
+
+    def log(self, event, agent, peer=None, position=None):
+        """
+        Appends an event to the log.
+
+        Args:
+            event (str): the kind of event (see the constants of this module)
+            agent (str): the name or JID of the agent that produced the event
+            peer (str, optional): the name or JID of the other agent involved in the event
+            position (list, optional): the coordinates of the agent (latitude, longitude)
+        """
+        now = time.time() - self.start_time if self.start_time else 0.0
+        latitude, longitude = position if position else (None, None)
+        self.buffer.append((now, event, _name(agent), _name(peer), latitude, longitude))
+        self.count += 1
+        if metrics.enabled:
+            metrics.inc("events_logged_total", event=event)
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Sends the buffered events to the writer thread.
+        """
+        if self.buffer:
+            self.batches.put(self.buffer)
+            self.buffer = []
+
+    def close(self):
+        """
+        Writes all the pending events and closes the file.
+        """
+        self.flush()
+        self.batches.put(None)
+        self.thread.join()
+        logger.info("{} events written to {}".format(self.count, self.filename))
+
+    def _write_batches(self):
+        while True:
+            batch = self.batches.get()
+            if batch is None:
+                break
+            try:
+                self.writer.write(batch)
+            except Exception as e:
+                logger.error("Could not write events to {}: {}".format(self.filename, e))
+        self.writer.close()
+
+
+class _CsvWriter(object):
+    def __init__(self, filename):
+        self.file = open(filename, "w", newline="")
+        self.csv = csv.writer(self.file)
+        self.csv.writerow(COLUMNS)
+
+    def write(self, batch):
+        self.csv.writerows(batch)
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class _JsonLinesWriter(object):
+    def __init__(self, filename):
+        self.file = open(filename, "w")
+
+    def write(self, batch):
+        self.file.writelines(json.dumps(dict(zip(COLUMNS, row))) + "\n" for row in batch)
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class _ArrowWriter(object):
+    def __init__(self, filename):
+        try:
+            import pyarrow
+        except ImportError:
+            raise ImportError("The arrow event log requires pyarrow. Install it with: pip install simfleet[arrow]")
+        self.pyarrow = pyarrow
+        self.schema = pyarrow.schema([("time", pyarrow.float64()), ("event", pyarrow.string()),
+                                      ("agent", pyarrow.string()), ("peer", pyarrow.string()),
+                                      ("latitude", pyarrow.float64()), ("longitude", pyarrow.float64())])
+        self.file = pyarrow.OSFile(filename, "wb")
+        self.stream = pyarrow.RecordBatchStreamWriter(self.file, self.schema)
+
+    def write(self, batch):
+        columns = [self.pyarrow.array(column, type=field.type) for column, field in zip(zip(*batch), self.schema)]
+        self.stream.write_batch(self.pyarrow.RecordBatch.from_arrays(columns, schema=self.schema))
+
+    def close(self):
+        self.stream.close()
+        self.file.close()
+
+
+_WRITERS = {"csv": _CsvWriter, "jsonl": _JsonLinesWriter, "arrow": _ArrowWriter}
+
+
+def _name(jid):
+    return str(jid).split("@")[0] if jid is not None else None
+
+
+def set_event_log(filename, buffer_size=1000):
+    """
+    Opens the event log used by ``log_event`` in this process. A previous log is closed.
+
+    Args:
+        filename (str): the file of the log. The log is disabled if None
+        buffer_size (int): number of events kept in memory before they are written
+    """
+    global _log
+    if _log is not None:
+        _log.close()
+    _log = EventLog(filename, buffer_size) if filename else None
+    if _log is not None:
+        logger.info("Writing events to {}".format(filename))
+
+
+def get_event_log():
+    return _log
+
+
+def log_event(event, agent, peer=None, position=None):
+    """
+    Appends an event to the event log of the process. Nothing is done if there is no event log.
+
+    Args:
+        event (str): the kind of event
+        agent (str): the name or JID of the agent that produced the event
+        peer (str, optional): the name or JID of the other agent involved in the event
+        position (list, optional): the coordinates of the agent (latitude, longitude)
+    """
+    if _log is not None:
+        _log.log(event, agent, peer, position)
@@ -1,23 +1,102 @@
 # -*- coding: utf-8 -*-
 
 import json
+import math
+import time
 from asyncio import CancelledError
 
 import faker
+import numpy as np
 from loguru import logger
 from spade.agent import Agent
-from spade.behaviour import CyclicBehaviour
+from spade.behaviour import CyclicBehaviour, PeriodicBehaviour
 from spade.message import Message
 from spade.template import Template
 
+from .energy import fleet as fleet_energy
+from .metrics import InstrumentedAgentMixin, registry as metrics
 from .protocol import REQUEST_PROTOCOL, REGISTER_PROTOCOL, ACCEPT_PERFORMATIVE, REQUEST_PERFORMATIVE, \
-    REFUSE_PERFORMATIVE
-from .utils import StrategyBehaviour
+    REFUSE_PERFORMATIVE, QUERY_PROTOCOL, INFORM_PERFORMATIVE, CHARGE_PERFORMATIVE, REBALANCE_PERFORMATIVE
+from .rebalancing import DemandGrid, plan_rebalancing, fleet as fleet_positions
+from .replay import ReplayAgentMixin
+from .utils import StrategyBehaviour, FREE_STATION
 
 faker_factory = faker.Factory.create()
 
 
-class FleetManagerAgent(Agent):
+class DemandEstimator(object):
+    """
+    Predicts the rate of customer requests of a fleet with an exponentially decayed count of the requests.
+    """
+
+    def __init__(self, half_life=600.0):
+        """
+        Args:
+            half_life (float): seconds after which a request weights half
+        """
+        self.tau = half_life / math.log(2)
+        self.count = 0.0
+        self.last = None
+
+    def _decayed(self, now):
+        return self.count * math.exp(-(now - self.last) / self.tau) if self.last is not None else 0.0
+
+    def record(self, now=None):
+        """
+        Records a customer request.
+
+        Args:
+            now (float, optional): the timestamp of the request
+        """
+        now = time.time() if now is None else now
+        self.count = self._decayed(now) + 1
+        self.last = now
+
+    def rate(self, now=None):
+        """
+        Returns the predicted rate of requests.
+
+        Args:
+            now (float, optional): the current timestamp
+
+        Returns:
+            float: requests per second
+        """
+        now = time.time() if now is None else now
+        return self._decayed(now) / self.tau
+
+
+def plan_charging(soc, available, demand_rate, trip_time, charging_capacity, threshold=0.6):
+    """
+    Chooses the transports of a fleet to send to charge now. The transports that the predicted demand keeps busy
+    (``demand_rate * trip_time``) stay in service and, among the rest, up to ``charging_capacity`` transports with a
+    state of charge below ``threshold`` are sent to charge, lowest first. This maximizes the energy recovered now
+    without leaving the predicted demand unserved or queueing at the stations, so transports charge while demand is
+    low instead of when they run out.
+
+    Args:
+        soc (numpy.ndarray): the state of charge (0 to 1) of every transport
+        available (numpy.ndarray): whether every transport may be sent to charge (booleans)
+        demand_rate (float): the predicted customer requests per second
+        trip_time (float): the seconds a trip keeps a transport busy
+        charging_capacity (int): the transports the stations can take now without queueing
+        threshold (float): transports at or above this state of charge are never sent
+
+    Returns:
+        numpy.ndarray: the indexes of the transports to send to charge
+    """
+    soc, available = np.asarray(soc, dtype=float), np.asarray(available, dtype=bool)
+    needed = math.ceil(demand_rate * trip_time)
+    budget = min(int(available.sum()) - needed, charging_capacity)
+    candidates = np.flatnonzero(available & (soc < threshold))
+    if budget <= 0 or len(candidates) == 0:
+        return np.array([], dtype=int)
+    if budget < len(candidates):
+        candidates = candidates[np.argpartition(soc[candidates], budget - 1)[:budget]]
+    return candidates[np.argsort(soc[candidates], kind="stable")]
+
+
+class FleetManagerAgent(ReplayAgentMixin, InstrumentedAgentMixin, Agent):
     """
     FleetManager agent that manages the requests between transports and customers
     """
@@ -36,6 +115,10 @@ class FleetManagerAgent(Agent):
         self.stopped = False
         self.is_launched = False
         self.ready = False
+        self.demand = DemandEstimator()
+        self.charging_dispatch = None  # the options of the ChargingDispatchBehaviour (None if disabled)
+        self.demand_grid = None  # the demand of every cell of the city (None if rebalancing is disabled)
+        self.rebalancing = None  # the options of the RebalancingBehaviour
         self.clear_agents()
 
     def clear_agents(self):
@@ -44,6 +127,27 @@ class FleetManagerAgent(Agent):
         """
         self.set("transport_agents", {})
 
+    def register_transport(self, content):
+        """
+        Adds a new transport to the fleet.
+
+        Args:
+            content (dict): the registration of the transport, with its ``name``, ``jid`` and ``fleet_type``
+        """
+        self.transports_in_fleet += 1
+        self.get("transport_agents")[content["name"]] = content
+
+    def record_request(self, content):
+        """
+        Records a customer request in the demand estimates of the fleet.
+
+        Args:
+            content (dict): the request of the customer, with its ``origin``
+        """
+        self.demand.record()
+        if self.demand_grid is not None and content.get("origin"):
+            self.demand_grid.record(content["origin"])
+
     async def setup(self):
         logger.info("FleetManager agent {} running".format(self.name))
         try:
@@ -57,6 +161,43 @@ class FleetManagerAgent(Agent):
             self.ready = True
         except Exception as e:
             logger.error("EXCEPTION creating RegisterBehaviour in Manager {}: {}".format(self.agent_id, e))
+        if self.charging_dispatch is not None:
+            template = Template()
+            template.set_metadata("protocol", QUERY_PROTOCOL)
+            self.add_behaviour(ChargingDispatchBehaviour(**self.charging_dispatch), template)
+        if self.rebalancing is not None:
+            self.add_behaviour(RebalancingBehaviour(**self.rebalancing))
+
+    def set_charging_dispatch(self, interval=60, soc=0.6, trip_time=600, cooldown=None):
+        """
+        Enables the predictive charging dispatcher of the fleet (see ``ChargingDispatchBehaviour``).
+
+        Args:
+            interval (float): seconds between dispatches
+            soc (float): transports below this state of charge may be sent to charge
+            trip_time (float): the seconds a trip keeps a transport busy
+            cooldown (float, optional): seconds before a transport can be sent again (``3 * interval`` if None)
+        """
+        self.charging_dispatch = {"period": interval, "soc": soc, "trip_time": trip_time,
+                                  "cooldown": 3 * interval if cooldown is None else cooldown}
+
+    def set_rebalancing(self, center, interval=120, cell_size=500, cells=40, half_life=900, max_moves=None,
+                        cooldown=None):
+        """
+        Enables the rebalancing of the idle transports of the fleet (see ``RebalancingBehaviour``).
+
+        Args:
+            center (list): the [lat, lon] coordinates of the center of the demand grid
+            interval (float): seconds between rebalancings
+            cell_size (float): the side of a cell of the demand grid in meters
+            cells (int): the number of cells of every side of the demand grid
+            half_life (float): seconds after which a customer request weights half
+            max_moves (int, optional): the maximum number of transports moved every period
+            cooldown (float, optional): seconds before a transport can be moved again (``interval`` if None)
+        """
+        self.demand_grid = DemandGrid(center, cell_size, cells, half_life)
+        self.rebalancing = {"period": interval, "max_moves": max_moves,
+                            "cooldown": interval if cooldown is None else cooldown}
 
     def set_id(self, agent_id):
         """
@@ -120,8 +261,7 @@ class TransportRegistrationForFleetBehaviour(CyclicBehaviour):
         Args:
             agent (``TransportAgent``): the instance of the TransportAgent to be added
         """
-        self.agent.transports_in_fleet += 1
-        self.get("transport_agents")[agent["name"]] = agent
+        self.agent.register_transport(agent)
 
     def remove_transport(self, key):
         """
@@ -183,6 +323,125 @@ class TransportRegistrationForFleetBehaviour(CyclicBehaviour):
             logger.error("EXCEPTION in RegisterBehaviour of Manager {}: {}".format(self.agent.name, e))
 
 
+class ChargingDispatchBehaviour(PeriodicBehaviour):
+    """
+    Periodically sends transports of the fleet to charge before they run out. Every period it reads the state of
+    charge of all the transports of the fleet (from ``simfleet.energy.fleet``), the predicted demand of the fleet and
+    the free places of the stations (from the directory) and solves ``plan_charging`` for the whole fleet. The chosen
+    transports receive a message with the REQUEST_PROTOCOL and the CHARGE_PERFORMATIVE; transports that are not
+    waiting for a customer ignore it.
+    """
+
+    def __init__(self, period, soc=0.6, trip_time=600, cooldown=180):
+        super().__init__(period=period)
+        self.soc = soc
+        self.trip_time = trip_time
+        self.cooldown = cooldown
+        self.stations = {}
+        self.ordered = {}  # when every transport was last sent to charge
+
+    def charging_capacity(self):
+        """
+        Returns the transports the stations can take without queueing, from their availability in the directory.
+
+        Returns:
+            int: the free places minus the queued transports of all the stations
+        """
+        return sum(max((station.get("available_places") or 0) - station.get("queue_length", 0), 0)
+                   for station in self.stations.values())
+
+    async def run(self):
+        while True:  # the latest answer of the directory
+            msg = await self.receive(timeout=0)
+            if msg is None:
+                break
+            if msg.get_metadata("performative") == INFORM_PERFORMATIVE:
+                self.stations = json.loads(msg.body)
+        now = time.time()
+        transports = [transport["jid"] for transport in self.get("transport_agents").values()
+                      if transport["jid"] in fleet_energy.indexes]
+        if transports:
+            soc = fleet_energy.soc()[[fleet_energy.indexes[jid] for jid in transports]]
+            available = np.array([now - self.ordered.get(jid, -math.inf) >= self.cooldown for jid in transports])
+            plan = plan_charging(soc, available, self.agent.demand.rate(now), self.trip_time,
+                                 self.charging_capacity(), self.soc)
+            for index in plan:
+                await self.send_to_charge(transports[index])
+                self.ordered[transports[index]] = now
+            if len(plan):
+                logger.info("Manager {} sent {} transports to charge".format(self.agent.name, len(plan)))
+        await self.ask_stations(limit=max(len(transports), 1))
+
+    async def send_to_charge(self, transport_id):
+        msg = Message()
+        msg.to = str(transport_id)
+        msg.set_metadata("protocol", REQUEST_PROTOCOL)
+        msg.set_metadata("performative", CHARGE_PERFORMATIVE)
+        msg.body = json.dumps({})
+        await self.send(msg)
+        if metrics.enabled:
+            metrics.inc("charging_dispatch_orders_total", fleet=self.agent.name)
+
+    async def ask_stations(self, limit):
+        """
+        Asks the directory for the stations with free places. Every station has at least one place, so no more
+        stations than transports in the fleet are needed.
+
+        Args:
+            limit (int): the maximum number of stations in the answer
+        """
+        msg = Message()
+        msg.to = str(self.agent.directory_id)
+        msg.set_metadata("protocol", QUERY_PROTOCOL)
+        msg.set_metadata("performative", REQUEST_PERFORMATIVE)
+        msg.body = json.dumps({"type": "station", "status": FREE_STATION, "limit": limit})
+        await self.send(msg)
+
+
+class RebalancingBehaviour(PeriodicBehaviour):
+    """
+    Periodically moves the idle transports of the fleet towards the cells of the city with more demand. Every period it
+    reads the positions of the idle transports of the fleet (from ``simfleet.rebalancing.fleet``) and the demand grid
+    of the fleet, and solves ``plan_rebalancing`` for the whole fleet. The chosen transports receive a message with the
+    REQUEST_PROTOCOL and the REBALANCE_PERFORMATIVE with the center of their cell; transports that are not waiting for
+    a customer ignore it.
+    """
+
+    def __init__(self, period, max_moves=None, cooldown=120):
+        super().__init__(period=period)
+        self.max_moves = max_moves
+        self.cooldown = cooldown
+        self.ordered = {}  # when every transport was last moved
+
+    async def run(self):
+        now = time.time()
+        grid = self.agent.demand_grid
+        transports = fleet_positions.idle_transports([transport["jid"] for transport in
+                                                      self.get("transport_agents").values()])
+        if not transports:
+            return
+        indexes = [fleet_positions.indexes[jid] for jid in transports]
+        movable = np.array([now - self.ordered.get(jid, -math.inf) >= self.cooldown for jid in transports])
+        moves = plan_rebalancing(grid.demand(now), grid.cell(fleet_positions.positions[indexes]), movable,
+                                 self.max_moves)
+        targets = grid.center_of([cell for _, cell in moves])
+        for (index, _), target in zip(moves, targets):
+            await self.send_to_rebalance(transports[index], target)
+            self.ordered[transports[index]] = now
+        if moves:
+            logger.info("Manager {} moved {} idle transports".format(self.agent.name, len(moves)))
+
+    async def send_to_rebalance(self, transport_id, position):
+        msg = Message()
+        msg.to = str(transport_id)
+        msg.set_metadata("protocol", REQUEST_PROTOCOL)
+        msg.set_metadata("performative", REBALANCE_PERFORMATIVE)
+        msg.body = json.dumps({"position": position})
+        await self.send(msg)
+        if metrics.enabled:
+            metrics.inc("rebalancing_moves_total", fleet=self.agent.name)
+
+
 class FleetManagerStrategyBehaviour(StrategyBehaviour):
     """
     Class from which to inherit to create a coordinator strategy.
@@ -0,0 +1,358 @@
+"""
+Generator module
+
+Builds synthetic scenarios of any size that can be loaded with ``simfleet --config``.
+Scenarios are written as a stream, so files with millions of customers never need to fit in memory.
+"""
+
+import json
+import math
+import random
+
+from loguru import logger
+
+DEFAULT_BBOX = [39.428981, -0.426062, 39.503374, -0.323799]  # Valencia taxi stands
+METERS_PER_DEGREE = 111320.0
+
+
+class SpatialDistribution(object):
+    """
+    Base class of the spatial distributions used to place agents in the map.
+    You must overload the ``sample`` method.
+    """
+
+    def sample(self, rng):
+        """
+        Returns a random point following the distribution.
+
+        Args:
+            rng (random.Random): the random generator to be used
+
+        Returns:
+            list: a point (latitude and longitude)
+        """
+        raise NotImplementedError
+
+
+class UniformDistribution(SpatialDistribution):
+    """
+    Samples points uniformly inside a bounding box.
+    """
+
+    def __init__(self, bbox=None):
+        """
+        Args:
+            bbox (list, optional): [min_lat, min_lng, max_lat, max_lng] of the area
+        """
+        self.bbox = bbox if bbox is not None else DEFAULT_BBOX
+
+    def sample(self, rng):
+        min_lat, min_lng, max_lat, max_lng = self.bbox
+        return [rng.uniform(min_lat, max_lat), rng.uniform(min_lng, max_lng)]
+
+
+class HotspotDistribution(SpatialDistribution):
+    """
+    Samples points around a set of hotspots (gaussian clusters) placed inside a bounding box.
+    A fraction of the points is spread uniformly in the whole area as background demand.
+    The hotspots are placed with the first draw, so they depend on the seed of the generator.
+    """
+
+    def __init__(self, bbox=None, hotspots=5, radius=500, background=0.1):
+        """
+        Args:
+            bbox (list, optional): [min_lat, min_lng, max_lat, max_lng] of the area
+            hotspots (int): number of hotspots
+            radius (float): standard deviation of every hotspot (in meters)
+            background (float): fraction of points sampled uniformly in the whole area
+        """
+        self.uniform = UniformDistribution(bbox)
+        self.hotspots = max(hotspots, 1)
+        self.centers = None
+        self.weights = None
+        self.radius = radius
+        self.background = background
+
+    def sample(self, rng):
+        if self.centers is None:
+            self.centers = [self.uniform.sample(rng) for _ in range(self.hotspots)]
+            self.weights = [rng.uniform(0.5, 1.0) for _ in self.centers]
+        if rng.random() < self.background:
+            return self.uniform.sample(rng)
+        lat, lng = rng.choices(self.centers, weights=self.weights)[0]
+        sigma_lat = self.radius / METERS_PER_DEGREE
+        sigma_lng = self.radius / (METERS_PER_DEGREE * math.cos(math.radians(lat)))
+        min_lat, min_lng, max_lat, max_lng = self.uniform.bbox
+        return [min(max(rng.gauss(lat, sigma_lat), min_lat), max_lat),
+                min(max(rng.gauss(lng, sigma_lng), min_lng), max_lng)]
+
+
+class GeoJSONDistribution(SpatialDistribution):
+    """
+    Samples points from the features of a GeoJSON file.
+    Point features are chosen uniformly and (Multi)Polygon features are sampled proportionally to their area.
+    """
+
+    def __init__(self, filename):
+        """
+        Args:
+            filename (str): the name of the GeoJSON file
+        """
+        with open(filename) as f:
+            logger.info("Reading GeoJSON {}".format(filename))
+            data = json.load(f)
+        features = data["features"] if data.get("type") == "FeatureCollection" else [data]
+        self.points = []
+        self.polygons = []
+        for feature in features:
+            geometry = feature.get("geometry", feature)
+            if geometry["type"] == "Point":
+                self.points.append(geometry["coordinates"])
+            elif geometry["type"] == "MultiPoint":
+                self.points += geometry["coordinates"]
+            elif geometry["type"] == "Polygon":
+                self.polygons.append(geometry["coordinates"][0])
+            elif geometry["type"] == "MultiPolygon":
+                self.polygons += [polygon[0] for polygon in geometry["coordinates"]]
+        if not self.points and not self.polygons:
+            raise ValueError("GeoJSON file {} has no Point or Polygon features".format(filename))
+        self.areas = [polygon_area(polygon) for polygon in self.polygons]
+
+    def sample(self, rng):
+        if self.polygons and (not self.points or rng.random() < 0.5):
+            ring = rng.choices(self.polygons, weights=self.areas)[0]
+            lngs = [p[0] for p in ring]
+            lats = [p[1] for p in ring]
+            while True:
+                point = [rng.uniform(min(lngs), max(lngs)), rng.uniform(min(lats), max(lats))]
+                if point_in_polygon(point, ring):
+                    return [point[1], point[0]]
+        lng, lat = rng.choice(self.points)[:2]
+        return [lat, lng]
+
+
+def polygon_area(ring):
+    """
+    Returns the area of a polygon ring (in squared degrees) using the shoelace formula.
+
+    Args:
+        ring (list): a list of points (longitude, latitude)
+
+    Returns:
+        float: the area of the polygon
+    """
+    area = 0.0
+    for (x1, y1), (x2, y2) in zip(ring, ring[1:] + ring[:1]):
+        area += x1 * y2 - x2 * y1
+    return abs(area) / 2.0
+
+
+def point_in_polygon(point, ring):
+    """
+    Checks whether a point is inside a polygon ring using ray casting.
+
+    Args:
+        point (list): a point (longitude, latitude)
+        ring (list): a list of points (longitude, latitude)
+
+    Returns:
+        bool: whether the point is inside the polygon or not
+    """
+    x, y = point
+    inside = False
+    j = len(ring) - 1
+    for i in range(len(ring)):
+        xi, yi = ring[i][:2]
+        xj, yj = ring[j][:2]
+        if (yi > y) != (yj > y) and x < (xj - xi) * (y - yi) / (yj - yi) + xi:
+            inside = not inside
+        j = i
+    return inside
+
+
+def parse_arrival_rates(rates):
+    """
+    Parses a piecewise-constant arrival rate definition.
+
+    Examples:
+        >>> parse_arrival_rates("0:0.5,600:2,1800:0.5")
+        [(0.0, 0.5), (600.0, 2.0), (1800.0, 0.5)]
+
+    Args:
+        rates (str): comma separated list of ``start_second:customers_per_second``
+
+    Returns:
+        list: a sorted list of tuples (start time, rate)
+
+    Raises:
+        ValueError: if the definition is malformed
+    """
+    result = []
+    for item in rates.split(","):
+        try:
+            start, rate = item.split(":")
+            result.append((float(start), float(rate)))
+        except ValueError:
+            raise ValueError("arrival rates must be start:customers_per_second pairs (got '{}')".format(item))
+    return sorted(result)
+
+
+def arrival_delays(rates, rng):
+    """
+    Yields the launching delays of a non-homogeneous Poisson arrival process with piecewise-constant rates.
+    The last rate is kept forever, so the generator is infinite unless the last rate is zero.
+
+    Args:
+        rates (list): a sorted list of tuples (start time, rate) as returned by ``parse_arrival_rates``
+        rng (random.Random): the random generator to be used
+
+    Returns:
+        generator: delays in seconds
+    """
+    t = rates[0][0]
+    index = 0
+    while True:
+        rate = rates[index][1]
+        end = rates[index + 1][0] if index + 1 < len(rates) else math.inf
+        if rate <= 0:
+            if end == math.inf:
+                return
+            t, index = end, index + 1
+            continue
+        t += rng.expovariate(rate)
+        if t >= end:
+            t, index = end, index + 1
+            continue
+        yield t
+
+
+class ScenarioGenerator(object):
+    """
+    Generates the agents of a synthetic scenario in the format read by ``SimfleetConfig``.
+    All the random draws come from a single seeded generator, so the same arguments always produce the same file.
+    """
+
+    def __init__(self, fleets=1, transports=10, customers=10, stations=0, fleet_type="taxi", host="127.0.0.1",
+                 demand=None, destinations=None, supply=None, arrival_rates=None, delay_resolution=1,
+                 speed=None, autonomy=None, places=4, power=50, seed=None):
+        """
+        Args:
+            fleets (int): number of fleet managers
+            transports (int): number of transports (split among fleets in round robin)
+            customers (int): number of customers
+            stations (int): number of charging stations
+            fleet_type (str): the fleet type of every fleet, transport and customer
+            host (str): the XMPP host used to build the fleet manager JIDs
+            demand (SpatialDistribution, optional): distribution of customer origins (uniform by default)
+            destinations (SpatialDistribution, optional): distribution of customer destinations (uniform by default)
+            supply (SpatialDistribution, optional): distribution of transports and stations (uniform by default)
+            arrival_rates (list, optional): piecewise-constant customer arrival rates. All customers start at once if None
+            delay_resolution (float): delays are rounded to this resolution (in seconds) so agents launch in batches
+            speed (float, optional): speed of the transports
+            autonomy (int, optional): autonomy of the transports (in km)
+            places (int): places of every station
+            power (int): power of every station
+            seed (int, optional): the random seed
+        """
+        self.rng = random.Random(seed)
+        self.num_fleets = max(fleets, 1)
+        self.num_transports = transports
+        self.num_customers = customers
+        self.num_stations = stations
+        self.fleet_type = fleet_type
+        self.host = host
+        self.demand = demand if demand is not None else UniformDistribution()
+        self.destinations = destinations if destinations is not None else UniformDistribution()
+        self.supply = supply if supply is not None else UniformDistribution()
+        self.arrival_rates = arrival_rates
+        self.delay_resolution = delay_resolution
+        self.speed = speed
+        self.autonomy = autonomy
+        self.places = places
+        self.power = power
+
+    def _point(self, distribution):
+        return [round(coord, 6) for coord in distribution.sample(self.rng)]
+
+    def fleets(self):
+        for i in range(self.num_fleets):
+            yield {"name": "fleet{}".format(i), "fleet_type": self.fleet_type}
+
+    def transports(self):
+        for i in range(self.num_transports):
+            transport = {
+                "name": "transport{}".format(i),
+                "fleet": "fleet{}@{}".format(i % self.num_fleets, self.host),
+                "fleet_type": self.fleet_type,
+                "position": self._point(self.supply)
+            }
+            if self.speed:
+                transport["speed"] = self.speed
+            if self.autonomy:
+                transport["autonomy"] = self.autonomy
+            yield transport
+
+    def customers(self):
+        delays = arrival_delays(self.arrival_rates, self.rng) if self.arrival_rates else None
+        for i in range(self.num_customers):
+            customer = {
+                "name": "customer{}".format(i),
+                "fleet_type": self.fleet_type,
+                "position": self._point(self.demand),
+                "destination": self._point(self.destinations)
+            }
+            if delays is not None:
+                delay = next(delays, None)
+                if delay is None:
+                    logger.warning("Arrival rates exhausted after {} customers.".format(i))
+                    return
+                if self.delay_resolution:
+                    delay = int(delay // self.delay_resolution) * self.delay_resolution
+                customer["delay"] = delay
+            yield customer
+
+    def stations(self):
+        for i in range(self.num_stations):
+            yield {
+                "name": "station{}".format(i),
+                "position": self._point(self.supply),
+                "places": self.places,
+                "power": self.power
+            }
+
+    def write(self, f, settings=None):
+        """
+        Writes the scenario as JSON into a file object, one agent at a time.
+
+        Args:
+            f (file): a writable text file object
+            settings (dict, optional): extra config fields (e.g. ``simulation_name``, ``max_time`` or ``coords``)
+        """
+        sections = [("fleets", self.fleets()), ("transports", self.transports()),
+                    ("customers", self.customers()), ("stations", self.stations())]
+        write_scenario(f, settings or {}, sections)
+
+
+def write_scenario(f, settings, sections):
+    """
+    Writes a scenario as JSON without building it in memory.
+
+    Args:
+        f (file): a writable text file object
+        settings (dict): config fields to be written as they are
+        sections (list): a list of tuples (name, iterable of dicts) to be written as JSON arrays
+    """
+    f.write("{\n")
+    for key, value in settings.items():
+        f.write("    {}: {},\n".format(json.dumps(key), json.dumps(value)))
+    for index, (name, items) in enumerate(sections):
+        f.write("    {}: [".format(json.dumps(name)))
+        separator = "\n"
+        for item in items:
+            f.write(separator)
+            f.write("        ")
+            f.write(json.dumps(item))
+            separator = ",\n"
+        f.write("\n    ]" if separator != "\n" else "]")
+        f.write(",\n" if index < len(sections) - 1 else "\n")
+    f.write("}\n")
@@ -10,14 +10,26 @@ import random
 
 from geopy.distance import vincenty
 
+from .metrics import registry as metrics
+from .replay import replay_draw
 
-def random_position():
+
+def random_position(agent=None):
     """
     Returns a random position inside the map.
+    When a simulation is recorded or replayed (see ``simfleet.replay``) the positions drawn by an agent are recorded
+    or taken from the recorded ones.
+
+    Args:
+        agent (str, optional): the name of the agent that draws the position
 
     Returns:
         list: a point (longitude and latitude)
     """
+    return replay_draw(agent, _draw_position)
+
+
+def _draw_position():
     path = os.path.dirname(__file__) + os.sep + "templates" + os.sep + "data" + os.sep + "taxi_stations.json"
     with open(path) as f:
         stations = json.load(f)["features"]
@@ -43,6 +55,7 @@ def are_close(coord1, coord2, tolerance=10):
     return vincenty(coord1, coord2).meters < tolerance
 
 
+@metrics.timed("distance_seconds")
 def distance_in_meters(coord1, coord2):
     """
     Returns the distance between two coordinates in meters.
@@ -0,0 +1,392 @@
+"""
+Metrics module
+
+Process-wide counters, gauges and histograms used to measure what the simulation is doing (messages, routes,
+behaviours, event loop lag, ...). All the agents of a simulation run in the same process, so a single registry is
+shared by all of them.
+
+The detailed instrumentation (timings, per-protocol message counters, ...) is opt-in: it is only recorded when the
+registry is enabled (``simfleet --metrics`` or ``"metrics": true`` in the config file).
+"""
+
+import asyncio
+import functools
+import math
+import time
+from bisect import bisect_left
+from collections import defaultdict
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, math.inf)
+
+
+class Histogram(object):
+    """
+    A histogram with fixed buckets. It keeps the number of observations of every bucket, their count and their sum.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        """
+        Args:
+            buckets (tuple): sorted upper bounds of the buckets. The last one should be ``math.inf``
+        """
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        self.counts[min(index, len(self.counts) - 1)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """
+        Estimates a quantile as the upper bound of the bucket where it falls.
+
+        Args:
+            q (float): the quantile (between 0 and 1)
+
+        Returns:
+            float: the estimated quantile or None if there are no observations
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        accumulated = 0
+        for bound, count in zip(self.buckets, self.counts):
+            accumulated += count
+            if accumulated >= rank:
+                return bound
+        return self.buckets[-1]
+
+    def to_json(self):
+        cumulative = 0
+        buckets = {}
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            buckets["+Inf" if bound == math.inf else str(bound)] = cumulative
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else None,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "buckets": buckets
+        }
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+class MetricsRegistry(object):
+    """
+    A store of named counters, gauges and histograms. Metrics can have labels (e.g. the protocol of a message).
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.counters = defaultdict(float)
+        self.gauges = {}
+        self.histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        """
+        Increments a counter.
+
+        Args:
+            name (str): name of the counter
+            value (float): amount to be added
+            **labels: labels of the counter
+        """
+        self.counters[_key(name, labels)] += value
+
+    def get(self, name, **labels):
+        """
+        Returns the value of a counter.
+
+        Args:
+            name (str): name of the counter
+            **labels: labels of the counter
+
+        Returns:
+            float: the current value of the counter (0 if it was never incremented)
+        """
+        return self.counters.get(_key(name, labels), 0)
+
+    def total(self, name):
+        """
+        Returns the sum of a counter for all its labels.
+
+        Args:
+            name (str): name of the counter
+
+        Returns:
+            float: the sum of the counter values
+        """
+        return sum(value for (key, _), value in self.counters.items() if key == name)
+
+    def set(self, name, value, **labels):
+        """
+        Sets the value of a gauge.
+
+        Args:
+            name (str): name of the gauge
+            value (float): the new value
+            **labels: labels of the gauge
+        """
+        self.gauges[_key(name, labels)] = value
+
+    def add(self, name, value, **labels):
+        """
+        Adds an amount (that may be negative) to a gauge.
+
+        Args:
+            name (str): name of the gauge
+            value (float): amount to be added
+            **labels: labels of the gauge
+        """
+        key = _key(name, labels)
+        self.gauges[key] = self.gauges.get(key, 0) + value
+
+    def move(self, name, old, new, label="status"):
+        """
+        Moves one unit of a gauge from a label value to another one (e.g. when an agent changes its status).
+
+        Args:
+            name (str): name of the gauge
+            old: the previous value of the label (nothing is subtracted if None)
+            new: the new value of the label (nothing is added if None)
+            label (str): name of the label
+        """
+        if old == new:
+            return
+        if old is not None:
+            self.add(name, -1, **{label: old})
+        if new is not None:
+            self.add(name, 1, **{label: new})
+
+    def clear_gauges(self):
+        """
+        Removes all the gauges.
+        """
+        self.gauges.clear()
+
+    def observe(self, name, value, buckets=DEFAULT_BUCKETS, **labels):
+        """
+        Adds an observation to a histogram.
+
+        Args:
+            name (str): name of the histogram
+            value (float): the observed value
+            buckets (tuple): the buckets used if the histogram does not exist yet
+            **labels: labels of the histogram
+        """
+        key = _key(name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram(buckets)
+        histogram.observe(value)
+
+    def histogram(self, name, **labels):
+        return self.histograms.get(_key(name, labels))
+
+    def reset(self):
+        """
+        Removes all the metrics.
+        """
+        self.counters.clear()
+        self.gauges.clear()
+        self.histograms.clear()
+
+    def snapshot(self):
+        """
+        Returns all the metrics as a JSON serializable dict grouped by type and name.
+
+        Returns:
+            dict: the counters, gauges and histograms with their labels
+        """
+        result = {"counters": defaultdict(list), "gauges": defaultdict(list), "histograms": defaultdict(list)}
+        for kind, store in (("counters", self.counters), ("gauges", self.gauges)):
+            for (name, labels), value in sorted(store.items(), key=lambda item: str(item[0])):
+                result[kind][name].append({"labels": dict(labels), "value": value})
+        for (name, labels), histogram in sorted(self.histograms.items(), key=lambda item: str(item[0])):
+            result["histograms"][name].append(dict(histogram.to_json(), labels=dict(labels)))
+        return {kind: dict(metrics) for kind, metrics in result.items()}
+
+    def to_text(self, prefix="simfleet_"):
+        """
+        Renders all the metrics in the Prometheus text exposition format.
+
+        Args:
+            prefix (str): prefix added to the name of every metric
+
+        Returns:
+            str: the metrics in text format
+        """
+        lines = []
+        for kind, store in (("counter", self.counters), ("gauge", self.gauges)):
+            for name, series in _group(store).items():
+                lines.append("# TYPE {}{} {}".format(prefix, name, kind))
+                for labels, value in series:
+                    lines.append("{}{}{} {}".format(prefix, name, _format_labels(labels), _format_value(value)))
+        for name, series in _group(self.histograms).items():
+            lines.append("# TYPE {}{} histogram".format(prefix, name))
+            for labels, histogram in series:
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    bucket_labels = labels + (("le", "+Inf" if bound == math.inf else repr(float(bound))),)
+                    lines.append("{}{}_bucket{} {}".format(prefix, name, _format_labels(bucket_labels), cumulative))
+                lines.append("{}{}_sum{} {}".format(prefix, name, _format_labels(labels), _format_value(histogram.sum)))
+                lines.append("{}{}_count{} {}".format(prefix, name, _format_labels(labels), histogram.count))
+        return "\n".join(lines) + "\n"
+
+    def timed(self, name, **labels):
+        """
+        Decorator that records the duration of every call of a function in a histogram when the registry is enabled.
+
+        Args:
+            name (str): name of the histogram
+            **labels: labels of the histogram
+        """
+
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.observe(name, time.perf_counter() - start, **labels)
+
+            return wrapper
+
+        return decorator
+
+
+def _group(store):
+    groups = defaultdict(list)
+    for (name, labels), value in sorted(store.items(), key=lambda item: str(item[0])):
+        groups[name].append((labels, value))
+    return groups
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(key, _escape(value)) for key, value in labels) + "}"
+
+
+def _format_value(value):
+    return repr(float(value))
+
+
+registry = MetricsRegistry()
+
+
+class BusyTimer(object):
+    """
+    Awaitable that runs a coroutine and measures the time it spends running in the event loop, excluding the time it
+    is suspended (waiting for messages, sleeping, ...).
+    """
+
+    def __init__(self, coro):
+        self.coro = coro
+        self.busy = 0.0
+
+    def __await__(self):
+        value, error = None, None
+        while True:
+            start = time.perf_counter()
+            try:
+                if error is not None:
+                    future = self.coro.throw(error)
+                else:
+                    future = self.coro.send(value)
+            except StopIteration as e:
+                return e.value
+            finally:
+                self.busy += time.perf_counter() - start
+            try:
+                value, error = (yield future), None
+            except BaseException as e:
+                value, error = None, e
+
+
+def instrument_behaviour(behaviour):
+    """
+    Wraps the ``run`` method of a behaviour (and of the states of a FSM) to record its busy time in the
+    ``behaviour_run_seconds`` histogram labelled with the class of the behaviour.
+    Nothing is done if the registry is not enabled.
+
+    Args:
+        behaviour (spade.behaviour.CyclicBehaviour): the behaviour to be instrumented
+    """
+    if not registry.enabled or "run" in behaviour.__dict__:
+        return
+    run = behaviour.run
+    name = type(behaviour).__name__
+
+    async def timed_run():
+        timer = BusyTimer(run())
+        try:
+            return await timer
+        finally:
+            registry.observe("behaviour_run_seconds", timer.busy, behaviour=name)
+
+    behaviour.run = timed_run
+    for state in getattr(behaviour, "_states", {}).values():
+        instrument_behaviour(state)
+
+
+async def sample_loop_lag(stop_event, interval=0.1, samples=None):
+    """
+    Measures how late the event loop wakes up a coroutine that sleeps for a fixed interval.
+    The lags are recorded in the ``event_loop_lag_seconds`` histogram.
+
+    Args:
+        stop_event (threading.Event): sampling stops when this event is set
+        interval (float): sampling interval in seconds
+        samples (list, optional): a list where the lags (in seconds) are also appended
+    """
+    while not stop_event.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lag = max(time.perf_counter() - start - interval, 0.0)
+        registry.observe("event_loop_lag_seconds", lag)
+        if samples is not None:
+            samples.append(lag)
+
+
+class InstrumentedAgentMixin(object):
+    """
+    Mixin for the agents of the simulation that counts the messages they receive (by protocol and performative) and
+    times their behaviours when the registry is enabled.
+    """
+
+    def dispatch(self, msg):
+        if registry.enabled:
+            registry.inc("messages_received_total", protocol=msg.get_metadata("protocol"),
+                         performative=msg.get_metadata("performative"))
+        return super().dispatch(msg)
+
+    def add_behaviour(self, behaviour, template=None):
+        instrument_behaviour(behaviour)
+        super().add_behaviour(behaviour, template)
+
+    def mailbox_depth(self):
+        """
+        Returns the number of messages waiting to be received by the behaviours of the agent.
+
+        Returns:
+            int: the number of messages in the mailboxes of the agent
+        """
+        return sum(behaviour.mailbox_size() for behaviour in self.behaviours)
@@ -0,0 +1,222 @@
+"""
+Pooling module
+
+The itinerary of a transport that carries several customers at once (ride-pooling). The itinerary is the sequence of
+stops (pickups and dropoffs) the transport still has to visit. A new customer is added with the cheapest insertion of
+its pickup and its dropoff in the sequence that never exceeds the capacity of the transport.
+
+The distances between the stops of an itinerary are kept in a matrix that is updated when a stop is added or visited,
+so evaluating a new customer only computes the distances from its pickup, its dropoff and the current position of the
+transport to the stops, and the cost of every insertion is computed at once with numpy. Distances are straight-line
+estimates (the routes are only requested to the route server when the transport moves).
+
+The capacity of a transport is set with the ``capacity`` field of the transport in the config file (1 by default, i.e.
+no pooling). A transport also accepts ``queued_jobs`` queued jobs: trips chained after the stops of the customers it is
+serving (i.e. picked up once the transport is empty), so the transport goes from a dropoff to the next pickup without
+waiting for a new request. Customers that share the transport with the ones it serves are only limited by its capacity.
+"""
+
+from collections import namedtuple
+
+import numpy as np
+
+EARTH_RADIUS = 6371008.8
+
+PICKUP = "pickup"
+DROPOFF = "dropoff"
+
+Stop = namedtuple("Stop", ["customer", "kind", "position"])
+
+
+def distance_matrix(origins, destinations):
+    """
+    Returns the great-circle distances between two sets of positions.
+
+    Args:
+        origins (list): a list of [lat, lon] coordinates
+        destinations (list): a list of [lat, lon] coordinates
+
+    Returns:
+        numpy.ndarray: the len(origins) x len(destinations) matrix of distances in meters
+    """
+    origins = np.radians(np.asarray(origins, dtype=float).reshape(-1, 2))[:, None, :]
+    destinations = np.radians(np.asarray(destinations, dtype=float).reshape(-1, 2))[None, :, :]
+    delta = destinations - origins
+    a = np.sin(delta[..., 0] / 2) ** 2 + \
+        np.cos(origins[..., 0]) * np.cos(destinations[..., 0]) * np.sin(delta[..., 1] / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+class Itinerary(object):
+    """
+    The stops a transport still has to visit and the customers it carries.
+    """
+
+    def __init__(self, capacity=1, queued_jobs=0):
+        """
+        Args:
+            capacity (int): the maximum number of customers in the transport at once
+            queued_jobs (int): the trips the transport accepts after the ones it serves
+        """
+        self.capacity = capacity
+        self.queued_jobs = queued_jobs
+        self.stops = []
+        self.onboard = set()
+        self.matrix = np.zeros((0, 0))  # distances between the stops
+
+    def __len__(self):
+        return len(self.stops)
+
+    def __bool__(self):
+        return bool(self.stops)
+
+    @property
+    def next_stop(self):
+        return self.stops[0] if self.stops else None
+
+    def customers(self):
+        """
+        Returns the customers of the itinerary: the ones in the transport and the ones waiting to be picked up.
+
+        Returns:
+            set: the jids of the customers
+        """
+        return {stop.customer for stop in self.stops}
+
+    def loads(self):
+        """
+        Returns the number of customers in the transport after every stop.
+
+        Returns:
+            numpy.ndarray: the current load followed by the load after every stop
+        """
+        changes = [1 if stop.kind == PICKUP else -1 for stop in self.stops]
+        return len(self.onboard) + np.concatenate([[0], np.cumsum(changes, dtype=int)])
+
+    def queued(self):
+        """
+        Returns the number of queued jobs of the itinerary: the stops after which the transport is empty and still has
+        to pick up other customers.
+
+        Returns:
+            int: the number of queued jobs
+        """
+        return int(np.count_nonzero(self.loads()[1:-1] == 0))
+
+    def insertion(self, position, origin, dest):
+        """
+        Finds the cheapest insertion of a new customer in the itinerary. The pickup is inserted after the ``i``-th
+        point and the dropoff after the ``j``-th point of the itinerary (``i <= j``), where the point 0 is the current
+        position of the transport and the point ``k`` is the ``k``-th stop.
+
+        Args:
+            position (list): the current position of the transport
+            origin (list): the position of the customer
+            dest (list): the destination of the customer
+
+        Returns:
+            tuple: the meters added to the itinerary and the points ``i`` and ``j``, or None if the customer does not
+            fit in the transport or would exceed its queued jobs
+        """
+        size = len(self.stops) + 1
+        loads = self.loads()
+        points = [position] + [stop.position for stop in self.stops]
+        new = distance_matrix([origin, dest], points)  # from the pickup and the dropoff to every point
+        pickup_dropoff = distance_matrix([origin], [dest])[0, 0]
+        # the leg from every point to the next one, and from the new stops to the next point (none after the last)
+        legs = np.zeros(size)
+        to_next = np.zeros((2, size))
+        if self.stops:
+            legs[0] = distance_matrix([position], [self.stops[0].position])[0, 0]
+            legs[1:-1] = np.diagonal(self.matrix, offset=1)
+            to_next[:, :-1] = new[:, 1:]
+        detour = new + to_next - legs  # meters added by a stop inserted after every point
+        together = new[0] + pickup_dropoff + to_next[1] - legs  # the dropoff right after the pickup
+
+        costs = detour[0][:, None] + detour[1][None, :]
+        costs[np.diag_indices(size)] = together
+        costs[np.tril_indices(size, -1)] = np.inf
+        # the new customer is in the transport from the point i to the point j
+        peak = np.full((size, size), self.capacity)
+        for i in range(size):
+            peak[i, i:] = np.maximum.accumulate(loads[i:])
+        costs[peak >= self.capacity] = np.inf
+        if size > 1:
+            # the queued jobs after the insertion: the empty points (but the first and the last) that the new customer
+            # does not ride over, the last point if the customer goes after it and the dropoff if more stops follow
+            empty, last = loads == 0, size - 1
+            interior = np.concatenate([[0], np.cumsum(empty[1:-1])])  # empty points from 1 to every point
+            rows, columns = np.indices((size, size))
+            queued = interior[-1] - interior[np.minimum(columns, last - 1)] + interior[np.minimum(rows, last - 1)]
+            queued += (rows == last) & empty[last]
+            queued += (columns < last) & empty[columns]
+            costs[queued > self.queued_jobs] = np.inf
+
+        best = int(np.argmin(costs))
+        i, j = divmod(best, size)
+        if not np.isfinite(costs[i, j]):
+            return None
+        return float(costs[i, j]), i, j
+
+    def insert(self, customer, origin, dest, i, j):
+        """
+        Inserts the pickup of a customer after the ``i``-th point and its dropoff after the ``j``-th point (see
+        :func:`insertion`).
+
+        Args:
+            customer (str): the jid of the customer
+            origin (list): the position of the customer
+            dest (list): the destination of the customer
+            i (int): the point after which the customer is picked up
+            j (int): the point after which the customer is dropped off
+        """
+        self._insert_stop(i, Stop(customer, PICKUP, origin))
+        self._insert_stop(j + 1, Stop(customer, DROPOFF, dest))
+
+    def append(self, customer, origin, dest):
+        """
+        Adds a customer at the end of the itinerary.
+
+        Args:
+            customer (str): the jid of the customer
+            origin (list): the position of the customer
+            dest (list): the destination of the customer
+        """
+        self.insert(customer, origin, dest, len(self.stops), len(self.stops))
+
+    def _insert_stop(self, index, stop):
+        row = distance_matrix([stop.position], [s.position for s in self.stops])[0] if self.stops else np.zeros(0)
+        self.stops.insert(index, stop)
+        self.matrix = np.insert(np.insert(self.matrix, index, row, axis=0), index, np.insert(row, index, 0), axis=1)
+
+    def pop(self):
+        """
+        Visits the next stop: the customer boards or leaves the transport.
+
+        Returns:
+            Stop: the visited stop
+        """
+        stop = self.stops.pop(0)
+        self.matrix = self.matrix[1:, 1:]
+        if stop.kind == PICKUP:
+            self.onboard.add(stop.customer)
+        else:
+            self.onboard.discard(stop.customer)
+        return stop
+
+    def remove(self, customer):
+        """
+        Removes the stops of a customer (e.g. when its trip is cancelled).
+
+        Args:
+            customer (str): the jid of the customer
+        """
+        keep = [index for index, stop in enumerate(self.stops) if stop.customer != customer]
+        self.stops = [self.stops[index] for index in keep]
+        self.matrix = self.matrix[np.ix_(keep, keep)]
+        self.onboard.discard(customer)
+
+    def clear(self):
+        self.stops = []
+        self.onboard = set()
+        self.matrix = np.zeros((0, 0))
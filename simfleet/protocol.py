@@ -14,4 +14,10 @@ REFUSE_PERFORMATIVE = "refuse"
 PROPOSE_PERFORMATIVE = "propose"
 CANCEL_PERFORMATIVE = "cancel"
 INFORM_PERFORMATIVE = "inform"
+RESERVE_PERFORMATIVE = "reserve"
+CHARGE_PERFORMATIVE = "charge"
+REBALANCE_PERFORMATIVE = "rebalance"
 
+SUBSCRIBE_PERFORMATIVE = "subscribe"
+UNSUBSCRIBE_PERFORMATIVE = "unsubscribe"
+UPDATE_PERFORMATIVE = "update"
@@ -0,0 +1,274 @@
+"""
+Queues module
+
+The waiting queues of the charging stations. Transports that find no free place in a station wait in its queue until a
+place is released. Pushing, popping and removing a transport are O(1) (O(log n) for the priority policies), so a
+charging hub can hold hundreds of queued transports.
+
+The policy of the queue of a station is set with the ``queue`` field of the station in the config file:
+
+    * ``"fifo"`` (default): transports charge in order of arrival.
+    * ``"shortest_charge_first"``: transports that need the smallest charge go first.
+    * ``{"policy": "reserved", "fleet": <fleet name>, "slots": <n>}``: ``n`` places of the station are reserved for the
+      transports of a fleet. Transports of other fleets only take a place while the fleet has other ``n`` places
+      available, and the queued transports of the fleet always go first.
+
+Every entry of a queue records when the transport was queued, so the time it waited is known when it leaves.
+"""
+
+import heapq
+import itertools
+import time
+from collections import deque
+
+
+class QueueEntry(object):
+    """
+    A transport waiting in a station queue.
+    """
+    __slots__ = ["transport", "seq", "time", "need", "fleet"]
+
+    def __init__(self, transport, seq, enqueued_at, need=None, fleet=None):
+        self.transport = transport
+        self.seq = seq
+        self.time = enqueued_at
+        self.need = need
+        self.fleet = fleet
+
+
+class StationQueue(object):
+    """
+    Base class of the station queues. Subclasses store the entries in the structure of their policy and implement
+    :func:`_push`, :func:`_pop` and :func:`_ordered`. Removed transports are discarded lazily when they reach the head
+    of the queue.
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self.counter = itertools.count()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return (entry.transport for entry in self._ordered())
+
+    def __contains__(self, transport_id):
+        return str(transport_id) in self.entries
+
+    def _live(self, entry):
+        return self.entries.get(entry.transport) is entry
+
+    def push(self, transport_id, need=None, fleet=None):
+        """
+        Adds a transport to the queue. A transport already in the queue is queued again at the end.
+
+        Args:
+            transport_id (str): the jid of the transport
+            need (float, optional): the kilometers of autonomy the transport needs to charge
+            fleet (str, optional): the fleet of the transport
+        """
+        entry = QueueEntry(str(transport_id), next(self.counter), time.time(), need, fleet)
+        self.entries[entry.transport] = entry
+        self._push(entry)
+
+    def pop(self, available_places=1, charging=None, fits=None):
+        """
+        Takes the next transport of the queue that may use one of the available places of the station.
+
+        Args:
+            available_places (int): the places of the station that are available for the queued transports
+            charging (dict, optional): the fleet of every transport that is charging in the station
+            fits (function, optional): whether the charge of an entry fits in the station now. Entries that do not fit
+                keep their turn and the next one in the order of the policy is taken
+
+        Returns:
+            QueueEntry: the entry of the transport, or None if no transport may charge
+        """
+        if fits is None:
+            entry = self._pop(available_places, charging or {})
+        else:
+            entry = next((entry for entry in self._ordered() if fits(entry)), None) if available_places > 0 else None
+        if entry is not None:
+            del self.entries[entry.transport]
+        return entry
+
+    def remove(self, transport_id):
+        """
+        Removes a transport from the queue (e.g. when it cancels its charge).
+
+        Args:
+            transport_id (str): the jid of the transport
+
+        Returns:
+            QueueEntry: the entry of the transport, or None if it was not in the queue
+        """
+        return self.entries.pop(str(transport_id), None)
+
+    def can_charge(self, fleet, available_places, charging=None):
+        """
+        Returns whether a transport that arrives to the station may take one of its available places instead of
+        waiting in the queue.
+
+        Args:
+            fleet (str): the fleet of the transport
+            available_places (int): the available places of the station
+            charging (dict, optional): the fleet of every transport that is charging in the station
+
+        Returns:
+            bool: whether the transport may charge
+        """
+        return available_places > 0 and not self.entries
+
+    def _push(self, entry):
+        raise NotImplementedError
+
+    def _pop(self, available_places, charging):
+        raise NotImplementedError
+
+    def _ordered(self):
+        raise NotImplementedError
+
+
+class FifoQueue(StationQueue):
+    """
+    Transports charge in order of arrival.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.items = deque()
+
+    def _push(self, entry):
+        self.items.append(entry)
+
+    def _pop(self, available_places, charging):
+        if available_places <= 0:
+            return None
+        while self.items:
+            entry = self.items.popleft()
+            if self._live(entry):
+                return entry
+        return None
+
+    def _ordered(self):
+        return [entry for entry in self.items if self._live(entry)]
+
+
+class ShortestChargeFirstQueue(StationQueue):
+    """
+    Transports that need the smallest charge go first. Transports with the same need charge in order of arrival.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.heap = []
+
+    def _push(self, entry):
+        heapq.heappush(self.heap, (entry.need or 0.0, entry.seq, entry))
+
+    def _pop(self, available_places, charging):
+        if available_places <= 0:
+            return None
+        while self.heap:
+            entry = heapq.heappop(self.heap)[2]
+            if self._live(entry):
+                return entry
+        return None
+
+    def _ordered(self):
+        return [item[2] for item in sorted(self.heap) if self._live(item[2])]
+
+
+class ReservedSlotsQueue(StationQueue):
+    """
+    Reserves some places of the station for the transports of a fleet. The transports of the fleet and the other ones
+    wait in two FIFO queues.
+    """
+
+    def __init__(self, fleet, slots=1):
+        """
+        Args:
+            fleet (str): the name (or jid) of the fleet
+            slots (int): the number of places reserved for the fleet
+        """
+        super().__init__()
+        self.fleet = fleet.split("@")[0]
+        self.slots = slots
+        self.reserved = FifoQueue()
+        self.others = FifoQueue()
+
+    def is_reserved(self, fleet):
+        return fleet is not None and str(fleet).split("@")[0] == self.fleet
+
+    def free_reserved_places(self, charging):
+        """
+        Returns the reserved places that are not used by the fleet.
+
+        Args:
+            charging (dict): the fleet of every transport that is charging in the station
+
+        Returns:
+            int: the number of reserved places not used by the fleet
+        """
+        used = sum(1 for fleet in charging.values() if self.is_reserved(fleet))
+        return max(self.slots - used, 0)
+
+    def _queue(self, fleet):
+        return self.reserved if self.is_reserved(fleet) else self.others
+
+    def push(self, transport_id, need=None, fleet=None):
+        self.remove(transport_id)
+        self._queue(fleet).push(transport_id, need, fleet)
+        self.entries[str(transport_id)] = self._queue(fleet).entries[str(transport_id)]
+
+    def pop(self, available_places=1, charging=None, fits=None):
+        charging = charging or {}
+        result = None
+        if available_places > 0 and self.reserved:
+            result = self.reserved.pop(available_places, charging, fits)
+        if result is None and available_places > self.free_reserved_places(charging):
+            result = self.others.pop(available_places, charging, fits)
+        if result is not None:
+            del self.entries[result.transport]
+        return result
+
+    def remove(self, transport_id):
+        entry = self.entries.pop(str(transport_id), None)
+        if entry is not None:
+            self._queue(entry.fleet).remove(transport_id)
+        return entry
+
+    def can_charge(self, fleet, available_places, charging=None):
+        queue = self._queue(fleet)
+        if self.is_reserved(fleet):
+            return available_places > 0 and not queue
+        return available_places > self.free_reserved_places(charging or {}) and not queue
+
+    def _ordered(self):
+        return self.reserved._ordered() + self.others._ordered()
+
+
+QUEUE_POLICIES = {"fifo": FifoQueue, "shortest_charge_first": ShortestChargeFirstQueue, "reserved": ReservedSlotsQueue}
+
+
+def create_queue(config=None):
+    """
+    Creates the queue of a station from its config.
+
+    Args:
+        config (str or dict, optional): the name of the policy or a dict with the ``policy`` and its options
+            (e.g. ``{"policy": "reserved", "fleet": "fleetmanager", "slots": 2}``). Defaults to FIFO.
+
+    Returns:
+        StationQueue: the queue
+    """
+    if not config:
+        return FifoQueue()
+    if isinstance(config, str):
+        config = {"policy": config}
+    options = dict(config)
+    policy = options.pop("policy", "fifo")
+    if policy not in QUEUE_POLICIES:
+        raise ValueError("Unknown station queue policy {} (choose from {})".format(policy, ", ".join(QUEUE_POLICIES)))
+    return QUEUE_POLICIES[policy](**options)
@@ -0,0 +1,223 @@
+"""
+Rebalancing module
+
+Moves the idle transports of a fleet towards the areas where customers are requesting trips, instead of leaving them
+where they dropped their last customer. The fleet manager keeps the recent demand in a ``DemandGrid``: a grid of
+square cells around the center of the simulation with an exponentially decayed count of the customer requests made in
+every cell. Every period it compares the share of the demand of every cell with the share of the idle transports in it
+and moves the transports in excess to the closest under-served cells (see :func:`plan_rebalancing`). All the orders of
+a period are sent at once, so the transports request their routes concurrently.
+
+The positions and the idle status of all the transports are kept in the arrays of a single ``FleetPositions``
+(``fleet``), so the fleet managers read the whole fleet at once.
+
+Rebalancing is enabled with the ``rebalancing`` field of the config file, e.g. ``{"interval": 120, "cell_size": 500,
+"cells": 40, "half_life": 900}``.
+"""
+
+import math
+import time
+
+import numpy as np
+
+METERS_PER_DEGREE = 111320.0
+
+
+class DemandGrid(object):
+    """
+    The recent customer requests in a grid of ``cells`` x ``cells`` square cells of ``cell_size`` meters centered in
+    ``center``. Positions out of the grid are counted in the closest border cell.
+    """
+
+    def __init__(self, center, cell_size=500.0, cells=40, half_life=900.0):
+        """
+        Args:
+            center (list): the [lat, lon] coordinates of the center of the grid
+            cell_size (float): the side of a cell in meters
+            cells (int): the number of cells of every side of the grid
+            half_life (float): seconds after which a request weights half
+        """
+        self.cells = cells
+        self.lat_step = cell_size / METERS_PER_DEGREE
+        self.lon_step = cell_size / (METERS_PER_DEGREE * math.cos(math.radians(center[0])))
+        self.origin = np.array([center[0] - cells * self.lat_step / 2, center[1] - cells * self.lon_step / 2])
+        self.step = np.array([self.lat_step, self.lon_step])
+        self.tau = half_life / math.log(2)
+        self.counts = np.zeros((cells, cells))
+        self.last = None
+
+    def cell(self, positions):
+        """
+        Returns the cells of some positions.
+
+        Args:
+            positions (list): a list of [lat, lon] coordinates
+
+        Returns:
+            numpy.ndarray: the (row, column) of every position
+        """
+        cells = np.floor((np.asarray(positions, dtype=float).reshape(-1, 2) - self.origin) / self.step)
+        return np.clip(cells, 0, self.cells - 1).astype(int)
+
+    def center_of(self, cells):
+        """
+        Returns the coordinates of the center of some cells.
+
+        Args:
+            cells (numpy.ndarray): the (row, column) of every cell
+
+        Returns:
+            list: the [lat, lon] coordinates of every center
+        """
+        return (self.origin + (np.asarray(cells).reshape(-1, 2) + 0.5) * self.step).tolist()
+
+    def _decay(self, now):
+        if self.last is not None and now > self.last:
+            self.counts *= math.exp(-(now - self.last) / self.tau)
+        self.last = now if self.last is None else max(self.last, now)
+
+    def record(self, position, now=None):
+        """
+        Records a customer request.
+
+        Args:
+            position (list): the [lat, lon] coordinates of the origin of the request
+            now (float, optional): the timestamp of the request
+        """
+        self._decay(time.time() if now is None else now)
+        row, column = self.cell(position)[0]
+        self.counts[row, column] += 1
+
+    def demand(self, now=None):
+        """
+        Returns the decayed count of requests of every cell.
+
+        Args:
+            now (float, optional): the current timestamp
+
+        Returns:
+            numpy.ndarray: the cells x cells grid of counts
+        """
+        self._decay(time.time() if now is None else now)
+        return self.counts
+
+
+def plan_rebalancing(demand, cells, movable, max_moves=None):
+    """
+    Chooses the idle transports to move and the cells they go to. Every cell should have a share of the idle
+    transports equal to its share of the demand: the transports in excess in a cell (and only the ``movable`` ones) are
+    assigned to the missing places of the under-served cells, closest pairs first.
+
+    Args:
+        demand (numpy.ndarray): the demand of every cell of the grid
+        cells (numpy.ndarray): the (row, column) of the cell of every idle transport
+        movable (numpy.ndarray): whether every idle transport may be moved (booleans)
+        max_moves (int, optional): the maximum number of transports to move
+
+    Returns:
+        list: a (transport index, (row, column)) tuple for every move
+    """
+    demand = np.asarray(demand, dtype=float)
+    cells = np.asarray(cells, dtype=int).reshape(-1, 2)
+    movable = np.asarray(movable, dtype=bool)
+    total = demand.sum()
+    if total <= 0 or len(cells) == 0:
+        return []
+    target = demand / total * len(cells)
+    supply = np.zeros(demand.shape)
+    np.add.at(supply, (cells[:, 0], cells[:, 1]), 1)
+
+    # the movable transports in excess of every cell
+    excess = np.floor(supply - target).clip(min=0)
+    sources = []
+    for index in np.flatnonzero(movable):
+        row, column = cells[index]
+        if excess[row, column] > 0:
+            excess[row, column] -= 1
+            sources.append(index)
+    # a slot for every missing transport of the under-served cells
+    missing = np.rint(target - supply).clip(min=0).astype(int)
+    slots = np.repeat(np.argwhere(missing > 0), missing[missing > 0], axis=0)
+    if not sources or len(slots) == 0:
+        return []
+
+    distances = np.hypot(*(cells[sources][:, None, :] - slots[None, :, :]).transpose(2, 0, 1))
+    moves, used_sources, used_slots = [], set(), set()
+    limit = min(len(sources), len(slots), len(sources) if max_moves is None else max_moves)
+    for flat in np.argsort(distances, axis=None, kind="stable"):
+        source, slot = divmod(int(flat), len(slots))
+        if source in used_sources or slot in used_slots:
+            continue
+        used_sources.add(source)
+        used_slots.add(slot)
+        moves.append((int(sources[source]), tuple(int(x) for x in slots[slot])))
+        if len(moves) == limit:
+            break
+    return moves
+
+
+class FleetPositions(object):
+    """
+    The position and the idle status of every transport, stored in numpy arrays indexed by the position of the
+    transport.
+    """
+
+    def __init__(self, size=64):
+        self.names = []
+        self.indexes = {}
+        self.positions = np.full((size, 2), np.nan)
+        self.idle = np.zeros(size, dtype=bool)
+
+    def __len__(self):
+        return len(self.names)
+
+    def register(self, name):
+        """
+        Adds a transport (or resets it if it was already added).
+
+        Args:
+            name (str): the jid of the transport
+
+        Returns:
+            int: the index of the transport in the arrays
+        """
+        index = self.indexes.get(name)
+        if index is None:
+            index = len(self.names)
+            if index == len(self.idle):
+                self.positions = np.concatenate([self.positions, np.full(self.positions.shape, np.nan)])
+                self.idle = np.concatenate([self.idle, np.zeros(len(self.idle), dtype=bool)])
+            self.names.append(name)
+            self.indexes[name] = index
+        self.positions[index] = np.nan
+        self.idle[index] = False
+        return index
+
+    def move(self, index, position):
+        self.positions[index] = np.nan if position is None else position
+
+    def set_idle(self, index, idle):
+        self.idle[index] = idle
+
+    def idle_transports(self, names):
+        """
+        Returns the transports that are idle and have a position.
+
+        Args:
+            names (list): the jids of the transports to look at
+
+        Returns:
+            list: the jids of the idle transports
+        """
+        indexes = [self.indexes[name] for name in names if name in self.indexes]
+        found = np.array(indexes, dtype=int)
+        if not len(found):
+            return []
+        mask = self.idle[found] & ~np.isnan(self.positions[found]).any(axis=1)
+        return [self.names[index] for index in found[mask]]
+
+    def reset(self):
+        self.__init__()
+
+
+fleet = FleetPositions()
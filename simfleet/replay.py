@@ -0,0 +1,283 @@
+"""
+Replay module
+
+Deterministic record and replay of simulations. In record mode (``simfleet --record``) the random generator is seeded
+and every message received by an agent, every random position drawn by an agent and every route answered by the route
+server is written to a log (a JSON object per line).
+
+In replay mode (``simfleet replay``) the agents of the recorded scenario are started without connecting to the XMPP
+server and the recorded messages are delivered to them in the same order, as fast as they can process them. Messages
+sent by the agents are dropped (their recipients get the recorded ones instead), random positions are taken from the
+draws of the same agent and routes are answered from the log, so every agent takes the same decisions without a XMPP
+server or a route server. This allows to profile and debug the strategies of a long simulation in a fraction of its
+time.
+"""
+
+import asyncio
+import json
+import random
+import time
+from collections import defaultdict, deque
+
+from loguru import logger
+from spade.message import Message
+
+HEADER = "header"
+MESSAGE = "message"
+RANDOM = "random"
+ROUTE = "route"
+RUN = "run"
+
+_recorder = None
+_replay = None
+
+
+class Recorder(object):
+    """
+    Writes the inbound messages, random draws and routes of a simulation to a log.
+    """
+
+    def __init__(self, filename, seed=None, config=None):
+        """
+        Args:
+            filename (str): the file of the log
+            seed (int, optional): seed of the random generator. A random one is used if None
+            config (dict, optional): the config of the simulation, stored in the log to replay it
+        """
+        self.filename = filename
+        self.seed = seed if seed is not None else random.randrange(2 ** 32)
+        self.start_time = time.time()
+        self.count = 0
+        random.seed(self.seed)
+        self.file = open(filename, "w")
+        self.write(HEADER, seed=self.seed, config=config or {})
+
+    def write(self, kind, **data):
+        data["kind"] = kind
+        data["time"] = time.time() - self.start_time
+        self.file.write(json.dumps(data) + "\n")
+        self.count += 1
+
+    def message(self, msg):
+        self.write(MESSAGE, to=str(msg.to), sender=str(msg.sender), thread=msg.thread, metadata=dict(msg.metadata),
+                   body=msg.body)
+
+    def close(self):
+        self.file.close()
+        logger.info("{} records written to {} (seed {})".format(self.count, self.filename, self.seed))
+
+
+class Replay(object):
+    """
+    A recorded simulation loaded from its log.
+    """
+
+    def __init__(self, filename):
+        """
+        Args:
+            filename (str): the file of the log written by ``Recorder``
+        """
+        self.filename = filename
+        self.seed = None
+        self.config = {}
+        self.events = []  # messages and run marks, in order
+        self.draws = defaultdict(deque)
+        self.routes = {}
+        self.delivering = False
+        self.delivered = 0
+        with open(filename) as f:
+            for line in f:
+                record = json.loads(line)
+                kind = record["kind"]
+                if kind == HEADER:
+                    self.seed = record["seed"]
+                    self.config = record["config"]
+                elif kind in [MESSAGE, RUN]:
+                    self.events.append(record)
+                elif kind == RANDOM:
+                    self.draws[record["agent"]].append(record["value"])
+                elif kind == ROUTE:
+                    key = _route_key(record["origin"], record["destination"])
+                    self.routes[key] = record["path"], record["distance"], record["duration"]
+
+    def draw(self, agent):
+        """
+        Returns the next random position drawn by an agent in the recorded simulation.
+
+        Args:
+            agent (str): the name of the agent
+
+        Returns:
+            list: the position or None if the agent has no more recorded draws
+        """
+        draws = self.draws.get(agent)
+        return draws.popleft() if draws else None
+
+    def route(self, origin, destination):
+        """
+        Returns the route recorded for an origin and a destination.
+
+        Returns:
+            list, float, float: the path, the distance of the path and the estimated duration (Nones if not recorded)
+        """
+        route = self.routes.get(_route_key(origin, destination))
+        if route is None:
+            logger.warning("Route from {} to {} not found in {}".format(origin, destination, self.filename))
+            return None, None, None
+        return route
+
+    async def drive(self, simulator, timeout=5):
+        """
+        Delivers the recorded messages to the agents of a simulator (started in replay mode) and starts the
+        simulation at the same point it was started in the recorded simulation.
+
+        Args:
+            simulator (SimulatorAgent): the simulator with the agents of the recorded scenario
+            timeout (float): seconds to wait for the recipient of a message to have a behaviour that accepts it
+        """
+        container = simulator.container
+        for event in self.events:
+            if event["kind"] == RUN:
+                simulator.run()
+                while not simulator.simulation_running:
+                    await asyncio.sleep(0.01)
+                continue
+            msg = Message(to=event["to"], sender=event["sender"], body=event["body"], thread=event["thread"],
+                          metadata=event["metadata"])
+            if not container.has_agent(event["to"]):
+                logger.warning("Agent {} of recorded message not found".format(event["to"]))
+                continue
+            agent = container.get_agent(event["to"])
+            deadline = time.time() + timeout
+            while not any(behaviour.match(msg) for behaviour in agent.behaviours) and time.time() < deadline:
+                await asyncio.sleep(0.001)
+            self.delivering = True
+            try:
+                agent.dispatch(msg)
+            finally:
+                self.delivering = False
+            self.delivered += 1
+            await asyncio.sleep(0)
+        agents = [simulator.directory_agent] + list(simulator.manager_agents.values()) + \
+            list(simulator.transport_agents.values()) + list(simulator.customer_agents.values()) + \
+            list(simulator.station_agents.values())
+        while any(agent.mailbox_depth() for agent in agents if agent is not None):
+            await asyncio.sleep(0.01)
+
+
+def _route_key(origin, destination):
+    return json.dumps([list(origin), list(destination)])
+
+
+def set_recorder(filename, seed=None, config=None):
+    """
+    Starts recording the simulation of this process. A previous recording is closed.
+
+    Args:
+        filename (str): the file of the log. Recording stops if None
+        seed (int, optional): seed of the random generator
+        config (dict, optional): the config of the simulation
+    """
+    global _recorder
+    if _recorder is not None:
+        _recorder.close()
+    _recorder = Recorder(filename, seed, config) if filename else None
+    if _recorder is not None:
+        logger.info("Recording simulation to {} (seed {})".format(filename, _recorder.seed))
+
+
+def get_recorder():
+    return _recorder
+
+
+def set_replay(replay):
+    """
+    Sets the recorded simulation replayed in this process. The random generator is seeded with the recorded seed.
+
+    Args:
+        replay (Replay): the recorded simulation (None to stop replaying)
+    """
+    global _replay
+    _replay = replay
+    if replay is not None:
+        random.seed(replay.seed)
+
+
+def get_replay():
+    return _replay
+
+
+def record_run():
+    if _recorder is not None:
+        _recorder.write(RUN)
+
+
+def record_route(origin, destination, path, distance, duration):
+    if _recorder is not None:
+        _recorder.write(ROUTE, origin=origin, destination=destination, path=path, distance=distance,
+                        duration=duration)
+
+
+def replay_draw(agent, draw):
+    """
+    Returns a random position for an agent: the recorded one when replaying and a new one otherwise (that is recorded
+    in record mode).
+
+    Args:
+        agent (str): the name of the agent that draws the position (None if unknown)
+        draw (function): function that draws a new position
+
+    Returns:
+        list: the position
+    """
+    if _replay is not None and agent is not None:
+        value = _replay.draw(agent)
+        if value is not None:
+            return value
+    value = draw()
+    if _recorder is not None and agent is not None:
+        _recorder.write(RANDOM, agent=agent, value=value)
+    return value
+
+
+class ReplayAgentMixin(object):
+    """
+    Mixin for the agents of the simulation that records the messages they receive in record mode and runs them
+    without a XMPP connection in replay mode.
+    """
+
+    def dispatch(self, msg):
+        if _replay is not None and not _replay.delivering:
+            return []  # messages sent during a replay are replaced by the recorded ones
+        if _recorder is not None:
+            _recorder.message(msg)
+        return super().dispatch(msg)
+
+    async def send(self, msg):
+        if not msg.sender:
+            msg.sender = str(self.jid)
+            logger.debug(f"Adding agent's jid as sender to message: {msg}")
+        if _replay is not None:
+            return
+        aioxmpp_msg = msg.prepare()
+        await self.client.send(aioxmpp_msg)
+        msg.sent = True
+        self.traces.append(msg, category=str(self))
+
+    async def _async_start(self, auto_register=True):
+        if _replay is None:
+            return await super()._async_start(auto_register)
+        await self.setup()
+        self._alive.set()
+        for behaviour in self.behaviours:
+            if not behaviour.is_running:
+                behaviour.start()
+
+    async def _async_stop(self):
+        if _replay is None:
+            return await super()._async_stop()
+        for behaviour in self.behaviours:
+            behaviour.kill()
+        if self.web.is_started():
+            await self.web.runner.cleanup()
+        self._alive.clear()
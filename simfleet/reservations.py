@@ -0,0 +1,166 @@
+"""
+Reservations module
+
+The charging calendar of a station. Transports book a charging window in a station in advance, so they do not find the
+station full when they arrive. The calendar keeps, for every place of the station, the windows booked in it (and the
+charges in progress) sorted by their start, so finding the earliest free window or checking a window is a binary search
+plus a walk over the following windows of every place.
+
+Stations publish their booked windows in the directory (without the transports that booked them), so a transport can
+compute the earliest slot of all the stations returned by a single directory query (see
+:func:`SlotCalendar.from_windows`).
+"""
+
+import bisect
+from collections import namedtuple
+
+Booking = namedtuple("Booking", ["transport", "place", "start", "end"])
+
+
+class SlotCalendar(object):
+    """
+    The windows booked in every place of a station. Times are timestamps in seconds.
+    """
+
+    def __init__(self, places):
+        """
+        Args:
+            places (int): the number of places of the station
+        """
+        self.places = [[] for _ in range(max(places or 0, 0))]  # sorted (start, end, transport) tuples per place
+        self.bookings = {}
+
+    @classmethod
+    def from_windows(cls, places, windows):
+        """
+        Builds a calendar from the windows published by a station.
+
+        Args:
+            places (int): the number of places of the station
+            windows (list): a [place, start, end] list for every booked window
+
+        Returns:
+            SlotCalendar: the calendar
+        """
+        calendar = cls(places)
+        for index, (place, start, end) in enumerate(windows or []):
+            if place < len(calendar.places):
+                bisect.insort(calendar.places[place], (start, end, "#{}".format(index)))
+        return calendar
+
+    def __len__(self):
+        return sum(len(place) for place in self.places)
+
+    def _gap(self, place, start, duration):
+        """
+        Returns the earliest time from ``start`` when the place is free for ``duration`` seconds.
+        """
+        windows = self.places[place]
+        index = bisect.bisect_left(windows, (start,))
+        if index > 0 and windows[index - 1][1] > start:
+            start = windows[index - 1][1]
+        for window_start, window_end, _ in windows[index:]:
+            if window_start >= start + duration:
+                break
+            start = max(start, window_end)
+        return start
+
+    def earliest(self, start, duration, place=None):
+        """
+        Returns the earliest window of ``duration`` seconds that starts at ``start`` or later.
+
+        Args:
+            start (float): the earliest start of the window
+            duration (float): the length of the window in seconds
+            place (int, optional): look only in this place
+
+        Returns:
+            tuple: the start of the window and its place, or (None, None) if the station has no places
+        """
+        places = range(len(self.places)) if place is None else [place]
+        return min(((self._gap(p, start, duration), p) for p in places), default=(None, None))
+
+    def free_places(self, start, end):
+        """
+        Returns the number of places that are free during the whole window.
+
+        Args:
+            start (float): the start of the window
+            end (float): the end of the window
+
+        Returns:
+            int: the number of free places
+        """
+        return sum(1 for place in range(len(self.places)) if self._gap(place, start, end - start) == start)
+
+    def book(self, transport_id, start, duration, place=None, exact=False):
+        """
+        Books the earliest window of ``duration`` seconds that starts at ``start`` or later. A previous booking of the
+        transport is replaced.
+
+        Args:
+            transport_id (str): the jid of the transport
+            start (float): the earliest start of the window
+            duration (float): the length of the window in seconds
+            place (int, optional): book only in this place
+            exact (bool): book only if the window can start at ``start``
+
+        Returns:
+            Booking: the booking, or None if the window could not be booked
+        """
+        previous = self.cancel(transport_id)
+        window_start, place = self.earliest(start, duration, place)
+        if window_start is None or (exact and window_start > start):
+            if previous is not None:
+                self._insert(previous)
+            return None
+        booking = Booking(str(transport_id), place, window_start, window_start + duration)
+        self._insert(booking)
+        return booking
+
+    def _insert(self, booking):
+        bisect.insort(self.places[booking.place], (booking.start, booking.end, booking.transport))
+        self.bookings[booking.transport] = booking
+
+    def cancel(self, transport_id):
+        """
+        Cancels the booking of a transport.
+
+        Args:
+            transport_id (str): the jid of the transport
+
+        Returns:
+            Booking: the cancelled booking, or None if the transport had none
+        """
+        booking = self.bookings.pop(str(transport_id), None)
+        if booking is not None:
+            windows = self.places[booking.place]
+            index = bisect.bisect_left(windows, (booking.start, booking.end, booking.transport))
+            del windows[index]
+        return booking
+
+    def booking(self, transport_id):
+        return self.bookings.get(str(transport_id))
+
+    def prune(self, now):
+        """
+        Forgets the windows that ended before ``now``.
+
+        Args:
+            now (float): the current timestamp
+        """
+        for windows in self.places:
+            ended = 0
+            while ended < len(windows) and windows[ended][1] <= now:
+                self.bookings.pop(windows[ended][2], None)
+                ended += 1
+            del windows[:ended]
+
+    def windows(self):
+        """
+        Returns the booked windows, as published in the directory.
+
+        Returns:
+            list: a [place, start, end] list for every window, sorted by place and start
+        """
+        return [[place, start, end] for place, windows in enumerate(self.places) for start, end, _ in windows]
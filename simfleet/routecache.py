@@ -0,0 +1,137 @@
+"""
+Route cache module
+
+A persistent cache of the routes answered by the route server. It is stored in a SQLite file, so it can be shared by
+several simulations running in parallel (see ``simfleet sweep``) and reused by later runs of the same scenario.
+Lookups run in the default executor and new routes are written in batches by a background thread, so the agents never
+wait for the disk. If the file stays locked by another process for longer than ``timeout`` the batch is dropped: the
+routes are simply requested again later.
+"""
+
+import asyncio
+import json
+import queue
+import sqlite3
+import threading
+
+from loguru import logger
+
+_cache = None
+
+
+class RouteCache(object):
+    """
+    Stores routes by origin and destination (rounded to a fixed precision).
+    """
+
+    def __init__(self, filename, precision=6, timeout=1.0, batch_size=100):
+        """
+        Args:
+            filename (str): the SQLite file of the cache. It is created if it does not exist
+            precision (int): number of decimals of the coordinates used as key
+            timeout (float): seconds to wait for the lock of the file when another process is writing. The pending
+                routes are not stored if it expires
+            batch_size (int): maximum number of routes written in a single transaction
+        """
+        self.filename = filename
+        self.precision = precision
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self.hits = 0
+        self.misses = 0
+        self.connection = sqlite3.connect(filename, timeout=30, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS routes (key TEXT PRIMARY KEY, path TEXT NOT NULL, "
+                                "distance REAL NOT NULL, duration REAL NOT NULL)")
+        self.connection.commit()
+        self.lock = threading.Lock()
+        self.writes = queue.Queue()
+        self.thread = threading.Thread(target=self._write_batches, name="routecache", daemon=True)
+        self.thread.start()
+
+    def _key(self, origin, destination):
+        return ";".join("{0:.{1}f}".format(coord, self.precision) for coord in list(origin) + list(destination))
+
+    async def get(self, origin, destination):
+        """
+        Returns a cached route.
+
+        Args:
+            origin (list): origin coordinate (latitude, longitude)
+            destination (list): target coordinate (latitude, longitude)
+
+        Returns:
+            list, float, float: the path, the distance of the path and the estimated duration, or None if not cached
+        """
+        loop = asyncio.get_running_loop()
+        row = await loop.run_in_executor(None, self._select, self._key(origin, destination))
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(row[0]), row[1], row[2]
+
+    def put(self, origin, destination, path, distance, duration):
+        """
+        Queues a route to be stored in the cache by the writer thread.
+
+        Args:
+            origin (list): origin coordinate (latitude, longitude)
+            destination (list): target coordinate (latitude, longitude)
+            path (list): the path
+            distance (float): the distance of the path in meters
+            duration (float): the estimated duration of the path in seconds
+        """
+        self.writes.put((self._key(origin, destination), json.dumps(path), distance, duration))
+
+    def close(self):
+        """
+        Writes the pending routes and closes the file.
+        """
+        self.writes.put(None)
+        self.thread.join()
+        self.connection.close()
+
+    def _select(self, key):
+        with self.lock:
+            return self.connection.execute("SELECT path, distance, duration FROM routes WHERE key = ?",
+                                           (key,)).fetchone()
+
+    def _write_batches(self):
+        connection = sqlite3.connect(self.filename, timeout=self.timeout)
+        connection.execute("PRAGMA synchronous=NORMAL")
+        closed = False
+        while not closed:
+            batch = [self.writes.get()]
+            while len(batch) < self.batch_size and not self.writes.empty():
+                batch.append(self.writes.get())
+            if None in batch:
+                closed = True
+                batch = [row for row in batch if row is not None]
+            if not batch:
+                continue
+            try:
+                with connection:
+                    connection.executemany("INSERT OR IGNORE INTO routes VALUES (?, ?, ?, ?)", batch)
+            except sqlite3.Error as e:
+                logger.warning("Could not store {} routes in cache {}: {}".format(len(batch), self.filename, e))
+        connection.close()
+
+
+def set_route_cache(filename):
+    """
+    Opens the route cache used by ``request_route_to_server`` in this process.
+
+    Args:
+        filename (str): the SQLite file of the cache. The cache is disabled if None
+    """
+    global _cache
+    if _cache is not None:
+        _cache.close()
+    _cache = RouteCache(filename) if filename else None
+    if _cache is not None:
+        logger.info("Using route cache {}".format(filename))
+
+
+def get_route_cache():
+    return _cache
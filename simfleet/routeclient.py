@@ -0,0 +1,216 @@
+"""
+Route client module
+
+The policy used to request routes to the route server, shared by all the agents of a process. It limits the requests
+in flight, retries failed requests with exponential backoff and jitter (so thousands of transports do not retry in
+lockstep), and stops calling the server while it is unhealthy: after ``threshold`` consecutive failures the circuit
+breaker opens and requests fail immediately (or get a straight-line route if ``fallback`` is enabled) until
+``reset_timeout`` seconds later, when a single request probes the server again.
+
+The outcome of every attempt is counted in ``RoutePolicy.counts`` (and in the ``route_requests_total`` metric):
+``success``, ``error``, ``retry``, ``rejected`` (by the open circuit) and ``fallback``.
+
+The policy is set with the ``route_policy`` field of the config file, e.g. ``{"max_concurrency": 32, "retries": 3,
+"base_delay": 0.5, "max_delay": 8, "timeout": 10, "threshold": 10, "reset_timeout": 30, "fallback": true}``.
+"""
+
+import asyncio
+import random
+import time
+from collections import Counter
+
+from loguru import logger
+
+from .helpers import distance_in_meters, kmh_to_ms
+from .metrics import registry as metrics
+
+_policy = None
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class CircuitBreaker(object):
+    """
+    Opens after ``threshold`` consecutive failures and lets a single request probe the server ``reset_timeout``
+    seconds later. The circuit closes again when the probe succeeds.
+    """
+
+    def __init__(self, threshold=10, reset_timeout=30.0):
+        """
+        Args:
+            threshold (int): consecutive failures that open the circuit
+            reset_timeout (float): seconds the circuit stays open before probing the server
+        """
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+
+    def allow(self, now=None):
+        """
+        Returns whether a request may be sent to the server now.
+
+        Args:
+            now (float, optional): the current monotonic time
+
+        Returns:
+            bool: False while the circuit is open (or a probe is in flight)
+        """
+        if self.state == CLOSED:
+            return True
+        now = time.monotonic() if now is None else now
+        if self.state == OPEN and now - self.opened_at >= self.reset_timeout:
+            self.state = HALF_OPEN
+            return True
+        return False
+
+    def success(self):
+        if self.state != CLOSED:
+            logger.info("Route server is healthy again")
+        self.state = CLOSED
+        self.failures = 0
+
+    def release(self):
+        """
+        Gives up a probe without a result (e.g. a cancelled request), so the next request probes the server.
+        """
+        if self.state == HALF_OPEN:
+            self.state = OPEN
+
+    def failure(self, now=None):
+        self.failures += 1
+        if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.threshold):
+            if self.state == CLOSED:
+                logger.warning("Route server failed {} times in a row: not requesting routes for {} seconds"
+                               .format(self.failures, self.reset_timeout))
+            self.state = OPEN
+            self.opened_at = time.monotonic() if now is None else now
+
+
+def straight_line_route(origin, destination, speed_in_kmh=30):
+    """
+    Returns a straight-line route, used when the route server is unavailable.
+
+    Args:
+        origin (list): origin coordinate (latitude, longitude)
+        destination (list): target coordinate (latitude, longitude)
+        speed_in_kmh (float): the speed used to estimate the duration
+
+    Returns:
+        list, float, float: the path, the distance of the path and the estimated duration
+    """
+    distance = distance_in_meters(origin, destination)
+    return [list(origin), list(destination)], distance, distance / kmh_to_ms(speed_in_kmh)
+
+
+class RoutePolicy(object):
+    """
+    Bounded concurrency, retries with backoff and a circuit breaker for the requests to the route server.
+    """
+
+    def __init__(self, max_concurrency=64, retries=4, base_delay=0.5, max_delay=8.0, timeout=10.0, threshold=10,
+                 reset_timeout=30.0, fallback=False):
+        """
+        Args:
+            max_concurrency (int): the maximum number of requests in flight
+            retries (int): the retries of a failed request
+            base_delay (float): the seconds before the first retry (doubled on every retry)
+            max_delay (float): the maximum seconds between retries
+            timeout (float): the seconds before a request is considered failed
+            threshold (int): consecutive failures that open the circuit breaker
+            reset_timeout (float): seconds the circuit stays open before probing the server
+            fallback (bool): return straight-line routes instead of failing while the server is unavailable
+        """
+        self.max_concurrency = max_concurrency
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.timeout = timeout
+        self.fallback = fallback
+        self.breaker = CircuitBreaker(threshold, reset_timeout)
+        self.counts = Counter()
+        self._semaphore = None
+
+    @property
+    def semaphore(self):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    def backoff(self, attempt):
+        """
+        Returns the seconds to wait before a retry: a random delay up to an exponentially growing cap ("full jitter").
+
+        Args:
+            attempt (int): the number of the failed attempt (0 for the first one)
+
+        Returns:
+            float: the seconds to wait
+        """
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def count(self, outcome):
+        self.counts[outcome] += 1
+        if metrics.enabled:
+            metrics.inc("route_requests_total", outcome=outcome)
+
+    async def request(self, fetch, origin, destination):
+        """
+        Requests a route following the policy.
+
+        Args:
+            fetch (coroutine function): requests a route to the server. It receives the origin, the destination and
+                the timeout and returns the path, the distance and the duration (None if the request failed)
+            origin (list): origin coordinate (latitude, longitude)
+            destination (list): target coordinate (latitude, longitude)
+
+        Returns:
+            list, float, float: the path, the distance of the path and the estimated duration, or None if the route
+            could not be requested
+        """
+        for attempt in range(self.retries + 1):
+            if not self.breaker.allow():
+                self.count("rejected")
+                break
+            try:
+                async with self.semaphore:
+                    route = await fetch(origin, destination, self.timeout)
+            except asyncio.CancelledError:  # a cancelled job or a stopped agent says nothing about the server
+                self.breaker.release()
+                raise
+            except BaseException:  # a probe must not leave the circuit half-open
+                self.breaker.failure()
+                raise
+            if route[0] is not None:
+                self.breaker.success()
+                self.count("success")
+                return route
+            self.breaker.failure()
+            self.count("error")
+            if attempt < self.retries:
+                self.count("retry")
+                await asyncio.sleep(self.backoff(attempt))
+        if self.fallback:
+            self.count("fallback")
+            return straight_line_route(origin, destination)
+        return None, None, None
+
+
+def set_route_policy(config=None):
+    """
+    Sets the policy used by ``request_route_to_server`` in this process.
+
+    Args:
+        config (dict, optional): the options of the policy (see ``RoutePolicy``). Defaults are used if None
+    """
+    global _policy
+    _policy = RoutePolicy(**(config or {}))
+
+
+def get_route_policy():
+    if _policy is None:
+        set_route_policy()
+    return _policy
@@ -0,0 +1,192 @@
+"""
+Shards module
+
+Support for simulations split across several processes (possibly in several hosts). The coordinator simulator runs
+the directory and the fleet managers and splits the transports, customers and stations of the scenario among a set of
+shard workers. Every worker is a ``SimulatorAgent`` that runs its part of the agents and exposes them through its web
+interface, so the coordinator can start and stop the simulation and aggregate the stats and the map of all the shards.
+Agents talk to each other through the XMPP server, so the directory and fleet manager protocols work across shards.
+"""
+
+import asyncio
+import json
+import random
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+from bisect import bisect_right
+
+import aiohttp
+from loguru import logger
+
+PARTITIONS = ["geography", "fleet"]
+
+
+def partition_scenario(config, shards, by="geography"):
+    """
+    Splits the transports, customers and stations of a scenario among shards.
+
+    With the ``geography`` partition the map is split in vertical strips with the same number of agents, so most of the
+    agents that interact live in the same shard. With the ``fleet`` partition every fleet is assigned to a shard
+    (transports follow their fleet manager) and customers and stations are split in round robin.
+
+    Args:
+        config (SimfleetConfig): the config of the scenario
+        shards (int): number of shards
+        by (str): the partition criteria (geography or fleet)
+
+    Returns:
+        list: a list of dicts (one per shard) with the transports, customers and stations of the shard
+    """
+    sections = ["transports", "customers", "stations"]
+    result = [{section: [] for section in sections} for _ in range(shards)]
+    if by == "fleet":
+        fleets = sorted({transport["fleet"] for transport in config["transports"]})
+        fleet_shard = {fleet: index % shards for index, fleet in enumerate(fleets)}
+        for transport in config["transports"]:
+            result[fleet_shard[transport["fleet"]]]["transports"].append(transport)
+        for section in ["customers", "stations"]:
+            for index, agent in enumerate(config[section]):
+                result[index % shards][section].append(agent)
+    else:
+        longitudes = sorted(agent["position"][1] for section in sections for agent in config[section])
+        bounds = [longitudes[len(longitudes) * i // shards] for i in range(1, shards)] if longitudes else []
+        for section in sections:
+            for agent in config[section]:
+                result[bisect_right(bounds, agent["position"][1])][section].append(agent)
+    return result
+
+
+class ShardManager(object):
+    """
+    Keeps track of the shard workers of a coordinator and queries their web interfaces.
+    """
+
+    def __init__(self, partitions, timeout=30):
+        """
+        Args:
+            partitions (list): the agents of every shard as returned by ``partition_scenario``
+            timeout (float): timeout (in seconds) of the requests to the workers
+        """
+        self.partitions = partitions
+        self.urls = {}
+        self.summaries = {}
+        self.timeout = timeout
+
+    def __len__(self):
+        return len(self.partitions)
+
+    def register(self, shard, url):
+        logger.info("Shard {} registered at {}".format(shard, url))
+        self.urls[shard] = url
+
+    def all_registered(self):
+        return len(self.urls) == len(self.partitions)
+
+    async def request(self, path):
+        """
+        Sends a GET request to all the registered workers.
+
+        Args:
+            path (str): the path of the request (e.g. ``shard/stats``)
+
+        Returns:
+            list: the JSON responses of the workers (None for the workers that failed)
+        """
+
+        async def get(session, shard, url):
+            try:
+                async with session.get(url + path) as response:
+                    return await response.json()
+            except Exception as e:
+                logger.error("Error requesting {} to shard {}: {}".format(path, shard, e))
+                return None
+
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            return await asyncio.gather(*[get(session, shard, url) for shard, url in sorted(self.urls.items())])
+
+    async def update_summaries(self):
+        for shard, summary in zip(sorted(self.urls.keys()), await self.request("shard/summary")):
+            if summary is not None:
+                self.summaries[shard] = summary
+
+    async def wait_ready(self, interval=0.5):
+        """
+        Waits until all the workers are registered and all their agents are ready.
+        """
+        while True:
+            if self.all_registered():
+                await self.update_summaries()
+                if self.all_ready():
+                    return
+            logger.debug("Waiting for all shards to be ready")
+            await asyncio.sleep(interval)
+
+    def all_ready(self):
+        return len(self.summaries) == len(self.partitions) and all(s["ready"] for s in self.summaries.values())
+
+    def all_customers_in_destination(self):
+        """
+        Checks the last summaries of the workers.
+
+        Returns:
+            bool: whether all the customers of all the shards are in their destinations (False if there are none)
+        """
+        if len(self.summaries) < len(self.partitions):
+            return False
+        customers = sum(summary["customers"] for summary in self.summaries.values())
+        return customers > 0 and all(summary["customers"] == summary["in_destination"]
+                                     for summary in self.summaries.values())
+
+
+def launch_workers(shards, coordinator_url, verbose=0):
+    """
+    Starts the shard workers as local processes.
+
+    Args:
+        shards (int): number of workers
+        coordinator_url (str): the URL of the web interface of the coordinator
+        verbose (int): verbosity level of the workers
+
+    Returns:
+        list: the ``subprocess.Popen`` of the workers
+    """
+    processes = []
+    for shard in range(shards):
+        command = [sys.executable, "-m", "simfleet.cli"] + ["-v"] * verbose + \
+                  ["worker", "--coordinator", coordinator_url, "--shard", str(shard)]
+        processes.append(subprocess.Popen(command))
+    logger.info("Launched {} shard workers.".format(shards))
+    return processes
+
+
+def fetch_shard_config(coordinator_url, shard, retries=8, base_delay=0.5, max_delay=8.0):
+    """
+    Downloads the config of a shard from the coordinator. The coordinator may still be starting its web interface when
+    the workers are launched, so failed requests are retried with exponential backoff and jitter.
+
+    Args:
+        coordinator_url (str): the URL of the web interface of the coordinator (ending with /)
+        shard (int): the index of the shard
+        retries (int): the retries of a failed request
+        base_delay (float): the seconds before the first retry (doubled on every retry)
+        max_delay (float): the maximum seconds between retries
+
+    Returns:
+        dict: the config of the shard
+    """
+    url = "{}shards/{}".format(coordinator_url, shard)
+    for attempt in range(retries + 1):
+        try:
+            with urllib.request.urlopen(url) as response:
+                return json.loads(response.read().decode("utf-8"))
+        except (urllib.error.URLError, ConnectionError) as e:
+            if attempt == retries:
+                raise
+            delay = random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+            logger.warning("Coordinator {} not ready ({}). Retrying in {:.1f} seconds.".format(coordinator_url, e,
+                                                                                               delay))
+            time.sleep(delay)
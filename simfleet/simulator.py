@@ -3,29 +3,88 @@ import io
 import json
 import threading
 import time
-from datetime import datetime
+from datetime import datetime, timedelta
 from pathlib import Path
 from typing import List
 
+import aiohttp
 import faker
 import pandas as pd
 from aiohttp import web as aioweb
 from loguru import logger
 from spade.agent import Agent
-from spade.behaviour import TimeoutBehaviour, OneShotBehaviour
+from spade.behaviour import TimeoutBehaviour, OneShotBehaviour, PeriodicBehaviour
 from tabulate import tabulate
 
+from .checkpoint import CheckpointBehaviour, read_checkpoint, restore_snapshot, take_snapshot, write_checkpoint
 from .customer import CustomerAgent
 from .directory import DirectoryAgent
+from .energy import fleet as fleet_energy
+from .eventlog import get_event_log, set_event_log
 from .fleetmanager import FleetManagerAgent
+from .metrics import registry as metrics, sample_loop_lag
+from .replay import ReplayAgentMixin, get_recorder, get_replay, record_run, set_recorder
+from .routecache import get_route_cache, set_route_cache
+from .routeclient import set_route_policy
+from .shards import ShardManager, partition_scenario
 from .station import StationAgent
+from .trajectory import TrajectoryWriter, playback_routes
 from .transport import TransportAgent
-from .utils import load_class, status_to_str, avg, request_path as async_request_path
+from .utils import load_class, status_to_str, request_path as async_request_path, FREE_STATION
 
 faker_factory = faker.Factory.create()
 
+# Columns (and their types) of the stats of every kind of agent. Numbers are kept as numbers, so the stats can be
+# exported to typed columnar formats (Parquet, Arrow) and aggregated without parsing strings.
+MANAGER_STATS = {"fleet_name": "object", "transports_in_fleet": "int64", "type": "object"}
+CUSTOMER_STATS = {"name": "object", "waiting_time": "float64", "total_time": "float64", "status": "object"}
+TRANSPORT_STATS = {"name": "object", "assignments": "int64", "distance": "float64",
+                   "waiting_in_station_time": "float64", "charging_time": "float64", "consumed_autonomy": "float64",
+                   "shared_trips": "int64", "status": "object"}
+STATION_STATS = {"name": "object", "status": "object", "available_places": "Int64", "power": "float64",
+                 "charged_transports": "int64", "max_queue_length": "int64", "total_busy_time": "float64",
+                 "avg_busy_time": "float64", "avg_queue_time": "float64", "max_queue_time": "float64"}
 
-class SimulatorAgent(Agent):
+STATS_SECTIONS = ["simulation", "customers", "transports", "managers", "stations"]
+
+
+def stats_dataframe(schema, columns):
+    """
+    Builds a stats dataframe from a list of values per column, casting every column to the type of the schema.
+
+    Args:
+        schema (dict): the type of every column (in order)
+        columns (dict): the values of every column
+
+    Returns:
+        ``pandas.DataFrame``: the typed dataframe
+    """
+    return pd.DataFrame({name: pd.Series(columns[name], dtype=dtype) for name, dtype in schema.items()},
+                        columns=list(schema))
+
+
+def stats_to_json(sections):
+    """
+    Serializes stats dataframes as a JSON object with a key per section. The ``simulation`` section (a single row) is
+    written as an object and the other ones as objects of rows by index.
+
+    Args:
+        sections (dict): the dataframe of every section
+
+    Returns:
+        str: the JSON document
+    """
+    parts = []
+    for name, df in sections.items():
+        if name == "simulation":
+            body = df.to_json(orient="records")[1:-1]
+        else:
+            body = df.to_json(orient="index")
+        parts.append("{}: {}".format(json.dumps(name), body))
+    return "{" + ",\n".join(parts) + "}\n"
+
+
+class SimulatorAgent(ReplayAgentMixin, Agent):
     """
     The Simulator. It manages all the simulation processes.
     Tasks done by the simulator at initialization:
@@ -71,22 +130,44 @@ class SimulatorAgent(Agent):
 
         self.delayed_launch_agents = {}
 
+        if self.config.metrics:
+            metrics.enabled = True
+        self.stop_sampling = threading.Event()
+
+        self.shards = None  # the shard workers of a coordinator
+        self.shard_stats = []
+        self.shard_quit = threading.Event()
+
+        self.trajectory = None  # the writer of the trajectory file while the simulation is running
+        self.snapshot = read_checkpoint(config.resume) if config.resume else None  # the checkpoint to resume from
+
         logger.info("Starting SimFleet {}".format(self.pretty_name))
 
         self.set_default_strategies(config.fleetmanager_strategy, config.transport_strategy, config.customer_strategy,
                                     config.directory_strategy, config.station_strategy)
 
         self.route_host = config.route_host
+        if config.route_cache:
+            set_route_cache(config.route_cache)
+        set_route_policy(config.route_policy)
+        if config.event_log:
+            set_event_log(self.local_filename(config.event_log))
+        if config.record and get_replay() is None:
+            set_recorder(config.record, config.seed, config.to_dict())
 
         self.clear_agents()
 
         self.base_path = Path(__file__).resolve().parent
 
         self._icons = None
-        icons_path = self.base_path / "templates" / "data" / "img_transports.json"
-        self.load_icons(icons_path)
+        if not self.config.headless:
+            icons_path = self.base_path / "templates" / "data" / "img_transports.json"
+            self.load_icons(icons_path)
 
-        self.create_directory_agent(name=config.directory_name, password=config.directory_password)
+        if self.is_shard():
+            logger.info("Running shard {} of the simulation coordinated by {}".format(config.shard, config.coordinator))
+        else:
+            self.create_directory_agent(name=config.directory_name, password=config.directory_password)
 
         logger.info("Creating {} managers, {} transports, {} customers and {} stations.".format(config.num_managers,
                                                                                                 config.num_transport,
@@ -98,6 +179,24 @@ class SimulatorAgent(Agent):
 
     async def setup(self):
         logger.info("Simulator agent running")
+        if metrics.enabled:
+            self.submit(sample_loop_lag(self.stop_sampling))
+        if self.is_shard():
+            self.setup_shard()
+            return
+        if self.shards is not None:
+            self.web.add_get("/shards/{shard}", self.shard_config_controller, None)
+            self.web.add_post("/shards/{shard}/register", self.shard_register_controller, None)
+            self.add_behaviour(ShardMonitorBehaviour(period=2))
+        elif self.config.headless:
+            logger.info("Running in headless mode. The web interface is disabled.")
+            if metrics.enabled:
+                self.web.add_get("/metrics/prometheus", self.prometheus_controller, None, raw=True)
+                self.web.start(hostname=self.config.http_ip, port=self.config.http_port)
+                logger.info("Prometheus exporter running at http://{}:{}/metrics/prometheus".format(
+                    self.config.http_ip, self.config.http_port))
+            return
+
         self.web.add_get("/app", self.index_controller, "index.html")
         self.web.add_get("/init", self.init_controller, None)
         self.web.add_get("/entities", self.entities_controller, None)
@@ -106,12 +205,70 @@ class SimulatorAgent(Agent):
         self.web.add_get("/clean", self.clean_controller, None)
         self.web.add_get("/download/excel/", self.download_stats_excel_controller, None, raw=True)
         self.web.add_get("/download/json/", self.download_stats_json_controller, None, raw=True)
+        self.web.add_get("/metrics/prometheus", self.prometheus_controller, None, raw=True)
+        if metrics.enabled:
+            self.web.add_get("/metrics", self.metrics_controller, None)
+        if self.config.trajectory:
+            for path, controller in playback_routes(self.local_filename(self.config.trajectory),
+                                                    lambda: self.trajectory):
+                self.web.add_get(path, controller, None, raw=True)
 
         self.web.app.router.add_static("/assets", str(self.template_path / "assets"))
 
         self.web.start(hostname=self.config.http_ip, port=self.config.http_port, templates_path=str(self.template_path))
         logger.info("Web interface running at http://{}:{}/app".format(self.config.http_ip, self.config.http_port))
 
+    def setup_shard(self):
+        """
+        Starts the web interface used by the coordinator to control this shard and registers the shard.
+        """
+        self.web.add_get("/run", self.run_controller, None)
+        self.web.add_get("/stop", self.stop_agents_controller, None)
+        self.web.add_get("/shard/summary", self.shard_summary_controller, None)
+        self.web.add_get("/shard/entities", self.shard_entities_controller, None)
+        self.web.add_get("/shard/stats", self.shard_stats_controller, None)
+        self.web.add_get("/shard/quit", self.shard_quit_controller, None)
+        self.web.start(hostname=self.config.http_ip, port=self.config.http_port)
+        self.submit(self.register_shard())
+
+    async def register_shard(self):
+        url = "{}shards/{}/register".format(self.config.coordinator, self.config.shard)
+        data = {"url": "http://{}:{}/".format(self.config.http_ip, self.config.http_port)}
+        async with aiohttp.ClientSession() as session:
+            async with session.post(url, json=data) as response:
+                await response.json()
+
+    def is_shard(self):
+        """
+        Returns:
+            bool: whether this simulator is a shard worker of a distributed simulation
+        """
+        return self.config.shard is not None
+
+    def local_filename(self, filename):
+        """
+        Returns the name of an output file written by this simulator. Shard workers add their shard to the name
+        (e.g. ``events.shard0.csv``), so they do not overwrite the files of the other workers.
+
+        Args:
+            filename (str): the name of the file in the config
+
+        Returns:
+            str: the name of the file
+        """
+        if not self.is_shard():
+            return filename
+        path = Path(filename)
+        return str(path.with_name("{}.shard{}{}".format(path.stem, self.config.shard, path.suffix)))
+
+    def write_checkpoint(self):
+        """
+        Writes a checkpoint of the simulation to the checkpoint file of the config (see ``simfleet --resume``).
+        """
+        snapshot = take_snapshot(self)
+        write_checkpoint(self.config.checkpoint, snapshot)
+        logger.info("Checkpoint at {:.1f} seconds written to {}".format(snapshot["time"], self.config.checkpoint))
+
     def load_scenario(self):
         """
         Load the information from the preloaded scenario through the SimfleetConfig class
@@ -130,6 +287,13 @@ class SimulatorAgent(Agent):
         while len(self.manager_agents) < self.config.num_managers:
             time.sleep(0.1)
 
+        if self.config.shards:
+            self.shards = ShardManager(partition_scenario(self.config, self.config.shards, self.config.partition))
+            sizes = [len(p["transports"]) + len(p["customers"]) + len(p["stations"]) for p in self.shards.partitions]
+            logger.info("Transports, customers and stations split in {} shards by {}: {}".format(
+                self.config.shards, self.config.partition, sizes))
+            return
+
         all_coroutines = []
         try:
             future = self.submit(self.async_create_agents_batch_transport(self.config["transports"]))
@@ -147,9 +311,48 @@ class SimulatorAgent(Agent):
         except Exception as e:
             logger.exception("EXCEPTION creating Station agents batch {}".format(e))
 
+        if self.config.warm_start:
+            self.warm_start()
+
         assert all([asyncio.iscoroutine(x) for x in all_coroutines])
         self.submit(self.gather_batch(all_coroutines))
 
+    def warm_start(self):
+        """
+        Registers the agents of the scenario directly, skipping the registration handshakes: managers and stations are
+        added to the directory, transports to the fleet of their manager and customers get the managers of their fleet
+        type. Must be called before the transports, customers and stations are started.
+        """
+        if self.directory_agent is None:
+            logger.warning("Warm start is not available in shard workers. Agents will register with messages.")
+            return
+        directory = self.directory_agent
+        for manager in self.manager_agents.values():
+            directory.register_service({"jid": str(manager.jid), "type": manager.fleet_type})
+            manager.set_registration(True)
+        for transport in self.transport_agents.values():
+            manager = self.manager_agents.get(str(transport.fleetmanager_id).split("@")[0])
+            if manager is None or manager.fleet_type != transport.fleet_type:
+                continue  # the manager rejects (or never answers) the registration
+            manager.register_transport({"name": transport.name, "jid": str(transport.jid),
+                                        "fleet_type": transport.fleet_type})
+            transport.set_registration(True, {"icon": manager.fleet_icon, "fleet_type": manager.fleet_type})
+        for station in self.station_agents.values():
+            station.set_type("station")
+            station.set_status(station.status or FREE_STATION)
+            directory.register_service(dict({"jid": str(station.jid), "type": station.station_type,
+                                             "position": station.get_position(), "charge": station.power},
+                                            **station.availability()))
+            station.published_availability = station.availability()
+            station.set_registration(True)
+        services = directory.get("service_agents")
+        for customer in self.customer_agents.values():
+            if customer.fleet_type in services:
+                customer.fleetmanagers = dict(services[customer.fleet_type])
+        logger.info("Warm start: {} managers, {} transports and {} stations registered without messages.".format(
+            len(self.manager_agents), sum(transport.registration for transport in self.transport_agents.values()),
+            len(self.station_agents)))
+
     async def gather_batch(self, all_coroutines):
         agents_batch = 20
         number = max(len(all_coroutines), 0)
@@ -178,6 +381,10 @@ class SimulatorAgent(Agent):
             fuel = transport.get("fuel")
             autonomy = transport.get("autonomy")
             current_autonomy = transport.get("current_autonomy")
+            max_charge_rate = transport.get("max_charge_rate")
+            capacity = transport.get("capacity", 1)
+            queued_jobs = transport.get("queued_jobs", 0)
+            energy = transport.get("energy")
             strategy = transport.get("strategy")
             icon = transport.get("icon")
             delay = transport["delay"] if "delay" in transport else None
@@ -189,7 +396,9 @@ class SimulatorAgent(Agent):
             agent = self.create_transport_agent(name, password, position=position, speed=speed,
                                                 fleet_type=fleet_type,
                                                 fleetmanager=fleetmanager, strategy=strategy, autonomy=autonomy,
-                                                current_autonomy=current_autonomy, delayed=delayed)
+                                                current_autonomy=current_autonomy, max_charge_rate=max_charge_rate,
+                                                energy=energy, capacity=capacity, queued_jobs=queued_jobs,
+                                                delayed=delayed)
             self.set_icon(agent, icon, default="transport")
 
             if delay is not None:
@@ -238,7 +447,9 @@ class SimulatorAgent(Agent):
             strategy = station.get("strategy")
             icon = station.get("icon")
             agent = self.create_station_agent(station["name"], password, position=station["position"],
-                                              power=station["power"], places=station["places"], strategy=strategy)
+                                              power=station["power"], places=station["places"], strategy=strategy,
+                                              queue=station.get("queue"), charging=station.get("charging"),
+                                              shared_power=station.get("shared_power", False))
             self.set_icon(agent, icon, default="electric_station")
 
             coros.append(agent.start())
@@ -258,6 +469,8 @@ class SimulatorAgent(Agent):
         return icon
 
     def set_icon(self, agent, icon, default=None):
+        if self._icons is None:  # headless mode
+            return
         if icon:
             if icon.startswith("data:image"):
                 agent.set_icon(icon)
@@ -272,6 +485,17 @@ class SimulatorAgent(Agent):
     def get_directory(self):
         return self.directory_agent
 
+    def get_directory_jid(self):
+        """
+        Returns the JID of the directory. Shards do not run a directory, they use the one of the coordinator.
+
+        Returns:
+            str: the JID of the directory agent
+        """
+        if self.directory_agent is not None:
+            return str(self.directory_agent.jid)
+        return "{}@{}".format(self.config.directory_name, self.jid.domain)
+
     def is_simulation_finished(self):
         """
         Checks if the simulation is finished.
@@ -315,6 +539,11 @@ class SimulatorAgent(Agent):
                         while not all([agent.ready for agent in current_agents]):
                             logger.debug("Waiting for all agents to be ready")
                             await asyncio.sleep(0.5)
+                        if self.agent.shards is not None:
+                            await self.agent.shards.wait_ready()
+                            await self.agent.shards.request("run")
+                        if self.agent.snapshot is not None:
+                            self.agent.simulation_init_time = restore_snapshot(self.agent, self.agent.snapshot)
                         for manager in self.agent.manager_agents.values():
                             manager.run_strategy()
                             logger.debug(
@@ -331,7 +560,21 @@ class SimulatorAgent(Agent):
                             logger.debug(f"Running strategy {self.agent.directory_strategy} to station {station.name}")
 
                     self.agent.simulation_running = True
-                    self.agent.simulation_init_time = time.time()
+                    if self.agent.snapshot is None:
+                        self.agent.simulation_init_time = time.time()
+                    self.agent.snapshot = None
+                    if get_event_log() is not None:
+                        get_event_log().start(self.agent.simulation_init_time)
+                    record_run()
+                    if self.agent.config.trajectory:
+                        interval = self.agent.config.trajectory_interval
+                        self.agent.trajectory = TrajectoryWriter(self.agent.local_filename(
+                            self.agent.config.trajectory), interval)
+                        self.agent.add_behaviour(TrajectoryBehaviour(period=interval))
+                    if self.agent.config.checkpoint:
+                        self.agent.add_behaviour(CheckpointBehaviour(
+                            period=self.agent.config.checkpoint_interval,
+                            start_at=datetime.now() + timedelta(seconds=self.agent.config.checkpoint_interval)))
 
                     for delay in self.agent.delayed_launch_agents:
                         agents = self.agent.delayed_launch_agents[delay]
@@ -352,14 +595,40 @@ class SimulatorAgent(Agent):
         """
         self.simulation_time = self.get_simulation_time()
 
-        self.directory_agent.stop().result()
+        if self.shards is not None:
+            self.submit(self.shards.request("stop")).result()
+            self.submit(self.shards.update_summaries()).result()
+            self.shard_stats = [stats for stats in self.submit(self.shards.request("shard/stats")).result() if stats]
+            self.submit(self.shards.request("shard/quit")).result()
+
+        if self.directory_agent is not None:
+            self.directory_agent.stop().result()
 
         logger.info("Terminating... ({0:.1f} seconds elapsed)".format(self.simulation_time))
 
+        if self.config.checkpoint and self.simulation_init_time:
+            self.write_checkpoint()
+
         self.stop_agents()
 
+        if get_event_log() is not None:
+            set_event_log(None)
+        if get_recorder() is not None:
+            set_recorder(None)
+        if get_route_cache() is not None:
+            set_route_cache(None)
+        if self.trajectory is not None:
+            self.trajectory.close()
+            self.trajectory = None
+
         self.print_stats()
 
+        if metrics.enabled:
+            self.stop_sampling.set()
+            self.print_metrics()
+            if self.config.metrics_output:
+                self.write_metrics(self.config.metrics_output)
+
         return super().stop()
 
     def collect_stats(self):
@@ -389,23 +658,66 @@ class SimulatorAgent(Agent):
             self.collect_stats()
 
         print("Simulation Results")
-        print(tabulate(self.df_avg, headers="keys", showindex=False, tablefmt="fancy_grid"))
+        print(tabulate(self.df_avg, headers="keys", showindex=False, tablefmt="fancy_grid", floatfmt=".2f"))
         print("FleetManager stats")
-        print(tabulate(self.manager_df, headers="keys", showindex=False, tablefmt="fancy_grid"))
+        print(tabulate(self.manager_df, headers="keys", showindex=False, tablefmt="fancy_grid", floatfmt=".2f"))
         print("Customer stats")
-        print(tabulate(self.customer_df, headers="keys", showindex=False, tablefmt="fancy_grid"))
+        print(tabulate(self.customer_df, headers="keys", showindex=False, tablefmt="fancy_grid", floatfmt=".2f"))
         print("Transport stats")
-        print(tabulate(self.transport_df, headers="keys", showindex=False, tablefmt="fancy_grid"))
+        print(tabulate(self.transport_df, headers="keys", showindex=False, tablefmt="fancy_grid", floatfmt=".2f"))
         print("Station stats")
-        print(tabulate(self.station_df, headers="keys", showindex=False, tablefmt="fancy_grid"))
+        print(tabulate(self.station_df, headers="keys", showindex=False, tablefmt="fancy_grid", floatfmt=".2f"))
+
+    def get_metrics(self):
+        """
+        Returns the metrics of the registry and the depth of the mailboxes of the agents.
+
+        Returns:
+            dict: the counters, gauges and histograms of the registry and the mailbox depths
+        """
+        depths = {agent.name: agent.mailbox_depth() for agents in (self.manager_agents, self.transport_agents,
+                                                                   self.customer_agents, self.station_agents)
+                  for agent in agents.values() if agent.is_launched}
+        if self.directory_agent:
+            depths[self.directory_agent.name] = self.directory_agent.mailbox_depth()
+        result = metrics.snapshot()
+        result["mailboxes"] = {
+            "total": sum(depths.values()),
+            "max": max(depths.values()) if depths else 0,
+            "agents": {name: depth for name, depth in depths.items() if depth > 0}
+        }
+        return result
+
+    def print_metrics(self):
+        """
+        Prints a summary of the histograms of the registry.
+        """
+        rows = []
+        for (name, labels), histogram in sorted(metrics.histograms.items(), key=lambda item: str(item[0])):
+            data = histogram.to_json()
+            rows.append([name, ",".join("{}={}".format(k, v) for k, v in labels), data["count"],
+                         "{0:.6f}".format(data["mean"]) if data["mean"] is not None else "-", data["p50"], data["p95"]])
+        print("Metrics")
+        print(tabulate(rows, headers=["metric", "labels", "count", "mean", "p50", "p95"], tablefmt="fancy_grid"))
+
+    def write_metrics(self, filename):
+        """
+        Writes the metrics returned by ``get_metrics`` in a json file.
+
+        Args:
+            filename (str): name of the json file.
+        """
+        with open(filename, 'w') as f:
+            json.dump(self.get_metrics(), f, indent=4)
+        logger.info("Metrics written to {}".format(filename))
 
     def write_file(self, filename, fileformat="json"):
         """
-        Writes the dataframes collected by ``collect_stats`` in JSON or Excel format.
+        Writes the dataframes collected by ``collect_stats`` in JSON, Excel, Parquet or Arrow format.
 
         Args:
-            filename (str): name of the output file to be written.
-            fileformat (str): format of the output file. Choices: json or excel
+            filename (str): name of the output file to be written (a directory for parquet and arrow formats).
+            fileformat (str): format of the output file. Choices: json, excel, parquet or arrow
         """
         if self.df_avg is None:
             self.collect_stats()
@@ -413,25 +725,51 @@ class SimulatorAgent(Agent):
             self.write_json(filename)
         elif fileformat == "excel":
             self.write_excel(filename)
+        elif fileformat in ["parquet", "arrow"]:
+            self.write_columnar(filename, fileformat)
+
+    def get_stats_sections(self):
+        """
+        Returns:
+            dict: the dataframes collected by ``collect_stats`` with the name of their section in the output files
+        """
+        return dict(zip(STATS_SECTIONS, [self.df_avg, self.customer_df, self.transport_df, self.manager_df,
+                                         self.station_df]))
 
     def write_json(self, filename):
         """
         Writes the collected data by ``collect_stats`` in a json file.
+        Every dataframe is serialized by pandas and written as is, without building the intermediate dicts.
 
         Args:
             filename (str): name of the json file.
         """
-        data = {
-            "simulation": json.loads(self.df_avg.to_json(orient="index"))["0"],
-            "customers": json.loads(self.customer_df.to_json(orient="index")),
-            "transports": json.loads(self.transport_df.to_json(orient="index")),
-            "managers": json.loads(self.manager_df.to_json(orient="index")),
-            "stations": json.loads(self.station_df.to_json(orient="index"))
-        }
-
         with open(filename, 'w') as f:
-            f.seek(0)
-            json.dump(data, f, indent=4)
+            f.write(stats_to_json(self.get_stats_sections()))
+
+    def write_columnar(self, directory, fileformat="parquet"):
+        """
+        Writes the collected data by ``collect_stats`` in a directory with a Parquet or Arrow (Feather v2) file per
+        dataframe: ``simulation``, ``customers``, ``transports``, ``managers`` and ``stations``.
+        Requires pyarrow (``pip install simfleet[arrow]``).
+
+        Args:
+            directory (str): name of the output directory. It is created if it does not exist.
+            fileformat (str): parquet or arrow
+        """
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise ImportError("The {} output format requires pyarrow. Install it with: "
+                              "pip install simfleet[arrow]".format(fileformat))
+        path = Path(directory)
+        path.mkdir(parents=True, exist_ok=True)
+        for name, df in self.get_stats_sections().items():
+            if fileformat == "parquet":
+                df.to_parquet(str(path / "{}.parquet".format(name)), index=False)
+            else:
+                df.reset_index(drop=True).to_feather(str(path / "{}.arrow".format(name)))
+        logger.info("Simulation results written to {}".format(directory))
 
     def write_excel(self, filename):
         """
@@ -496,7 +834,108 @@ class SimulatorAgent(Agent):
         Returns:
             dict: the name of the template, the data to be pre-processed in the template
         """
-        return {"port": self.config.http_port, "ip": self.config.http_ip}
+        return {"port": self.config.http_port, "ip": self.config.http_ip, "playback": bool(self.config.trajectory)}
+
+    async def metrics_controller(self, request):
+        """
+        Web controller that returns the metrics of the simulation (see ``get_metrics``).
+
+        Returns:
+            dict: no template is returned since this is an AJAX controller, a dict with the metrics
+        """
+        return self.get_metrics()
+
+    async def prometheus_controller(self, request):
+        """
+        Web controller that returns the metrics in the Prometheus text format.
+        The gauges of the transports, customers and stations are updated by the agents when they change, so this
+        controller does not need to visit the agents.
+
+        Returns:
+            Response: a text response with the metrics.
+        """
+        return aioweb.Response(text=metrics.to_text(), headers={"Content-Type": "text/plain; version=0.0.4"})
+
+    async def shard_config_controller(self, request):
+        """
+        Web controller that returns the config of a shard worker: the settings of the simulation and its part of the
+        transports, customers and stations.
+
+        Returns:
+            dict: no template is returned since this is an AJAX controller, the config of the shard
+        """
+        shard = int(request.match_info["shard"])
+        config = self.config.to_dict()
+        config.update(self.shards.partitions[shard])
+        config.update({"fleets": [], "shards": 0, "headless": True, "metrics_output": None})
+        return config
+
+    async def shard_register_controller(self, request):
+        """
+        Web controller where the shard workers register the URL of their web interface.
+
+        Returns:
+            dict: no template is returned since this is an AJAX controller, a dict with status=ok
+        """
+        data = await request.json()
+        self.shards.register(int(request.match_info["shard"]), data["url"])
+        return {"status": "ok"}
+
+    async def shard_summary_controller(self, request):
+        """
+        Web controller that returns the state of a shard worker to its coordinator.
+
+        Returns:
+            dict: no template is returned since this is an AJAX controller, a dict with whether all the agents are
+            ready, the number of customers, how many of them are in their destination and the totals of the stats
+        """
+        agents = [agent for agents in (self.transport_agents, self.customer_agents, self.station_agents)
+                  for agent in agents.values() if agent.is_launched]
+        return {
+            "ready": all(agent.ready for agent in agents),
+            "customers": len(self.customer_agents),
+            "in_destination": len([c for c in self.customer_agents.values() if c.is_in_destination()]),
+            "totals": self.get_stats_totals()
+        }
+
+    async def shard_entities_controller(self, request):
+        """
+        Web controller that returns the entities of a shard worker to be shown in the map of the coordinator.
+
+        Returns:
+            dict: no template is returned since this is an AJAX controller, a dict with the transports, customers
+            and stations of the shard
+        """
+        return {
+            "transports": [transport.to_json() for transport in self.transport_agents.values() if
+                           transport.is_launched],
+            "customers": [customer.to_json() for customer in self.customer_agents.values() if customer.is_launched],
+            "stations": [station.to_json() for station in self.station_agents.values()]
+        }
+
+    async def shard_stats_controller(self, request):
+        """
+        Web controller that returns the stats of the agents of a shard worker to its coordinator.
+
+        Returns:
+            dict: no template is returned since this is an AJAX controller, a dict with the stats of the customers,
+            transports and stations of the shard
+        """
+        return {
+            "customers": json.loads(self.get_customer_stats().to_json(orient="records")),
+            "transports": json.loads(self.get_transport_stats().to_json(orient="records")),
+            "stations": json.loads(self.get_station_stats().to_json(orient="records"))
+        }
+
+    async def shard_quit_controller(self, request):
+        """
+        Web controller used by the coordinator to finish a shard worker.
+
+        Returns:
+            dict: no template is returned since this is an AJAX controller, a dict with status=ok
+        """
+        self.shard_quit.set()
+        return {"status": "ok"}
 
     async def init_controller(self, request):
         return {"coords": self.config.coords, "zoom": self.config.zoom}
@@ -569,20 +1008,31 @@ class SimulatorAgent(Agent):
         Returns:
             dict:  no template is returned since this is an AJAX controller, a dict with the list of transports, the list of customers, the tree view to be showed in the sidebar and the stats of the simulation.
         """
+        start = time.perf_counter()
         result = {
             "transports": [transport.to_json() for transport in self.transport_agents.values() if
                            transport.is_launched],
             "customers": [customer.to_json() for customer in self.customer_agents.values() if customer.is_launched],
-            "tree": self.generate_tree(),
-            "stats": self.get_stats(),
             "stations": [station.to_json() for station in self.station_agents.values()]
         }
+        if self.shards is not None:
+            for entities in await self.shards.request("shard/entities"):
+                for key in ["transports", "customers", "stations"]:
+                    result[key] += entities[key] if entities else []
+        result["tree"] = self.generate_tree(result["transports"], result["customers"])
+        result["stats"] = self.get_stats()
+        if metrics.enabled:
+            metrics.observe("web_entities_seconds", time.perf_counter() - start)
         return result
 
-    def generate_tree(self):
+    def generate_tree(self, transports, customers):
         """
         Generates the tree view in JSON format to be showed in the sidebar.
 
+        Args:
+            transports (list): the serialized transports (see ``TransportAgent.to_json``)
+            customers (list): the serialized customers (see ``CustomerAgent.to_json``)
+
         Returns:
             dict: a dict with all the agents in the simulator, with their name, status and icon.
         """
@@ -591,24 +1041,24 @@ class SimulatorAgent(Agent):
             "children": [
                 {
                     "name": "Transports",
-                    "count": "{}".format(len(self.transport_agents)),
+                    "count": "{}".format(len(transports)),
                     "children": [
                         {
-                            "name": " {}".format(i.name.split("@")[0]),
-                            "status": i.status,
+                            "name": " {}".format(i["id"]),
+                            "status": i["status"],
                             "icon": "fa-taxi"
-                        } for i in self.transport_agents.values()
+                        } for i in transports
                     ]
                 },
                 {
                     "name": "Customers",
-                    "count": "{}".format(len(self.customer_agents)),
+                    "count": "{}".format(len(customers)),
                     "children": [
                         {
-                            "name": " {}".format(i.name.split("@")[0]),
-                            "status": i.status,
+                            "name": " {}".format(i["id"]),
+                            "status": i["status"],
                             "icon": "fa-user"
-                        } for i in self.customer_agents.values()
+                        } for i in customers
                     ]
                 },
 
@@ -633,32 +1083,56 @@ class SimulatorAgent(Agent):
             dict: a dict with the total time, waiting time, is_running and finished values
 
         """
-        if len(self.customer_agents) > 0:
-            waiting = avg([customer.get_waiting_time() for customer in self.customer_agents.values()])
-            total = avg(
-                [customer.total_time() for customer in self.customer_agents.values() if customer.total_time()])
-        else:
-            waiting, total = 0, 0
-
-        if len(self.transport_agents) > 0:
-            t_waiting = avg([transport.total_waiting_time for transport in self.transport_agents.values()])
-            t_charging = avg([transport.total_charging_time for transport in self.transport_agents.values()])
-            distance = avg([sum(transport.distances) for transport in self.transport_agents.values()])
-        else:
-            t_waiting = 0
-            t_charging = 0
-            distance = 0
+        averages = self.get_averages()
 
         return {
-            "waiting": "{0:.2f}".format(waiting),
-            "totaltime": "{0:.2f}".format(total),
-            "t_waiting": "{0:.2f}".format(t_waiting),
-            "t_charging": "{0:.2f}".format(t_charging),
-            "distance": "{0:.2f}".format(distance),
+            "waiting": "{0:.2f}".format(averages["waiting"]),
+            "totaltime": "{0:.2f}".format(averages["totaltime"]),
+            "t_waiting": "{0:.2f}".format(averages["t_waiting"]),
+            "t_charging": "{0:.2f}".format(averages["t_charging"]),
+            "distance": "{0:.2f}".format(averages["distance"]),
             "finished": self.is_simulation_finished(),
             "is_running": self.simulation_running,
         }
 
+    def get_averages(self):
+        """
+        Returns the averages of ``get_stats`` as numbers, merging the totals of the shards in a distributed simulation.
+
+        Returns:
+            dict: the average of every value (0.0 if there are no values)
+        """
+        totals = self.get_stats_totals()
+        if self.shards is not None:
+            for summary in self.shards.summaries.values():
+                for key, (total, count) in summary["totals"].items():
+                    totals[key][0] += total
+                    totals[key][1] += count
+        return {key: total / count if count else 0.0 for key, (total, count) in totals.items()}
+
+    def get_stats_totals(self):
+        """
+        Returns the sum and the number of values of every average of ``get_stats``. Like ``avg``, Nones and zeros are
+        not counted. Sums and counts (instead of averages) can be merged with the ones of other shards.
+
+        Returns:
+            dict: a list [sum, count] for every average
+        """
+        customers = self.customer_agents.values()
+        transports = self.transport_agents.values()
+        values = {
+            "waiting": [customer.get_waiting_time() for customer in customers],
+            "totaltime": [customer.total_time() for customer in customers],
+            "t_waiting": [transport.total_waiting_time for transport in transports],
+            "t_charging": [transport.total_charging_time for transport in transports],
+            "distance": [sum(transport.distances) for transport in transports],
+        }
+        totals = {}
+        for key, array in values.items():
+            array = list(filter(None, array))
+            totals[key] = [sum(array, 0.0), len(array)]
+        return totals
+
     def all_customers_in_destination(self):
         """
         Checks whether the simulation has finished or not.
@@ -668,6 +1142,8 @@ class SimulatorAgent(Agent):
         Returns:`
             bool: whether the simulation has finished or not.
         """
+        if self.shards is not None:
+            return self.shards.all_customers_in_destination()
         if len(self.customer_agents) > 0:
             return all([customer.is_in_destination() for customer in self.customer_agents.values()])
         else:
@@ -749,23 +1225,17 @@ class SimulatorAgent(Agent):
             "Content-Disposition": "Attachment; filename=simulation.json"
         }
 
-        output = io.StringIO()
-
-        # Write the data frame to the StringIO object.
         df_avg, transport_df, customer_df, manager_df, stations_df = self.get_stats_dataframes()
-
-        data = {
-            "simulation": json.loads(df_avg.to_json(orient="index"))["0"],
-            "customers": json.loads(customer_df.to_json(orient="index")),
-            "transports": json.loads(transport_df.to_json(orient="index")),
-            "fleetmanagers": json.loads(manager_df.to_json(orient="index")),
-            "stations": json.loads(stations_df.to_json(orient="index"))
+        sections = {
+            "simulation": df_avg,
+            "customers": customer_df,
+            "transports": transport_df,
+            "fleetmanagers": manager_df,
+            "stations": stations_df
         }
 
-        json.dump(data, output, indent=4)
-
         return aioweb.Response(
-            body=output.getvalue(),
+            body=stats_to_json(sections),
             headers=headers
         )
 
@@ -779,6 +1249,7 @@ class SimulatorAgent(Agent):
         self.set("station_agents", {})
         self.simulation_time = None
         self.simulation_init_time = None
+        metrics.clear_gauges()
 
     def clear_stopped_agents(self):
         """
@@ -828,22 +1299,18 @@ class SimulatorAgent(Agent):
 
     def get_manager_stats(self):
         """
-        Creates a dataframe with the simulation stats of the customers
-        The dataframe includes for each customer its name, waiting time, total time and status.
+        Creates a dataframe with the simulation stats of the fleet managers
+        The dataframe includes for each manager its fleet name, number of transports and fleet type.
 
         Returns:
-            ``pandas.DataFrame``: the dataframe with the customers stats.
+            ``pandas.DataFrame``: the dataframe with the managers stats.
         """
-        try:
-            names, quantities, types = zip(*[(manager.name,
-                                              manager.transports_in_fleet, manager.fleet_type)
-                                             for manager in self.manager_agents.values()])
-        except ValueError:
-            names, quantities, types = [], [], []
-
-        df = pd.DataFrame.from_dict(
-            {"fleet_name": names, "transports_in_fleet": quantities, "type": types})
-        return df
+        managers = self.manager_agents.values()
+        return stats_dataframe(MANAGER_STATS, {
+            "fleet_name": [manager.name for manager in managers],
+            "transports_in_fleet": [manager.transports_in_fleet for manager in managers],
+            "type": [manager.fleet_type for manager in managers],
+        })
 
     def get_customer_stats(self):
         """
@@ -853,78 +1320,58 @@ class SimulatorAgent(Agent):
         Returns:
             ``pandas.DataFrame``: the dataframe with the customers stats.
         """
-        try:
-            names, waitings, totals, statuses = zip(*[(p.name, p.get_waiting_time(),
-                                                       p.total_time(), status_to_str(p.status))
-                                                      for p in self.customer_agents.values()])
-        except ValueError:
-            names, waitings, totals, statuses = [], [], [], []
-
-        df = pd.DataFrame.from_dict({"name": names, "waiting_time": waitings, "total_time": totals, "status": statuses})
-        return df
+        customers = self.customer_agents.values()
+        return stats_dataframe(CUSTOMER_STATS, {
+            "name": [customer.name for customer in customers],
+            "waiting_time": [customer.get_waiting_time() for customer in customers],
+            "total_time": [customer.total_time() for customer in customers],
+            "status": [status_to_str(customer.status) for customer in customers],
+        })
 
     def get_transport_stats(self):
         """
         Creates a dataframe with the simulation stats of the transports
-        The dataframe includes for each transport its name, assignments, traveled distance and status.
+        The dataframe includes for each transport its name, assignments, traveled distance, station times, consumed
+        autonomy, shared trips and status.
 
         Returns:
             ``pandas.DataFrame``: the dataframe with the transports stats.
         """
-        try:
-            names, assignments, distances, waiting_in_station_time, charging_time, statuses, = zip(
-                *[(t.name, t.num_assignments,
-                   "{0:.2f}".format(
-                       sum(t.distances)),
-                   "{0:.2f}".format(
-                       t.total_waiting_time),
-                   "{0:.2f}".format(
-                       t.total_charging_time),
-                   status_to_str(t.status))
-                  for t in
-                  self.transport_agents.values()])
-        except ValueError:
-            names, assignments, distances, waiting_in_station_time, charging_time, statuses = [], [], [], [], []
-        df = pd.DataFrame.from_dict({"name": names,
-                                     "assignments": assignments,
-                                     "distance": distances,
-                                     "waiting_in_station_time": waiting_in_station_time,
-                                     "charging_time": charging_time,
-                                     "status": statuses})
-        return df
+        transports = self.transport_agents.values()
+        return stats_dataframe(TRANSPORT_STATS, {
+            "name": [transport.name for transport in transports],
+            "assignments": [transport.num_assignments for transport in transports],
+            "distance": [sum(transport.distances) for transport in transports],
+            "waiting_in_station_time": [transport.total_waiting_time for transport in transports],
+            "charging_time": [transport.total_charging_time for transport in transports],
+            "consumed_autonomy": [float(fleet_energy.consumed[transport.energy_index]) for transport in transports],
+            "shared_trips": [transport.shared_trips for transport in transports],
+            "status": [status_to_str(transport.status) for transport in transports],
+        })
 
     def get_station_stats(self):
         """
-        Creates a dataframe with the simulation stats of the customers
-        The dataframe includes for each customer its name, waiting time, total time and status.
+        Creates a dataframe with the simulation stats of the stations
+        The dataframe includes for each station its name, status, places, power, charged transports, max queue length,
+        busy times and the average and maximum time waited in its queue by a transport.
 
         Returns:
-            ``pandas.DataFrame``: the dataframe with the customers stats.
-        """
-        try:
-            avg_busy_time = []
-            for p in self.station_agents.values():
-                if p.charged_transports > 0:
-                    avg_busy_time.append("{0:.2f}".format(p.total_busy_time / p.charged_transports))
-                else:
-                    avg_busy_time.append(0)
-
-            names, status, places, power, charged_transports, max_queue_length, total_busy_time = zip(
-                *[(p.name, p.status,
-                   p.available_places,
-                   p.power,
-                   p.charged_transports,
-                   p.max_queue_length,
-                   "{0:.2f}".format(p.total_busy_time))
-                  for p in
-                  self.station_agents.values()])
-        except ValueError:
-            names, status, places, power, charged_transports, max_queue_length, total_busy_time, avg_busy_time = [], [], [], [], [], [], [], []
-
-        df = pd.DataFrame.from_dict({"name": names, "status": status, "available_places": places, "power": power,
-                                     "charged_transports": charged_transports, "max_queue_length": max_queue_length,
-                                     "total_busy_time": total_busy_time, "avg_busy_time": avg_busy_time})
-        return df
+            ``pandas.DataFrame``: the dataframe with the stations stats.
+        """
+        stations = self.station_agents.values()
+        return stats_dataframe(STATION_STATS, {
+            "name": [station.name for station in stations],
+            "status": [station.status for station in stations],
+            "available_places": [station.available_places for station in stations],
+            "power": [station.power for station in stations],
+            "charged_transports": [station.charged_transports for station in stations],
+            "max_queue_length": [station.max_queue_length for station in stations],
+            "total_busy_time": [station.total_busy_time for station in stations],
+            "avg_busy_time": [station.total_busy_time / station.charged_transports
+                              if station.charged_transports > 0 else 0.0 for station in stations],
+            "avg_queue_time": [station.queue_time_stats()[0] for station in stations],
+            "max_queue_time": [station.queue_time_stats()[1] for station in stations],
+        })
 
     def get_stats_dataframes(self):
         """
@@ -935,32 +1382,40 @@ class SimulatorAgent(Agent):
             pandas.Dataframe, pandas.Dataframe, pandas.Dataframe: avg df, transport df and customer df
         """
         manager_df = self.get_manager_stats()
-        manager_df = manager_df[["fleet_name", "transports_in_fleet", "type"]]
-        customer_df = self.get_customer_stats()
-        customer_df = customer_df[["name", "waiting_time", "total_time", "status"]]
-        transport_df = self.get_transport_stats()
-        transport_df = transport_df[["name", "assignments", "distance", "waiting_in_station_time", "charging_time",
-                                     "status"]]
-        station_df = self.get_station_stats()
-        station_df = station_df[
-            ["name", "status", "available_places", "power", "charged_transports", "max_queue_length",
-             "total_busy_time", "avg_busy_time"]]
-
-        stats = self.get_stats()
-        df_avg = pd.DataFrame.from_dict({"Avg Customer Waiting Time": [stats["waiting"]],
-                                         "Avg Customer Total Time": [stats["totaltime"]],
-                                         "Avg Transport Waiting Time": [stats["t_waiting"]],
-                                         "Avg Transport Charging Time": [stats["t_charging"]],
-                                         "Avg Distance": [stats["distance"]],
-                                         "Simulation Finished": [stats["finished"]],
-                                         "Simulation Time": [self.get_simulation_time()]
-                                         })
-        columns = ["Avg Customer Waiting Time", "Avg Customer Total Time", "Avg Transport Waiting Time",
-                   "Avg Transport Charging Time", "Avg Distance", "Simulation Time", "Simulation Finished"]
-        df_avg = df_avg[columns]
+        customer_df = self.merge_shard_stats(self.get_customer_stats(), "customers")
+        transport_df = self.merge_shard_stats(self.get_transport_stats(), "transports")
+        station_df = self.merge_shard_stats(self.get_station_stats(), "stations")
+
+        averages = self.get_averages()
+        df_avg = pd.DataFrame({"Avg Customer Waiting Time": [averages["waiting"]],
+                               "Avg Customer Total Time": [averages["totaltime"]],
+                               "Avg Transport Waiting Time": [averages["t_waiting"]],
+                               "Avg Transport Charging Time": [averages["t_charging"]],
+                               "Avg Distance": [averages["distance"]],
+                               "Simulation Time": [float(self.get_simulation_time())],
+                               "Simulation Finished": [self.is_simulation_finished()]
+                               })
 
         return df_avg, transport_df, customer_df, manager_df, station_df
 
+    def merge_shard_stats(self, df, key):
+        """
+        Appends the stats collected from the shards (when the simulation is stopped) to a dataframe of local stats.
+
+        Args:
+            df (``pandas.DataFrame``): the local stats
+            key (str): the kind of stats (customers, transports or stations)
+
+        Returns:
+            ``pandas.DataFrame``: the stats of all the shards
+        """
+        if not self.shard_stats:
+            return df
+        schema = {"customers": CUSTOMER_STATS, "transports": TRANSPORT_STATS, "stations": STATION_STATS}[key]
+        df = pd.concat([df] + [pd.DataFrame(stats[key], columns=list(schema)) for stats in self.shard_stats],
+                       ignore_index=True, sort=False)
+        return df.astype(schema)
+
     async def async_start_agent(self, agent):
         await agent.start()
 
@@ -982,9 +1437,15 @@ class SimulatorAgent(Agent):
         agent = FleetManagerAgent(jid, password)
         logger.debug("Creating FleetManager {}".format(jid))
         agent.set_id(name)
-        agent.set_directory(self.get_directory().jid)
+        agent.set_directory(self.get_directory_jid())
         logger.debug("Assigning type {} to fleet manager {}".format(fleet_type, name))
         agent.set_fleet_type(fleet_type)
+        if self.config.charging_dispatch:
+            options = self.config.charging_dispatch
+            agent.set_charging_dispatch(**(options if isinstance(options, dict) else {}))
+        if self.config.rebalancing:
+            options = self.config.rebalancing
+            agent.set_rebalancing(self.config.coords, **(options if isinstance(options, dict) else {}))
 
         if strategy:
             agent.strategy = load_class(strategy)
@@ -1003,19 +1464,23 @@ class SimulatorAgent(Agent):
         return agent
 
     def create_transport_agent(self, name, password, fleet_type, fleetmanager, position, strategy=None, speed=None,
-                               autonomy=None, current_autonomy=None, delayed=False):
+                               autonomy=None, current_autonomy=None, max_charge_rate=None, energy=None, capacity=1,
+                               queued_jobs=0, delayed=False):
         jid = f"{name}@{self.jid.domain}"
         agent = TransportAgent(jid, password)
         logger.debug("Creating Transport {}".format(jid))
         agent.set_id(name)
-        agent.set_directory(self.get_directory().jid)
+        agent.set_directory(self.get_directory_jid())
         logger.debug("Assigning type {} to transport {}".format(fleet_type, name))
         agent.set_fleet_type(fleet_type)
         agent.set_fleetmanager(fleetmanager)
         agent.set_route_host(self.route_host)
-        agent.set_directory(self.get_directory().jid)
+        agent.set_directory(self.get_directory_jid())
         if autonomy:
             agent.set_autonomy(autonomy, current_autonomy=current_autonomy)
+        agent.set_max_charge_rate(max_charge_rate)
+        agent.set_energy_model(energy)
+        agent.set_capacity(capacity, queued_jobs)
 
         agent.set_initial_position(position)
 
@@ -1054,11 +1519,11 @@ class SimulatorAgent(Agent):
         agent = CustomerAgent(jid, password)
         logger.debug("Creating Customer {}".format(jid))
         agent.set_id(name)
-        agent.set_directory(self.get_directory().jid)
+        agent.set_directory(self.get_directory_jid())
         logger.debug("Assigning fleet type {} to customer {}".format(fleet_type, name))
         agent.set_fleet_type(fleet_type)
         agent.set_route_host(self.route_host)
-        agent.set_directory(self.get_directory().jid)
+        agent.set_directory(self.get_directory_jid())
 
         agent.set_position(position)
 
@@ -1079,7 +1544,8 @@ class SimulatorAgent(Agent):
 
         return agent
 
-    def create_station_agent(self, name, password, position, power, places, strategy=None):
+    def create_station_agent(self, name, password, position, power, places, strategy=None, queue=None, charging=None,
+                             shared_power=False):
         """
         Create a customer agent.
 
@@ -1090,19 +1556,24 @@ class SimulatorAgent(Agent):
             power (int): power of the station agent in kW
             places (int): destination coordinates of the agent
             strategy (class, optional): strategy class of the agent
+            queue (str or dict, optional): policy of the waiting queue of the station (see ``simfleet.queues``)
+            charging (str or dict, optional): charging model of the station (see ``simfleet.charging``)
+            shared_power (bool, optional): whether the power of the station is shared by the transports charging in it
         """
         jid = f"{name}@{self.jid.domain}"
         agent = StationAgent(jid, password)
         logger.debug("Creating station {}".format(jid))
         agent.set_id(name)
-        agent.set_directory(self.get_directory().jid)
+        agent.set_directory(self.get_directory_jid())
 
-        agent.set_directory(self.get_directory().jid)
+        agent.set_directory(self.get_directory_jid())
 
         agent.set_position(position)
 
-        agent.set_available_places(places)
+        agent.set_places(places)
         agent.set_power(power)
+        agent.set_queue(queue)
+        agent.set_charging_model(charging, shared_power)
 
         if strategy:
             agent.strategy = load_class(strategy)
@@ -1210,6 +1681,27 @@ class SimulatorAgent(Agent):
         return async_request_path(self, origin, destination, self.route_host)
 
 
+class TrajectoryBehaviour(PeriodicBehaviour):
+    """
+    Periodically writes the positions of the transports to the trajectory file.
+    """
+
+    async def run(self):
+        if self.agent.trajectory is not None:
+            self.agent.trajectory.write_tick([(transport.name, transport.get_position(), status_to_str(transport.status))
+                                              for transport in self.agent.transport_agents.values()])
+
+
+class ShardMonitorBehaviour(PeriodicBehaviour):
+    """
+    Periodically updates the summaries of the shard workers of a coordinator.
+    """
+
+    async def run(self):
+        if self.agent.shards.all_registered():
+            await self.agent.shards.update_summaries()
+
+
 class DelayedLaunchBehaviour(TimeoutBehaviour):
     def __init__(self, agents, *args, **kwargs):
         self.agents = agents
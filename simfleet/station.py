@@ -1,5 +1,6 @@
 import datetime
 import json
+import math
 import time
 from asyncio import CancelledError
 
@@ -9,14 +10,22 @@ from spade.behaviour import TimeoutBehaviour
 from spade.message import Message
 from spade.template import Template
 
+from .charging import ChargingSession, create_charging_model, share_power
+from .eventlog import CHARGE_END, CHARGE_START, log_event
 from .helpers import random_position
+from .metrics import InstrumentedAgentMixin, registry as metrics
 from .protocol import REQUEST_PROTOCOL, REGISTER_PROTOCOL, ACCEPT_PERFORMATIVE, REFUSE_PERFORMATIVE, \
-    REQUEST_PERFORMATIVE, TRAVEL_PROTOCOL, CANCEL_PERFORMATIVE, INFORM_PERFORMATIVE
+    REQUEST_PERFORMATIVE, TRAVEL_PROTOCOL, CANCEL_PERFORMATIVE, INFORM_PERFORMATIVE, RESERVE_PERFORMATIVE
+from .queues import create_queue
+from .replay import ReplayAgentMixin
+from .reservations import SlotCalendar
 from .utils import StrategyBehaviour, CyclicBehaviour, FREE_STATION, BUSY_STATION, TRANSPORT_MOVING_TO_STATION, \
     TRANSPORT_IN_STATION_PLACE, TRANSPORT_CHARGED
 
+RESERVATION_TOLERANCE = 60  # seconds a transport may arrive before its booked window
 
-class StationAgent(Agent):
+
+class StationAgent(ReplayAgentMixin, InstrumentedAgentMixin, Agent):
     def __init__(self, agentjid, password):
         super().__init__(jid=agentjid, password=password)
         self.agent_id = None
@@ -28,19 +37,28 @@ class StationAgent(Agent):
         self.station_name = None
         self.station_type = None
         self.current_pos = None
+        self.places = None
         self.available_places = None
+        self.published_availability = None  # the availability last published in the directory
         self.status = None
         self.power = None
         self.stopped = False
         self.ready = False
 
-        # waiting waiting_list
-        self.waiting_list = list()
+        # queue of the transports waiting for a place (see simfleet.queues)
+        self.waiting_list = create_queue()
+        self.charging = {}  # fleet of every transport charging in the station
+        self.calendar = SlotCalendar(0)  # windows booked in every place (see simfleet.reservations)
+        self.charging_model = create_charging_model()  # see simfleet.charging
+        self.shared_power = False  # whether the power of the station is shared by the transports charging in it
+        self.sessions = {}  # the charges in progress by transport
 
         # statistics
         self.charged_transports = 0
         self.queue_length = 0
         self.max_queue_length = 0
+        self.queue_times = {}  # total seconds waited in the queue by every transport
+        self.queued_transports = 0  # transports that waited in the queue
 
         self.transports_in_queue_time = None
         self.empty_queue_time = None
@@ -51,14 +69,16 @@ class StationAgent(Agent):
         logger.info("Station agent {} running".format(self.name))
         self.set_type("station")
         self.set_status()
+        metrics.set("station_queue_length", len(self.waiting_list), station=self.agent_id)
         try:
-            template = Template()
-            template.set_metadata("protocol", REGISTER_PROTOCOL)
-            register_behaviour = RegistrationBehaviour()
-            self.add_behaviour(register_behaviour, template)
-            while not self.has_behaviour(register_behaviour):
-                logger.warning("Station {} could not create RegisterBehaviour. Retrying...".format(self.agent_id))
+            if not self.registration:  # stations of a warm start are already registered
+                template = Template()
+                template.set_metadata("protocol", REGISTER_PROTOCOL)
+                register_behaviour = RegistrationBehaviour()
                 self.add_behaviour(register_behaviour, template)
+                while not self.has_behaviour(register_behaviour):
+                    logger.warning("Station {} could not create RegisterBehaviour. Retrying...".format(self.agent_id))
+                    self.add_behaviour(register_behaviour, template)
         except Exception as e:
             logger.error("EXCEPTION creating RegisterBehaviour in Station {}: {}".format(self.agent_id, e))
         try:
@@ -73,15 +93,6 @@ class StationAgent(Agent):
             logger.error("EXCEPTION creating TravelBehaviour in Station {}: {}".format(self.agent_id, e))
         self.ready = True
 
-    async def send(self, msg):
-        if not msg.sender:
-            msg.sender = str(self.jid)
-            logger.debug(f"Adding agent's jid as sender to message: {msg}")
-        aioxmpp_msg = msg.prepare()
-        await self.client.send(aioxmpp_msg)
-        msg.sent = True
-        self.traces.append(msg, category=str(self))
-
     def set_id(self, agent_id):
         """
         Sets the agent identifier
@@ -133,7 +144,7 @@ class StationAgent(Agent):
         if coords:
             self.current_pos = coords
         else:
-            self.current_pos = random_position()
+            self.current_pos = random_position(self.name)
         logger.debug("Station {} position is {}".format(self.agent_id, self.current_pos))
 
     def get_position(self):
@@ -148,15 +159,182 @@ class StationAgent(Agent):
     def set_status(self, state=FREE_STATION):
         self.status = state
 
+    def availability(self):
+        """
+        Returns the live availability of the station, published in the directory.
+
+        Returns:
+            dict: the status, the number of places, the free places, the transports waiting in the queue and the booked
+            windows of every place
+        """
+        self.calendar.prune(time.time())
+        return {
+            "status": self.status,
+            "places": self.places,
+            "available_places": self.available_places,
+            "queue_length": len(self.waiting_list),
+            "windows": self.calendar.windows()
+        }
+
+    async def publish_availability(self):
+        """
+        Informs the directory of the availability of the station if it changed since it was last published, so the
+        directory can notify the transports subscribed to the stations.
+        """
+        availability = self.availability()
+        if not self.registration or availability == self.published_availability:
+            return
+        self.published_availability = availability
+        await self.inform_directory(availability)
+
+    async def inform_directory(self, values):
+        """
+        Informs the directory of a change of the station (e.g. its status), so it can notify its subscribers.
+
+        Args:
+            values (dict): the fields of the registration of the station that changed
+        """
+        msg = Message()
+        msg.to = str(self.directory_id)
+        msg.set_metadata("protocol", REGISTER_PROTOCOL)
+        msg.set_metadata("performative", INFORM_PERFORMATIVE)
+        msg.body = json.dumps(dict({"jid": str(self.jid), "type": self.station_type}, **values))
+        await self.send(msg)
+
     def get_status(self):
         return self.status
 
+    def set_places(self, places):
+        """
+        Sets the number of charging places of the station. All of them are free.
+
+        Args:
+            places (int): the number of places
+        """
+        self.places = places
+        self.calendar = SlotCalendar(places)
+        self.set_available_places(places)
+
+    def set_queue(self, config=None):
+        """
+        Sets the policy of the waiting queue of the station. See :func:`simfleet.queues.create_queue`.
+
+        Args:
+            config (str or dict, optional): the policy of the queue and its options. Defaults to FIFO.
+        """
+        self.waiting_list = create_queue(config)
+
     def set_available_places(self, places):
         self.available_places = places
+        metrics.set("station_available_places", places, station=self.agent_id)
 
     def get_available_places(self):
         return self.available_places
 
+    def charge_duration(self, need):
+        """
+        Returns the seconds the station needs to charge some kilometers of autonomy.
+
+        Args:
+            need (float): the kilometers of autonomy to charge
+
+        Returns:
+            float: the duration of the charge (0 if it is unknown)
+        """
+        if not need or not self.get_power():
+            return 0.0
+        return self.charging_model.duration(0.0, need, need, self.get_power())
+
+    def reserve(self, transport_id, start, duration):
+        """
+        Books the earliest charging window of the station that starts at ``start`` or later. A previous booking of
+        the transport is replaced.
+
+        Args:
+            transport_id (str): the jid of the transport
+            start (float): the earliest start of the window (timestamp)
+            duration (float): the length of the window in seconds
+
+        Returns:
+            Booking: the booking, or None if the station has no places
+        """
+        self.calendar.prune(time.time())
+        booking = self.calendar.book(transport_id, max(start, time.time()), duration)
+        if booking is not None:
+            if metrics.enabled:
+                metrics.inc("station_reservations_total", station=self.agent_id)
+            logger.info("Station {} booked place {} for transport {} from {:.0f} to {:.0f}".format(
+                self.name, booking.place, transport_id, booking.start, booking.end))
+        return booking
+
+    def held_places(self, now=None):
+        """
+        Returns the places held for transports whose booked window has started but have not arrived yet.
+
+        Args:
+            now (float, optional): the current timestamp
+
+        Returns:
+            int: the number of held places
+        """
+        now = time.time() if now is None else now
+        return sum(1 for booking in self.calendar.bookings.values()
+                   if booking.start <= now < booking.end and booking.transport not in self.charging)
+
+    def can_start_charging(self, transport_id, need=None, fleet=None):
+        """
+        Returns whether a transport that arrives to the station may take a place now. A transport that arrives in its
+        booked window (or up to ``RESERVATION_TOLERANCE`` seconds before it) takes any free place. Other transports
+        need a free place that is not booked by other transports during their charge and the approval of the queue.
+
+        Args:
+            transport_id (str): the jid of the transport
+            need (float, optional): the kilometers of autonomy the transport needs to charge
+            fleet (str, optional): the fleet of the transport
+
+        Returns:
+            bool: whether the transport may start charging
+        """
+        now = time.time()
+        if self.in_booked_window(transport_id, now):
+            return self.get_available_places() > 0
+        if not self.waiting_list.can_charge(fleet, self.get_available_places() - self.held_places(now), self.charging):
+            return False
+        return self.charge_fits(transport_id, need, now)
+
+    def in_booked_window(self, transport_id, now):
+        booking = self.calendar.booking(transport_id)
+        return booking is not None and booking.start - RESERVATION_TOLERANCE <= now < booking.end
+
+    def charge_fits(self, transport_id, need=None, now=None):
+        """
+        Returns whether the charge of a transport that starts now ends before the bookings of other transports take
+        all the places of the station.
+
+        Args:
+            transport_id (str): the jid of the transport
+            need (float, optional): the kilometers of autonomy the transport needs to charge
+            now (float, optional): the current timestamp
+
+        Returns:
+            bool: whether the charge fits in the calendar
+        """
+        now = time.time() if now is None else now
+        if self.in_booked_window(transport_id, now):
+            return True
+        return self.calendar.free_places(now, now + self.charge_duration(need)) > 0
+
+    def set_charging_model(self, config=None, shared_power=False):
+        """
+        Sets the charging model of the station. See :func:`simfleet.charging.create_charging_model`.
+
+        Args:
+            config (str or dict, optional): the charging model and its options. Defaults to the linear model.
+            shared_power (bool): whether the power of the station is shared by the transports charging in it
+        """
+        self.charging_model = create_charging_model(config)
+        self.shared_power = shared_power
+
     def set_power(self, charge):
         self.power = charge
 
@@ -191,33 +369,144 @@ class StationAgent(Agent):
             "icon": self.icon
         }
 
-    async def assigning_place(self):
+    async def assigning_place(self, transport_id=None, fleet=None, need=None):
         """
         Set a space in the charging station for the transport that has been accepted, when the available spaces are zero,
         the status will change to BUSY_STATION
+
+        Args:
+            transport_id (str, optional): the jid of the transport
+            fleet (str, optional): the fleet of the transport
+            need (float, optional): the kilometers of autonomy the transport needs to charge
+
+        Returns:
+            bool: whether the place was assigned (False if the charge overlaps the bookings of the calendar)
         """
+        if transport_id is not None:
+            # the charge occupies the calendar (in the booked place if the transport booked one)
+            now, duration = time.time(), self.charge_duration(need)
+            booking = self.calendar.booking(transport_id)
+            if booking is None or self.calendar.book(transport_id, now, duration, booking.place, exact=True) is None:
+                if self.calendar.book(transport_id, now, duration, exact=True) is None:
+                    logger.warning("Station {} has no place free of bookings for the charge of transport {}".format(
+                        self.name, transport_id))
+                    return False
+            self.charging[str(transport_id)] = fleet
         p = self.get_available_places()
         if p - 1 <= 0:
             self.set_status(BUSY_STATION)
         self.set_available_places(p - 1)
         logger.info("Station {} assigned place. Available places are now {}.".format(self.name,
                                                                                      self.get_available_places()))
+        await self.publish_availability()
+        return True
+
+    def enqueue(self, transport_id, need=None, fleet=None):
+        """
+        Adds a transport to the waiting queue of the station.
+
+        Args:
+            transport_id (str): the jid of the transport
+            need (float, optional): the kilometers of autonomy the transport needs to charge
+            fleet (str, optional): the fleet of the transport
+        """
+        # time statistics update
+        if len(self.waiting_list) == 0:
+            self.transports_in_queue_time = time.time()
+        self.waiting_list.push(str(transport_id), need, fleet)
+        self.update_queue_length()
+        if self.queue_length > self.max_queue_length:
+            self.max_queue_length = self.queue_length
+
+    def dequeue(self, transport_id=None, available_places=1, fits=None):
+        """
+        Takes the next transport of the waiting queue that may charge in a released place (or removes a transport
+        from the queue) and records the time it waited.
 
-    async def deassigning_place(self):
+        Args:
+            transport_id (str, optional): the transport to remove. If None the next transport is taken.
+            available_places (int): the places the next transport may take
+            fits (function, optional): whether the charge of a queue entry fits in the station now
+
+        Returns:
+            QueueEntry: the entry of the transport that left the queue, or None
+        """
+        if transport_id is None:
+            entry = self.waiting_list.pop(available_places, self.charging, fits)
+        else:
+            entry = self.waiting_list.remove(transport_id)
+        if entry is None:
+            return None
+        transport_id, waited = entry.transport, time.time() - entry.time
+        self.queue_times[transport_id] = self.queue_times.get(transport_id, 0.0) + waited
+        self.queued_transports += 1
+        if metrics.enabled:
+            metrics.observe("station_queue_seconds", waited, station=self.agent_id)
+        self.update_queue_length()
+        # time statistics update
+        if len(self.waiting_list) == 0:
+            self.empty_queue_time = time.time()
+            self.total_busy_time += self.empty_queue_time - self.transports_in_queue_time
+        return entry
+
+    def update_queue_length(self):
+        self.queue_length = len(self.waiting_list)
+        metrics.set("station_queue_length", self.queue_length, station=self.agent_id)
+
+    def queue_time_stats(self):
+        """
+        Returns the average and maximum time waited in the queue by the transports that waited in it.
+
+        Returns:
+            float, float: the average and maximum seconds
         """
-        Leave a space of the charging station, when the station has free spaces, the status will change to FREE_STATION
+        if not self.queue_times:
+            return 0.0, 0.0
+        return sum(self.queue_times.values()) / self.queued_transports, max(self.queue_times.values())
+
+    async def deassigning_place(self, transport_id=None):
+        """
+        Leave a space of the charging station, when the station has free spaces, the status will change to FREE_STATION.
+        The place is given to the next transport of the queue that may use it. A transport that leaves the queue
+        before charging, or that only had a booking, does not release any place.
+
+        Args:
+            transport_id (str, optional): the jid of the transport that leaves the station
         """
-        if self.waiting_list:
-            transport_id = self.waiting_list.pop(0)
-            # time statistics update
-            if len(self.waiting_list) == 0:
-                self.empty_queue_time = time.time()
-                self.total_busy_time += self.empty_queue_time - self.transports_in_queue_time
+        if transport_id is not None:
+            transport_id = str(transport_id)
+            self.calendar.cancel(transport_id)
+            if transport_id in self.waiting_list:
+                self.dequeue(transport_id)
+            if transport_id not in self.charging:
+                await self.publish_availability()
+                return
+            self.charging.pop(transport_id)
+        p = self.get_available_places()
+        if p + 1:
+            self.set_status(FREE_STATION)
+        self.set_available_places(p + 1)
+        await self.serve_queue()
+        await self.publish_availability()
 
-            logger.debug("Station {} has a place to charge transport {}".format(self.agent_id, transport_id))
+    async def serve_queue(self):
+        """
+        Gives the available places that are not held by a booking to the next transports of the queue whose charge
+        ends before the places are booked by other transports.
+        """
+        while self.waiting_list:
+            now = time.time()
+            entry = self.dequeue(available_places=self.get_available_places() - self.held_places(now),
+                                 fits=lambda entry: self.charge_fits(entry.transport, entry.need, now))
+            if entry is None:
+                break
+            if not await self.assigning_place(entry.transport, entry.fleet, entry.need):
+                self.enqueue(entry.transport, entry.need, entry.fleet)
+                break
+            logger.debug("Station {} has a place to charge transport {}".format(self.agent_id, entry.transport))
             # confirm EXPLICITLY to transport it can start charging
             reply = Message()
-            reply.to = str(transport_id)
+            reply.to = entry.transport
             reply.set_metadata("protocol", REQUEST_PROTOCOL)
             reply.set_metadata("performative", ACCEPT_PERFORMATIVE)
             content = {
@@ -225,25 +514,73 @@ class StationAgent(Agent):
             }
             reply.body = json.dumps(content)
             await self.send(reply)
-            # await send_confirmation_to_transport(transport_id)
 
-        else:
-            p = self.get_available_places()
-            if p + 1:
-                self.set_status(FREE_STATION)
-            self.set_available_places(p + 1)
-
-    async def charging_transport(self, need, transport_id):
-        total_time = need / self.get_power()
-        now = datetime.datetime.now()
-        start_at = now + datetime.timedelta(seconds=total_time)
-        logger.info(
-            "Station {} started charging transport {} for {} seconds. From {} to {}.".format(self.name, transport_id,
-                                                                                             total_time, now, start_at))
+    async def charging_transport(self, need, transport_id, level=None, capacity=None, max_rate=None):
+        """
+        Starts charging a transport. The end of the charge is computed with the charging model of the station and the
+        charges in progress are rescheduled if the transport changes the power they get.
+
+        Args:
+            need (float): the kilometers of autonomy the transport needs to charge
+            transport_id (str): the jid of the transport
+            level (float, optional): the autonomy of the transport (0 if unknown)
+            capacity (float, optional): the maximum autonomy of the transport (``level + need`` if unknown)
+            max_rate (float, optional): the maximum charge rate of the transport
+        """
+        level = level or 0.0
+        capacity = capacity or level + need
+        session = ChargingSession(str(transport_id), level, level + need, capacity, max_rate)
+        self.sessions[session.transport] = session
+        self.reschedule_charges()
+        if math.isfinite(session.end):
+            logger.info("Station {} started charging transport {} for {} seconds. From {} to {}.".format(
+                self.name, transport_id, session.end - time.time(), datetime.datetime.now(),
+                datetime.datetime.fromtimestamp(session.end)))
         # charged transports update
         self.charged_transports += 1
-        charge_behaviour = ChargeBehaviour(start_at=start_at, transport_id=transport_id)
-        self.add_behaviour(charge_behaviour)
+        metrics.inc("charges_total")
+        log_event(CHARGE_START, self.name, transport_id, self.get_position())
+
+    def charge_powers(self):
+        """
+        Returns the power every charge in progress gets: the power of the station (or an equal share of it if it is
+        shared) limited by the maximum charge rate of the transport.
+
+        Returns:
+            dict: the power of every charge by transport
+        """
+        sessions = list(self.sessions.values())
+        if self.shared_power:
+            powers = share_power(self.get_power(), [session.max_rate for session in sessions])
+        else:
+            powers = [self.get_power() if session.max_rate is None else min(self.get_power(), session.max_rate)
+                      for session in sessions]
+        return {session.transport: power for session, power in zip(sessions, powers)}
+
+    def reschedule_charges(self):
+        """
+        Schedules the end of the charges whose power changed (or that have no end yet). The level of their batteries
+        is updated to the current time with the power they had, so only the charges affected by a change are touched.
+        """
+        now = time.time()
+        for transport_id, power in self.charge_powers().items():
+            session = self.sessions[transport_id]
+            if power == session.power and (session.behaviour is not None or power <= 0):
+                continue
+            session.advance(self.charging_model, now)
+            session.power = power
+            session.end = now + self.charging_model.duration(session.level, session.target, session.capacity, power)
+            if session.behaviour is not None and self.has_behaviour(session.behaviour):
+                self.remove_behaviour(session.behaviour)
+                if metrics.enabled:
+                    metrics.inc("charge_reschedules_total", station=self.agent_id)
+            session.behaviour = None
+            if power <= 0:  # the charge makes no progress until it gets some power
+                logger.warning("Station {} has no power to charge transport {}".format(self.name, transport_id))
+                continue
+            start_at = datetime.datetime.now() + datetime.timedelta(seconds=session.end - now)
+            session.behaviour = ChargeBehaviour(start_at=start_at, transport_id=transport_id)
+            self.add_behaviour(session.behaviour)
 
 
 class ChargeBehaviour(TimeoutBehaviour):
@@ -265,9 +602,22 @@ class ChargeBehaviour(TimeoutBehaviour):
 
     async def run(self):
         logger.debug("Station {} finished charging.".format(self.agent.name))
+        log_event(CHARGE_END, self.agent.name, self.transport_id, self.agent.get_position())
         self.set("current_station", None)
-        await self.agent.deassigning_place()
+        self.agent.sessions.pop(str(self.transport_id), None)
+        await self.agent.deassigning_place(self.transport_id)
         await self.charging_complete()
+        self.agent.reschedule_charges()
+
+
+class ServeQueueBehaviour(TimeoutBehaviour):
+    """
+    Gives the places of the station to the queued transports once the booked windows that kept them waiting end.
+    """
+
+    async def run(self):
+        await self.agent.serve_queue()
+        await self.agent.publish_availability()
 
 
 class RegistrationBehaviour(CyclicBehaviour):
@@ -290,6 +640,8 @@ class RegistrationBehaviour(CyclicBehaviour):
             "position": self.agent.get_position(),
             "charge": self.agent.power
         }
+        content.update(self.agent.availability())
+        self.agent.published_availability = self.agent.availability()
         msg = Message()
         msg.to = str(self.agent.directory_id)
         msg.set_metadata("protocol", REGISTER_PROTOCOL)
@@ -339,7 +691,8 @@ class TravelBehaviour(CyclicBehaviour):
                     # logger.info("Transport {} in station {}.".format(msg.sender.localpart, self.agent.name))
                     logger.info(
                         "Station {} is going to start charging transport {}".format(self.agent.name, transport_id))
-                    await self.agent.charging_transport(content["need"], transport_id)
+                    await self.agent.charging_transport(content["need"], transport_id, content.get("autonomy"),
+                                                        content.get("max_autonomy"), content.get("max_rate"))
         except CancelledError:
             logger.debug("Cancelling async tasks...")
         except Exception as e:
@@ -378,6 +731,24 @@ class StationStrategyBehaviour(StrategyBehaviour):
         await self.send(reply)
         logger.debug("Station {} accepted proposal for charge from transport {}".format(self.agent.name, transport_id))
 
+    async def send_reservation(self, transport_id, booking):
+        """
+        Sends a ``spade.message.Message`` to a transport with the window booked for it (or None if it could not be
+        booked). It uses the REQUEST_PROTOCOL and the RESERVE_PERFORMATIVE.
+
+        Args:
+            transport_id (str): The Agent JID of the transport
+            booking (Booking): the booked window
+        """
+        reply = Message()
+        reply.to = str(transport_id)
+        reply.set_metadata("protocol", REQUEST_PROTOCOL)
+        reply.set_metadata("performative", RESERVE_PERFORMATIVE)
+        reservation = {"place": booking.place, "start": booking.start, "end": booking.end} if booking else None
+        reply.body = json.dumps({"station_id": str(self.agent.jid), "reservation": reservation})
+        await self.send(reply)
+        await self.agent.publish_availability()
+
     async def refuse_transport(self, transport_id):
         """
         Sends an ``spade.message.Message`` to a transport to refuse a travel proposal for charge.
@@ -404,9 +775,12 @@ class StationStrategyBehaviour(StrategyBehaviour):
             transport_id = msg.sender
             if performative == CANCEL_PERFORMATIVE:
                 logger.warning("Station {} received a CANCEL from Transport {}.".format(self.agent.name, transport_id))
-                await self.agent.deassigning_place()
+                await self.agent.deassigning_place(transport_id)
             elif performative == ACCEPT_PERFORMATIVE:  # comes from send_confirmation_travel
-                if self.agent.get_status() == FREE_STATION:
+                content = json.loads(msg.body) if msg.body else {}
+                fleet, need = content.get("fleet"), content.get("need")
+                if self.agent.can_start_charging(transport_id, need, fleet) and \
+                        await self.agent.assigning_place(transport_id, fleet, need):
                     logger.info("Station {} has a place to charge transport {}".format(self.agent.name, transport_id))
                     # confirm EXPLICITLY to transport it can start charging
                     reply = Message()
@@ -418,18 +792,19 @@ class StationStrategyBehaviour(StrategyBehaviour):
                     }
                     reply.body = json.dumps(content)
                     await self.send(reply)
-                    await self.agent.assigning_place()
-                    # self.agent.assigning_place()
-
-                else:  # self.agent.get_status() == BUSY_STATION
-                    # time statistics update
-                    if len(self.agent.waiting_list) == 0:
-                        self.agent.transports_in_queue_time = time.time()
-                    # transport waits in a waiting_list until it is available to charge
-                    self.agent.waiting_list.append(str(transport_id))
-                    # list length statistics update
-                    self.agent.queue_length = len(self.agent.waiting_list)
-                    if self.agent.queue_length > self.agent.max_queue_length:
-                        self.agent.max_queue_length = self.agent.queue_length
-                    logger.info("{} is waiting at {}, whose waiting list is {}".format(transport_id, self.agent.name,
-                                                                                       self.agent.waiting_list))
+
+                else:  # no place for the transport (BUSY_STATION, reserved or booked places)
+                    # transport waits in the queue until it is available to charge
+                    self.agent.enqueue(transport_id, need, fleet)
+                    logger.info("{} is waiting at {}, whose queue has {} transports".format(
+                        transport_id, self.agent.name, self.agent.queue_length))
+                    if self.agent.get_available_places() > 0:  # the free places are booked: retry when they end
+                        now = time.time()
+                        start, _ = self.agent.calendar.earliest(now, self.agent.charge_duration(need))
+                        start_at = datetime.datetime.now() + datetime.timedelta(seconds=max(start - now, 1))
+                        self.agent.add_behaviour(ServeQueueBehaviour(start_at=start_at))
+                    await self.agent.publish_availability()
+            elif performative == RESERVE_PERFORMATIVE:
+                content = json.loads(msg.body)
+                booking = self.agent.reserve(transport_id, content["start"], content["duration"])
+                await self.send_reservation(transport_id, booking)
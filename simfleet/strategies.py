@@ -4,14 +4,17 @@ from loguru import logger
 
 from .customer import CustomerStrategyBehaviour
 from .fleetmanager import FleetManagerStrategyBehaviour
-from .helpers import PathRequestException, distance_in_meters
+from .helpers import PathRequestException, AlreadyInDestination
 from .protocol import REQUEST_PERFORMATIVE, ACCEPT_PERFORMATIVE, REFUSE_PERFORMATIVE, PROPOSE_PERFORMATIVE, \
-    CANCEL_PERFORMATIVE, INFORM_PERFORMATIVE, QUERY_PROTOCOL, REQUEST_PROTOCOL
+    CANCEL_PERFORMATIVE, INFORM_PERFORMATIVE, QUERY_PROTOCOL, REQUEST_PROTOCOL, UPDATE_PERFORMATIVE, \
+    CHARGE_PERFORMATIVE, REBALANCE_PERFORMATIVE
 from .transport import TransportStrategyBehaviour
 from .utils import TRANSPORT_WAITING, TRANSPORT_WAITING_FOR_APPROVAL, CUSTOMER_WAITING, TRANSPORT_MOVING_TO_CUSTOMER, \
     CUSTOMER_ASSIGNED, TRANSPORT_MOVING_TO_STATION, \
     TRANSPORT_CHARGING, TRANSPORT_CHARGED, TRANSPORT_NEEDS_CHARGING, TRANSPORT_IN_STATION_PLACE
 
+STATIONS_QUERY_LIMIT = 5  # closest stations asked to the directory when a transport needs charging
+
 
 ################################################################
 #                                                              #
@@ -30,6 +33,7 @@ class DelegateRequestBehaviour(FleetManagerStrategyBehaviour):
         msg = await self.receive(timeout=5)
         logger.debug("Manager received message: {}".format(msg))
         if msg:
+            self.agent.record_request(json.loads(msg.body))
             for transport in self.get_transport_agents().values():
                 msg.to = str(transport["jid"])
                 logger.debug("Manager sent request to transport {}".format(transport["name"]))
@@ -50,24 +54,13 @@ class AcceptAlwaysStrategyBehaviour(TransportStrategyBehaviour):
         if self.agent.needs_charging():
             if self.agent.stations is None or len(self.agent.stations) < 1:
                 logger.warning("Transport {} looking for a station.".format(self.agent.name))
-                await self.send_get_stations()
+                await self.send_get_stations(limit=STATIONS_QUERY_LIMIT)
             else:
-                # choice of closest station
-                station_positions = []
-                for key in self.agent.stations.keys():
-                    dic = self.agent.stations.get(key)
-                    station_positions.append((dic['jid'], dic['position']))
-                closest_station = min(station_positions,
-                                      key=lambda x: distance_in_meters(x[1], self.agent.get_position()))
-                # closest_station = min( station_positions, key = lambda x: request_route_to_server(x[1], self.agent.get_position(), "http://osrm.gti-ia.upv.es/")[1])
-
-                # closest_station = min( list(self.agent.stations), key = lambda x: distance_in_meters( x['position'], self.agent.get_position() ) )
-                logger.info("Closest station {}".format(closest_station))
-                station = closest_station[0]
-
-                # station = random.choice(list(self.agent.stations.keys()))
+                # choice of the station where charging would start first (travel time plus expected wait)
+                station = self.choose_station()
                 position = self.agent.stations[station]["position"]
                 logger.info("Transport {} selected station {}.".format(self.agent.name, station))
+                self.agent.stations = None  # the next charge asks for the stations closest to where it is then
 
                 try:
                     # transport moves to selected station
@@ -99,6 +92,8 @@ class AcceptAlwaysStrategyBehaviour(TransportStrategyBehaviour):
             if performative == INFORM_PERFORMATIVE:
                 self.agent.stations = content
                 logger.info("Got list of current stations: {}".format(list(self.agent.stations.keys())))
+            elif performative == UPDATE_PERFORMATIVE:
+                self.agent.update_stations(content)
             elif performative == CANCEL_PERFORMATIVE:
                 logger.info("Cancellation of request for stations information.")
 
@@ -113,9 +108,17 @@ class AcceptAlwaysStrategyBehaviour(TransportStrategyBehaviour):
                     else:
                         await self.send_proposal(content["customer_id"], {})
                         self.agent.status = TRANSPORT_WAITING_FOR_APPROVAL
+                elif self.agent.can_add_customer(content["origin"], content["dest"]) and \
+                        self.has_enough_autonomy(content["origin"], content["dest"]):
+                    await self.send_proposal(content["customer_id"], {})
+                    self.agent.offers.add(content["customer_id"])
 
             elif performative == ACCEPT_PERFORMATIVE:
-                if self.agent.status == TRANSPORT_WAITING_FOR_APPROVAL:
+                if content.get("customer_id") in self.agent.offers:  # a customer proposed while busy
+                    self.agent.offers.discard(content["customer_id"])
+                    if not await self.add_customer(content["customer_id"], content["origin"], content["dest"]):
+                        await self.cancel_proposal(content["customer_id"])
+                elif self.agent.status == TRANSPORT_WAITING_FOR_APPROVAL:
                     logger.debug("Transport {} got accept from {}".format(self.agent.name,
                                                                           content["customer_id"]))
                     try:
@@ -128,6 +131,7 @@ class AcceptAlwaysStrategyBehaviour(TransportStrategyBehaviour):
                         await self.cancel_proposal(content["customer_id"])
                     except Exception as e:
                         logger.error("Unexpected error in transport {}: {}".format(self.agent.name, e))
+                        self.agent.remove_job(content["customer_id"])
                         await self.cancel_proposal(content["customer_id"])
                         self.agent.status = TRANSPORT_WAITING
                 elif self.agent.status == TRANSPORT_IN_STATION_PLACE:
@@ -143,7 +147,10 @@ class AcceptAlwaysStrategyBehaviour(TransportStrategyBehaviour):
 
             elif performative == REFUSE_PERFORMATIVE:
                 logger.debug("Transport {} got refusal from customer/station".format(self.agent.name))
-                self.agent.status = TRANSPORT_WAITING
+                if content.get("customer_id") in self.agent.offers:
+                    self.agent.offers.discard(content["customer_id"])
+                else:
+                    self.agent.status = TRANSPORT_WAITING
 
             elif performative == INFORM_PERFORMATIVE:
                 if self.agent.status == TRANSPORT_CHARGING:
@@ -152,7 +159,24 @@ class AcceptAlwaysStrategyBehaviour(TransportStrategyBehaviour):
                         await self.agent.drop_station()
 
             elif performative == CANCEL_PERFORMATIVE:
-                logger.info("Cancellation of request for {} information".format(self.agent.fleet_type))
+                if content.get("customer_id") is not None:  # a customer cancels its trip
+                    self.agent.offers.discard(content["customer_id"])
+                    await self.agent.cancel_job(content["customer_id"])
+                else:
+                    logger.info("Cancellation of request for {} information".format(self.agent.fleet_type))
+
+            elif performative == CHARGE_PERFORMATIVE:  # the fleet manager sends the transport to charge
+                if self.agent.status == TRANSPORT_WAITING:
+                    logger.info("Transport {} was sent to charge by its fleet manager".format(self.agent.name))
+                    self.agent.status = TRANSPORT_NEEDS_CHARGING
+
+            elif performative == REBALANCE_PERFORMATIVE:  # the fleet manager moves the idle transport
+                if self.agent.status == TRANSPORT_WAITING and not self.agent.needs_charging():
+                    try:
+                        await self.agent.rebalance_to(content["position"])
+                    except (PathRequestException, AlreadyInDestination):
+                        logger.warning("Transport {} could not move to {}".format(self.agent.name,
+                                                                                  content["position"]))
 
 
 ################################################################
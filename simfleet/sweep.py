@@ -0,0 +1,248 @@
+"""
+Sweep module
+
+Runs variants of a scenario (a grid of config parameters) in a pool of processes and merges their results.
+Every variant runs headless in a fresh process with its own agent names, simulator JID and HTTP port, so several
+simulations can share the same XMPP server. All the variants share a route cache, so every route is only requested
+once to the route server.
+"""
+
+import contextlib
+import io
+import itertools
+import json
+import os
+import time
+import uuid
+from multiprocessing import get_context
+from pathlib import Path
+
+import pandas as pd
+from loguru import logger
+
+from .utils import unused_port
+
+SIZE_PARAMETERS = ["fleets", "transports", "customers", "stations"]
+
+
+def parse_param(value):
+    """
+    Parses a ``key=value1,value2`` parameter of the command line. Values are parsed as JSON when possible.
+
+    Examples:
+        >>> parse_param("transports=10,50")
+        ('transports', [10, 50])
+
+    Args:
+        value (str): the parameter
+
+    Returns:
+        str, list: the name of the parameter and its values
+    """
+    key, _, values = value.partition("=")
+    if not key or not values:
+        raise ValueError("parameter {} must be key=value1,value2,...".format(value))
+    result = []
+    for item in values.split(","):
+        try:
+            result.append(json.loads(item))
+        except ValueError:
+            result.append(item)
+    return key, result
+
+
+def expand_grid(grid):
+    """
+    Builds every combination of the values of a parameter grid.
+
+    Args:
+        grid (dict): a dict with a list of values for every parameter
+
+    Returns:
+        list: a list of dicts (one per combination)
+    """
+    keys = sorted(grid.keys())
+    return [dict(zip(keys, values)) for values in itertools.product(*(grid[key] for key in keys))]
+
+
+def apply_params(config, params):
+    """
+    Overrides the fields of a config with the parameters of a variant.
+    Integer values of ``fleets``, ``transports``, ``customers`` and ``stations`` keep only the first N agents of the
+    scenario instead of replacing the list. The transports of the fleets left out are reassigned to the remaining
+    fleets in turn (or dropped if no fleet remains).
+
+    Args:
+        config (SimfleetConfig): the config of the variant
+        params (dict): the parameters of the variant
+    """
+    values = dict(params)
+    for key in SIZE_PARAMETERS:
+        if isinstance(values.get(key), int):
+            values[key] = config[key][:values[key]]
+    if isinstance(params.get("fleets"), int):
+        values["transports"] = reassign_transports(values.get("transports", config["transports"]), values["fleets"])
+    config.update(values)
+
+
+def reassign_transports(transports, fleets):
+    """
+    Moves the transports whose fleet manager is not in ``fleets`` to the fleets of the list, in turn.
+
+    Args:
+        transports (list): the transports of the scenario
+        fleets (list): the remaining fleets
+
+    Returns:
+        list: the transports. Empty if there are no fleets
+    """
+    if not fleets:
+        return []
+    names = {fleet["name"] for fleet in fleets}
+    result = []
+    moved = 0
+    for transport in transports:
+        local, _, domain = transport["fleet"].partition("@")
+        if local not in names:
+            fleet = fleets[moved % len(fleets)]
+            moved += 1
+            transport = dict(transport, fleet="{}@{}".format(fleet["name"], domain),
+                             fleet_type=fleet.get("fleet_type", transport.get("fleet_type")))
+        result.append(transport)
+    return result
+
+
+def isolate_names(config, prefix):
+    """
+    Prefixes the names of all the agents of a config, so the JIDs of the variant do not collide with the ones of
+    other simulations running in the same XMPP server.
+
+    Args:
+        config (SimfleetConfig): the config of the variant
+        prefix (str): the prefix of the names
+    """
+    for key in SIZE_PARAMETERS:
+        config.update({key: [dict(agent, name=prefix + agent["name"]) for agent in config[key]]})
+    for transport in config["transports"]:
+        local, _, domain = transport["fleet"].partition("@")
+        transport["fleet"] = "{}{}@{}".format(prefix, local, domain)
+    config.directory_name = prefix + config.directory_name
+    config.route_name = prefix + config.route_name
+
+
+def run_variant(task):
+    """
+    Runs a variant of a sweep in the current process and returns its results.
+    This function is meant to be called in a fresh process (see ``run_sweep``).
+
+    Args:
+        task (tuple): the index of the variant, the scenario filename, the parameters of the variant and the settings
+                      of the sweep (``name``, ``max_time``, ``output_dir``, ``route_cache`` and ``resume``)
+
+    Returns:
+        dict: the parameters of the variant and its simulation results
+    """
+    index, scenario, params, settings = task
+    from spade import quit_spade
+
+    from .checkpoint import resume_config
+    from .config import SimfleetConfig
+    from .simulator import SimulatorAgent
+
+    logger.remove()
+
+    name = "{}_run{}".format(settings["name"], index)
+    row = dict({"run": index}, **{key: value if isinstance(value, (int, float, str)) else json.dumps(value)
+                                  for key, value in params.items()})
+    try:
+        config = SimfleetConfig(scenario, name, settings["max_time"], 0)
+        if settings["resume"]:
+            resume_config(config, settings["resume"])
+        apply_params(config, params)
+        isolate_names(config, name + "_")
+        config.simulation_name = name
+        if settings["max_time"]:
+            config.max_time = settings["max_time"]
+        if config.max_time is None:
+            raise ValueError("a sweep needs a max_time (in the scenario or with --max-time)")
+        config.headless = True
+        config.http_port = unused_port(config.http_ip)
+        config.route_cache = settings["route_cache"]
+        if config.event_log:
+            suffix = Path(config.event_log).suffix
+            config.event_log = str(Path(settings["output_dir"]) / "{}_events{}".format(name, suffix))
+        if config.checkpoint:
+            config.checkpoint = str(Path(settings["output_dir"]) / "{}_checkpoint.json.gz".format(name))
+
+        start = time.time()
+        simulator = SimulatorAgent(config=config, agentjid="simulator_{}@{}".format(name, config.host))
+        simulator.start().result()
+        simulator.run()
+        while not simulator.is_simulation_finished():
+            time.sleep(0.5)
+        with contextlib.redirect_stdout(io.StringIO()):
+            simulator.stop().result()
+        filename = str(Path(settings["output_dir"]) / "{}.json".format(name))
+        simulator.write_file(filename, "json")
+        quit_spade()
+
+        with open(filename) as f:
+            row.update(json.load(f)["simulation"])
+        row["Wall Time"] = time.time() - start
+        row["output"] = filename
+    except Exception as e:
+        logger.exception("EXCEPTION running sweep variant {}: {}".format(name, e))
+        row["error"] = str(e)
+    return row
+
+
+def run_sweep(scenario, grid, jobs=None, output_dir="sweep", max_time=None, route_cache=None, resume=None):
+    """
+    Runs all the variants of a parameter grid in a pool of processes.
+
+    Args:
+        scenario (str): the filename of the scenario
+        grid (dict): a dict with a list of values for every config parameter
+        jobs (int, optional): number of parallel processes. The number of CPUs if None
+        output_dir (str): directory where the results of every variant and the route cache are written
+        max_time (int, optional): maximum simulation time of every variant (overrides the scenario)
+        route_cache (str, optional): the route cache shared by the variants. ``routes.sqlite`` in output_dir if None
+        resume (str, optional): a checkpoint every variant is resumed from (its scenario replaces ``scenario``)
+
+    Returns:
+        pandas.DataFrame: a table with the parameters and the results of every variant
+    """
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    settings = {
+        "name": "sweep{}".format(uuid.uuid4().hex[:6]),
+        "max_time": max_time,
+        "output_dir": str(Path(output_dir).resolve()),
+        "route_cache": str(Path(route_cache or Path(output_dir) / "routes.sqlite").resolve()),
+        "resume": str(Path(resume).resolve()) if resume else None,
+    }
+    variants = expand_grid(grid)
+    jobs = min(jobs or os.cpu_count() or 1, max(len(variants), 1))
+    logger.info("Running {} variants of {} in {} processes.".format(len(variants), scenario or resume, jobs))
+
+    tasks = [(index, str(scenario) if scenario else None, params, settings) for index, params in enumerate(variants)]
+    rows = []
+    with get_context("spawn").Pool(processes=jobs, maxtasksperchild=1) as pool:
+        for row in pool.imap_unordered(run_variant, tasks):
+            logger.info("Variant {} finished{}.".format(row["run"], " with error" if "error" in row else ""))
+            rows.append(row)
+    return pd.DataFrame(rows).sort_values("run").reset_index(drop=True)
+
+
+def write_results(df, filename):
+    """
+    Writes the merged results of a sweep in CSV or JSON format (chosen by the extension of the filename).
+
+    Args:
+        df (pandas.DataFrame): the results returned by ``run_sweep``
+        filename (str): name of the output file
+    """
+    if filename.endswith(".json"):
+        with open(filename, "w") as f:
+            json.dump(json.loads(df.to_json(orient="records")), f, indent=4)
+    else:
+        df.to_csv(filename, index=False)
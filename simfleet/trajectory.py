@@ -0,0 +1,224 @@
+"""
+Trajectory module
+
+A compact, time-indexed file with the positions of the transports of a simulation, used to play back a finished
+simulation in the browser (see ``simfleet playback``) without running it again.
+
+The positions of all the transports are sampled every ``interval`` seconds (a tick). Every tick is a binary frame:
+a key frame has the absolute positions of all the transports and a delta frame has only the transports that moved or
+changed their status since the previous tick, as differences of their coordinates. Coordinates are stored as integers
+in millionths of a degree. A key frame is written every ``keyframe_every`` ticks, so a player can seek to any tick by
+reading only the segment of the file that starts at the previous key frame (with a HTTP range request).
+
+Binary layout (little endian). The file starts with ``MAGIC`` followed by frames::
+
+    frame:        type (uint8), tick (uint32), number of records (uint32), records
+    key record:   transport (uint32), latitude (int32), longitude (int32), status (uint8)
+    delta record: transport (uint32), latitude delta (int16), longitude delta (int16), status (uint8)
+
+The names of the transports and statuses (indexes of the records), the ticks and the offsets of the key frames are
+written in a JSON index next to the file (``<filename>.json``).
+"""
+
+import json
+import struct
+from pathlib import Path
+
+from aiohttp import web as aioweb
+from loguru import logger
+
+MAGIC = b"SFTRAJ2\n"
+KEY_FRAME = 0
+DELTA_FRAME = 1
+SCALE = 1e6
+
+FRAME = struct.Struct("<BII")
+KEY_RECORD = struct.Struct("<IiiB")
+DELTA_RECORD = struct.Struct("<IhhB")
+MAX_DELTA = 2 ** 15 - 1
+
+TEMPLATES_PATH = Path(__file__).resolve().parent / "templates"
+
+
+def index_filename(filename):
+    return str(filename) + ".json"
+
+
+class TrajectoryWriter(object):
+    """
+    Writes the positions of the transports of a simulation tick by tick.
+    """
+
+    def __init__(self, filename, interval=1.0, keyframe_every=60):
+        """
+        Args:
+            filename (str): the trajectory file. Its index is written in ``<filename>.json`` when it is closed
+            interval (float): seconds between ticks
+            keyframe_every (int): number of ticks between key frames
+        """
+        self.filename = filename
+        self.interval = interval
+        self.keyframe_every = keyframe_every
+        self.names = []
+        self.statuses = []
+        self._transports = {}
+        self._statuses = {}
+        self.last = {}
+        self.keyframes = []
+        self.ticks = 0
+        self.file = open(filename, "wb")
+        self.file.write(MAGIC)
+
+    def _transport(self, name):
+        if name not in self._transports:
+            self._transports[name] = len(self.names)
+            self.names.append(name)
+        return self._transports[name]
+
+    def _status(self, status):
+        if status not in self._statuses:
+            self._statuses[status] = len(self.statuses)
+            self.statuses.append(status)
+        return self._statuses[status]
+
+    def write_tick(self, transports):
+        """
+        Writes the positions of the transports in the next tick.
+
+        Args:
+            transports (list): a tuple (name, position, status) for every transport. Position is [latitude, longitude]
+        """
+        current = {}
+        for name, position, status in transports:
+            if position:
+                current[self._transport(name)] = (int(round(position[0] * SCALE)), int(round(position[1] * SCALE)),
+                                                  self._status(status))
+        changed = {index: value for index, value in current.items() if self.last.get(index) != value}
+        last = self.last
+        is_key = self.ticks % self.keyframe_every == 0 or any(
+            index not in last or max(abs(value[0] - last[index][0]), abs(value[1] - last[index][1])) > MAX_DELTA
+            for index, value in changed.items())
+        if is_key:
+            self.keyframes.append([self.ticks, self.file.tell()])
+            records = [KEY_RECORD.pack(index, lat, lon, status) for index, (lat, lon, status) in current.items()]
+        else:
+            records = [DELTA_RECORD.pack(index, lat - self.last[index][0], lon - self.last[index][1], status)
+                       for index, (lat, lon, status) in changed.items()]
+        self.file.write(FRAME.pack(KEY_FRAME if is_key else DELTA_FRAME, self.ticks, len(records)))
+        self.file.write(b"".join(records))
+        self.last.update(current)
+        self.ticks += 1
+
+    def index(self):
+        """
+        Returns the index of the trajectory written so far. The data written so far is flushed to the file.
+
+        Returns:
+            dict: the interval, transports, statuses, ticks, key frames (tick and offset) and size of the file
+        """
+        self.file.flush()
+        return {
+            "version": 2,
+            "interval": self.interval,
+            "scale": SCALE,
+            "transports": self.names,
+            "statuses": self.statuses,
+            "ticks": self.ticks,
+            "keyframes": self.keyframes,
+            "size": self.file.tell()
+        }
+
+    def close(self):
+        index = self.index()
+        self.file.close()
+        with open(index_filename(self.filename), "w") as f:
+            json.dump(index, f)
+        logger.info("Trajectory of {} ticks written to {}".format(self.ticks, self.filename))
+
+
+def read_trajectory(filename):
+    """
+    Reads a trajectory file and yields the positions of the transports in every tick.
+
+    Args:
+        filename (str): the trajectory file (its index must exist)
+
+    Yields:
+        int, dict: the tick and a dict with the position [latitude, longitude] and status of every transport
+    """
+    with open(index_filename(filename)) as f:
+        index = json.load(f)
+    with open(filename, "rb") as f:
+        data = f.read()
+    if not data.startswith(MAGIC):
+        raise ValueError("{} is not a trajectory file".format(filename))
+    offset = len(MAGIC)
+    positions = {}
+    while offset < len(data):
+        kind, tick, count = FRAME.unpack_from(data, offset)
+        offset += FRAME.size
+        record = KEY_RECORD if kind == KEY_FRAME else DELTA_RECORD
+        for _ in range(count):
+            transport, lat, lon, status = record.unpack_from(data, offset)
+            offset += record.size
+            if kind == DELTA_FRAME:
+                lat += positions[transport][0]
+                lon += positions[transport][1]
+            positions[transport] = (lat, lon, status)
+        yield tick, {index["transports"][transport]: {"position": [lat / SCALE, lon / SCALE],
+                                                      "status": index["statuses"][status]}
+                     for transport, (lat, lon, status) in positions.items()}
+
+
+def playback_routes(filename, get_writer=None):
+    """
+    Builds the web controllers of the playback of a trajectory file:
+
+        * ``/playback``: the playback page
+        * ``/playback/index``: the index of the trajectory (JSON)
+        * ``/playback/data``: the trajectory file (supports range requests)
+
+    Args:
+        filename (str): the trajectory file
+        get_writer (function, optional): returns the writer of the file while it is being written (or None)
+
+    Returns:
+        list: a list of (path, controller) tuples. Controllers return ``aiohttp.web.Response`` objects
+    """
+
+    async def page_controller(request):
+        return aioweb.FileResponse(TEMPLATES_PATH / "playback.html")
+
+    async def index_controller(request):
+        writer = get_writer() if get_writer else None
+        if writer is not None:
+            return aioweb.json_response(writer.index())
+        try:
+            with open(index_filename(filename)) as f:
+                return aioweb.json_response(json.load(f))
+        except FileNotFoundError:
+            raise aioweb.HTTPNotFound(text="Trajectory index {} not found".format(index_filename(filename)))
+
+    async def data_controller(request):
+        if not Path(filename).exists():
+            raise aioweb.HTTPNotFound(text="Trajectory {} not found".format(filename))
+        return aioweb.FileResponse(filename)
+
+    return [("/playback", page_controller), ("/playback/index", index_controller), ("/playback/data", data_controller)]
+
+
+def run_playback_server(filename, host="127.0.0.1", port=9000):
+    """
+    Serves the playback of a trajectory file until it is interrupted.
+
+    Args:
+        filename (str): the trajectory file
+        host (str): the IP of the web server
+        port (int): the port of the web server
+    """
+    app = aioweb.Application()
+    for path, controller in playback_routes(filename):
+        app.router.add_get(path, controller)
+    app.router.add_static("/assets", str(TEMPLATES_PATH / "assets"))
+    logger.info("Playback of {} running at http://{}:{}/playback".format(filename, host, port))
+    aioweb.run_app(app, host=host, port=port, print=None)
@@ -10,21 +10,29 @@ from spade.behaviour import PeriodicBehaviour, CyclicBehaviour
 from spade.message import Message
 from spade.template import Template
 
+from .energy import create_energy_model, fleet as fleet_energy
+from .eventlog import DROPOFF, PROPOSAL, log_event
 from .helpers import random_position, distance_in_meters, kmh_to_ms, PathRequestException, \
     AlreadyInDestination
+from .metrics import InstrumentedAgentMixin, registry as metrics
+from .pooling import Itinerary, PICKUP
 from .protocol import REQUEST_PROTOCOL, TRAVEL_PROTOCOL, PROPOSE_PERFORMATIVE, CANCEL_PERFORMATIVE, INFORM_PERFORMATIVE, \
     REGISTER_PROTOCOL, REQUEST_PERFORMATIVE, \
-    ACCEPT_PERFORMATIVE, REFUSE_PERFORMATIVE, QUERY_PROTOCOL
+    ACCEPT_PERFORMATIVE, REFUSE_PERFORMATIVE, QUERY_PROTOCOL, SUBSCRIBE_PERFORMATIVE, UNSUBSCRIBE_PERFORMATIVE, \
+    RESERVE_PERFORMATIVE
+from .rebalancing import fleet as fleet_positions
+from .replay import ReplayAgentMixin
+from .reservations import SlotCalendar
 from .utils import TRANSPORT_WAITING, TRANSPORT_MOVING_TO_CUSTOMER, TRANSPORT_IN_CUSTOMER_PLACE, \
     TRANSPORT_MOVING_TO_DESTINATION, TRANSPORT_IN_STATION_PLACE, TRANSPORT_CHARGING, \
     CUSTOMER_IN_DEST, CUSTOMER_LOCATION, TRANSPORT_MOVING_TO_STATION, chunk_path, request_path, StrategyBehaviour, \
-    TRANSPORT_NEEDS_CHARGING
+    TRANSPORT_NEEDS_CHARGING, status_to_str
 
 MIN_AUTONOMY = 2
 ONESECOND_IN_MS = 1000
 
 
-class TransportAgent(Agent):
+class TransportAgent(ReplayAgentMixin, InstrumentedAgentMixin, Agent):
     def __init__(self, agentjid, password):
         super().__init__(agentjid, password)
 
@@ -35,12 +43,16 @@ class TransportAgent(Agent):
 
         self.__observers = defaultdict(list)
         self.agent_id = None
+        self.position_index = fleet_positions.register(str(self.jid))  # position in the fleet arrays
+        self._status = None
         self.status = TRANSPORT_WAITING
         self.icon = None
         self.set("current_pos", None)
         self.dest = None
         self.set("path", None)
         self.chunked_path = None
+        self.moving_behaviour = None
+        self.rebalancing = False  # whether the transport is moving idle to a cell with more demand
         self.set("speed_in_kmh", 3000)
         self.animation_speed = ONESECOND_IN_MS
         self.distances = []
@@ -50,7 +62,12 @@ class TransportAgent(Agent):
         self.current_customer_orig = None
         self.current_customer_dest = None
         self.set("customer_in_transport", None)
+        self.itinerary = Itinerary()  # the pickups and dropoffs of the customers of the transport
+        self.offers = set()  # customers that got a proposal while the transport was busy
+        self.prefetched_routes = {}  # the routes requested in the background, by origin and destination
         self.num_assignments = 0
+        self.shared_trips = 0
+        self.trip_shared = False  # whether the transport carried several customers at once since it was free
         self.stopped = False
         self.ready = False
         self.registration = False
@@ -61,11 +78,14 @@ class TransportAgent(Agent):
 
         self.request = "station"
         self.stations = None
-        self.current_autonomy_km = 2000
-        self.max_autonomy_km = 2000
+        self.energy_index = fleet_energy.register(str(self.jid), 2000, 2000)  # autonomy in the fleet arrays
+        self.energy_model = create_energy_model()
+        self.step_energy = 0.0  # km of autonomy consumed by every step of the current path
+        self.max_charge_rate = None  # the maximum charge rate (km of autonomy per second) or None if unlimited
         self.num_charges = 0
         self.set("current_station", None)
         self.current_station_dest = None
+        self.reservation = None  # the charging window booked in a station
 
         # waiting time statistics
         self.waiting_in_queue_time = None
@@ -95,15 +115,42 @@ class TransportAgent(Agent):
 
         self.customer_in_transport_callback = customer_in_transport_callback
 
+    @property
+    def current_autonomy_km(self):
+        return float(fleet_energy.level[self.energy_index])
+
+    @current_autonomy_km.setter
+    def current_autonomy_km(self, autonomy):
+        fleet_energy.level[self.energy_index] = autonomy
+
+    @property
+    def max_autonomy_km(self):
+        return float(fleet_energy.capacity[self.energy_index])
+
+    @max_autonomy_km.setter
+    def max_autonomy_km(self, autonomy):
+        fleet_energy.capacity[self.energy_index] = autonomy
+
+    @property
+    def status(self):
+        return self._status
+
+    @status.setter
+    def status(self, status):
+        metrics.move("transports", status_to_str(self._status) if self._status else None, status_to_str(status))
+        self._status = status
+        fleet_positions.set_idle(self.position_index, status == TRANSPORT_WAITING)
+
     async def setup(self):
         try:
-            template = Template()
-            template.set_metadata("protocol", REGISTER_PROTOCOL)
-            register_behaviour = RegistrationBehaviour()
-            self.add_behaviour(register_behaviour, template)
-            while not self.has_behaviour(register_behaviour):
-                logger.warning("Transport {} could not create RegisterBehaviour. Retrying...".format(self.agent_id))
+            if not self.registration:  # transports of a warm start are already registered
+                template = Template()
+                template.set_metadata("protocol", REGISTER_PROTOCOL)
+                register_behaviour = RegistrationBehaviour()
                 self.add_behaviour(register_behaviour, template)
+                while not self.has_behaviour(register_behaviour):
+                    logger.warning("Transport {} could not create RegisterBehaviour. Retrying...".format(self.agent_id))
+                    self.add_behaviour(register_behaviour, template)
             self.ready = True
         except Exception as e:
             logger.error("EXCEPTION creating RegisterBehaviour in Transport {}: {}".format(self.agent_id, e))
@@ -111,6 +158,8 @@ class TransportAgent(Agent):
     def set(self, key, value):
         old = self.get(key)
         super().set(key, value)
+        if key == "current_pos":
+            fleet_positions.move(self.position_index, value)
         if key in self.__observers:
             for callback in self.__observers[key]:
                 callback(old, value)
@@ -177,6 +226,35 @@ class TransportAgent(Agent):
     def set_icon(self, icon):
         self.icon = icon
 
+    def update_stations(self, notification):
+        """
+        Applies an incremental notification of the directory to the known stations.
+
+        Args:
+            notification (dict): the ``added`` and ``updated`` stations (by jid) and the jids of the ``removed`` ones
+        """
+        if self.stations is None:
+            self.stations = {}
+        self.stations.update(notification.get("added", {}))
+        self.stations.update(notification.get("updated", {}))
+        for jid in notification.get("removed", []):
+            self.stations.pop(jid, None)
+
+    def set_reservation(self, content):
+        """
+        Stores the answer of a station to a booking request (see ``TransportStrategyBehaviour.reserve_station``).
+
+        Args:
+            content (dict): the ``station_id`` and the booked ``reservation`` (place, start and end), which is None if
+                the station could not book it
+        """
+        if content.get("reservation") is None:
+            logger.warning("Transport {} could not book a window in station {}".format(self.name,
+                                                                                       content.get("station_id")))
+            self.reservation = None
+        else:
+            self.reservation = dict(content["reservation"], station_id=content["station_id"])
+
     def set_fleetmanager(self, fleetmanager_id):
         """
         Sets the fleetmanager JID address
@@ -199,15 +277,6 @@ class TransportAgent(Agent):
         """
         self.route_host = route_host
 
-    async def send(self, msg):
-        if not msg.sender:
-            msg.sender = str(self.jid)
-            logger.debug(f"Adding agent's jid as sender to message: {msg}")
-        aioxmpp_msg = msg.prepare()
-        await self.client.send(aioxmpp_msg)
-        msg.sent = True
-        self.traces.append(msg, category=str(self))
-
     def is_customer_in_transport(self):
         return self.get("customer_in_transport") is not None
 
@@ -217,27 +286,107 @@ class TransportAgent(Agent):
     async def arrived_to_destination(self):
         """
         Informs that the transport has arrived to its destination.
-        It recomputes the new destination and path if picking up a customer
-        or drops it and goes to WAITING status again.
+        It picks up or drops the customer of the stop and goes to the next stop of its itinerary,
+        or goes to WAITING status again if there are no more stops.
         """
         self.set("path", None)
         self.chunked_path = None
-        if not self.is_customer_in_transport():  # self.status == TRANSPORT_MOVING_TO_CUSTOMER:
+        stop = self.itinerary.pop() if self.itinerary else None
+        if stop is not None and stop.kind == PICKUP:
+            self.set("customer_in_transport", stop.customer)
+            self.trip_shared = self.trip_shared or len(self.itinerary.onboard) > 1
+            await self.inform_customer(TRANSPORT_IN_CUSTOMER_PLACE, customer_id=stop.customer)
+            logger.info("Transport {} has picked up the customer {}.".format(self.agent_id, stop.customer))
+        elif stop is not None:
+            await self.drop_customer(stop.customer)
+        await self.go_to_next_stop()
+
+    async def go_to_next_stop(self):
+        """
+        Moves the transport to the next stop of its itinerary. The customers whose stop can not be reached are
+        cancelled. When the itinerary is over the transport goes to WAITING status again.
+        """
+        while self.itinerary:
+            stop = self.itinerary.next_stop
+            self.set("current_customer", stop.customer)
             try:
-                self.set("customer_in_transport", self.get("current_customer"))
-                await self.move_to(self.current_customer_dest)
+                await self.move_to(stop.position)
             except PathRequestException:
-                await self.cancel_customer()
-                self.status = TRANSPORT_WAITING
+                await self.cancel_customer(customer_id=stop.customer)
+                self.remove_job(stop.customer)
             except AlreadyInDestination:
-                await self.drop_customer()
+                await self.arrived_to_destination()
+                return
             else:
-                await self.inform_customer(TRANSPORT_IN_CUSTOMER_PLACE)
-                self.status = TRANSPORT_MOVING_TO_DESTINATION
-                logger.info("Transport {} has picked up the customer {}.".format(self.agent_id,
-                                                                                 self.get("current_customer")))
-        else:  # elif self.status == TRANSPORT_MOVING_TO_DESTINATION:
-            await self.drop_customer()
+                self.status = TRANSPORT_MOVING_TO_CUSTOMER if stop.kind == PICKUP else \
+                    TRANSPORT_MOVING_TO_DESTINATION
+                onboard = next(iter(self.itinerary.onboard), None)
+                if onboard != self.get("customer_in_transport"):
+                    self.set("customer_in_transport", onboard)
+                self.prefetch_next_leg()
+                return
+        self.discard_prefetched_routes()
+        if self.trip_shared:
+            self.shared_trips += 1
+            if metrics.enabled:
+                metrics.inc("shared_trips_total")
+            self.trip_shared = False
+        self.status = TRANSPORT_WAITING
+        self.set("current_customer", None)
+        self.set("customer_in_transport", None)
+
+    def remove_job(self, customer_id):
+        """
+        Removes the stops of a customer from the itinerary and cancels the routes to or from them that were requested
+        in the background.
+
+        Args:
+            customer_id (str): the jid of the customer
+        """
+        positions = [stop.position for stop in self.itinerary.stops if stop.customer == customer_id]
+        self.itinerary.remove(customer_id)
+        self.discard_prefetched_routes(positions)
+
+    async def cancel_job(self, customer_id):
+        """
+        Cancels the trip of a customer that has not been picked up yet. If the transport was going to pick it up, it
+        goes to its next stop (or stops and waits if there are no more stops).
+
+        Args:
+            customer_id (str): the jid of the customer
+
+        Returns:
+            bool: whether the trip was cancelled
+        """
+        if customer_id not in self.itinerary.customers() or customer_id in self.itinerary.onboard:
+            return False
+        was_next = self.itinerary.next_stop.customer == customer_id
+        self.remove_job(customer_id)
+        logger.info("Transport {} cancelled the trip of customer {}".format(self.agent_id, customer_id))
+        if was_next:
+            if not self.itinerary:  # stops where it is
+                self.set("path", None)
+                self.chunked_path = None
+                self.dest = self.get_position()
+            await self.go_to_next_stop()
+        return True
+
+    def can_add_customer(self, origin, dest):
+        """
+        Checks if a new customer can be added to the itinerary of the transport while it serves other customers
+        (sharing the transport or after them).
+
+        Args:
+            origin (list): the position of the customer
+            dest (list): the destination of the customer
+
+        Returns:
+            bool: whether the customer fits in the itinerary of the transport
+        """
+        if self.itinerary.capacity + self.itinerary.queued_jobs <= 1 or \
+                self.status not in [TRANSPORT_MOVING_TO_CUSTOMER, TRANSPORT_MOVING_TO_DESTINATION]:
+            return False
+        return self.itinerary.insertion(self.get_position(), origin, dest) is not None
 
     async def arrived_to_station(self, station_id=None):
         """
@@ -252,12 +401,25 @@ class TransportAgent(Agent):
                                                                                          self.get("current_station")))
         self.set("in_station_place", True)  # new
 
+    def charge_request(self):
+        """
+        Returns the content of the requests of a place to charge sent to a station, used by the queue of the station.
+
+        Returns:
+            dict: the kilometers of autonomy the transport needs to charge and its fleet
+        """
+        return {
+            "need": self.max_autonomy_km - self.current_autonomy_km,
+            "fleet": str(self.fleetmanager_id) if self.fleetmanager_id else None
+        }
+
     async def request_access_station(self):
 
         reply = Message()
         reply.to = self.get("current_station")
         reply.set_metadata("protocol", REQUEST_PROTOCOL)
         reply.set_metadata("performative", ACCEPT_PERFORMATIVE)
+        reply.body = json.dumps(self.charge_request())
         logger.debug("{} requesting access to {}".format(self.name, self.get("current_station"), reply.body))
         await self.send(reply)
 
@@ -280,7 +442,10 @@ class TransportAgent(Agent):
 
         data = {
             "status": TRANSPORT_IN_STATION_PLACE,
-            "need": self.max_autonomy_km - self.current_autonomy_km
+            "need": self.max_autonomy_km - self.current_autonomy_km,
+            "autonomy": self.current_autonomy_km,
+            "max_autonomy": self.max_autonomy_km,
+            "max_rate": self.max_charge_rate
         }
         logger.debug("Transport {} with autonomy {} tells {} that it needs to charge "
                      "{} km/autonomy".format(self.agent_id, self.current_autonomy_km, self.get("current_station"),
@@ -304,16 +469,17 @@ class TransportAgent(Agent):
         self.current_autonomy_km = self.max_autonomy_km
         self.total_charging_time += time.time() - self.charge_time
 
-    async def drop_customer(self):
+    async def drop_customer(self, customer_id=None):
         """
-        Drops the customer that the transport is carring in the current location.
+        Drops a customer that the transport is carrying in the current location.
+
+        Args:
+            customer_id (str, optional): the customer (the current customer by default)
         """
-        await self.inform_customer(CUSTOMER_IN_DEST)
-        self.status = TRANSPORT_WAITING
-        logger.debug("Transport {} has dropped the customer {} in destination.".format(self.agent_id,
-                                                                                       self.get("current_customer")))
-        self.set("current_customer", None)
-        self.set("customer_in_transport", None)
+        customer_id = customer_id or self.get("current_customer")
+        await self.inform_customer(CUSTOMER_IN_DEST, customer_id=customer_id)
+        log_event(DROPOFF, self.name, customer_id, self.get_position())
+        logger.debug("Transport {} has dropped the customer {} in destination.".format(self.agent_id, customer_id))
 
     async def drop_station(self):
         """
@@ -338,13 +504,9 @@ class TransportAgent(Agent):
         """
         if self.get("current_pos") == dest:
             raise AlreadyInDestination
-        counter = 5
-        path = None
-        distance, duration = 0, 0
-        while counter > 0 and path is None:
-            logger.debug("Requesting path from {} to {}".format(self.get("current_pos"), dest))
-            path, distance, duration = await self.request_path(self.get("current_pos"), dest)
-            counter -= 1
+        self.rebalancing = False  # a new destination replaces a rebalancing move
+        logger.debug("Requesting path from {} to {}".format(self.get("current_pos"), dest))
+        path, distance, duration = await self.fetch_route(self.get("current_pos"), dest)  # retried by the route policy
         if path is None:
             raise PathRequestException("Error requesting route.")
 
@@ -355,10 +517,29 @@ class TransportAgent(Agent):
             logger.error("Exception chunking path {}: {}".format(path, e))
             raise PathRequestException
         self.dest = dest
+        self.step_energy = self.energy_model.km(distance, self.get("speed_in_kmh")) / max(len(self.chunked_path), 1)
         self.distances.append(distance)
         self.durations.append(duration)
-        behav = self.MovingBehaviour(period=1)
-        self.add_behaviour(behav)
+        metrics.inc("distance_meters_total", distance)
+        if self.moving_behaviour is None or not self.has_behaviour(self.moving_behaviour):
+            self.moving_behaviour = self.MovingBehaviour(period=1)
+            self.add_behaviour(self.moving_behaviour)
+
+    async def rebalance_to(self, dest):
+        """
+        Moves the idle transport to a position with more demand. The transport keeps waiting for customers while it
+        moves and a new destination replaces the move.
+
+        Args:
+            dest (list): the coordinates of the new position
+
+        Raises:
+             AlreadyInDestination: if the transport is already in the position.
+             PathRequestException: if no route to the position was found.
+        """
+        await self.move_to(dest)
+        self.rebalancing = True
+        logger.debug("Transport {} rebalancing to {}".format(self.agent_id, dest))
 
     async def step(self):
         """
@@ -366,6 +547,7 @@ class TransportAgent(Agent):
         """
         if self.chunked_path:
             _next = self.chunked_path.pop(0)
+            fleet_energy.debit(self.energy_index, self.step_energy)
             distance = distance_in_meters(self.get_position(), _next)
             self.animation_speed = distance / kmh_to_ms(self.get("speed_in_kmh")) * ONESECOND_IN_MS
             await self.set_position(_next)
@@ -387,42 +569,43 @@ class TransportAgent(Agent):
         msg.body = json.dumps(data)
         await self.send(msg)
 
-    async def inform_customer(self, status, data=None):
+    async def inform_customer(self, status, data=None, customer_id=None):
         """
         Sends a message to the current assigned customer to inform her about a new status.
 
         Args:
             status (int): The new status code
             data (dict, optional): complementary info about the status
+            customer_id (str, optional): the customer to inform (the current customer by default)
         """
         if data is None:
             data = {}
         msg = Message()
-        msg.to = self.get("current_customer")
+        msg.to = customer_id or self.get("current_customer")
         msg.set_metadata("protocol", TRAVEL_PROTOCOL)
         msg.set_metadata("performative", INFORM_PERFORMATIVE)
         data["status"] = status
         msg.body = json.dumps(data)
         await self.send(msg)
 
-    async def cancel_customer(self, data=None):
+    async def cancel_customer(self, data=None, customer_id=None):
         """
         Sends a message to the current assigned customer to cancel the assignment.
 
         Args:
             data (dict, optional): Complementary info about the cancellation
+            customer_id (str, optional): the customer to cancel (the current customer by default)
         """
-        logger.error("Transport {} could not get a path to customer {}.".format(self.agent_id,
-                                                                                self.get("current_customer")))
+        customer_id = customer_id or self.get("current_customer")
+        logger.error("Transport {} could not get a path to customer {}.".format(self.agent_id, customer_id))
         if data is None:
             data = {}
         reply = Message()
-        reply.to = self.get("current_customer")
+        reply.to = customer_id
         reply.set_metadata("protocol", REQUEST_PROTOCOL)
         reply.set_metadata("performative", CANCEL_PERFORMATIVE)
         reply.body = json.dumps(data)
-        logger.debug("Transport {} sent cancel proposal to customer {}".format(self.agent_id,
-                                                                               self.get("current_customer")))
+        logger.debug("Transport {} sent cancel proposal to customer {}".format(self.agent_id, customer_id))
         await self.send(reply)
 
     async def request_path(self, origin, destination):
@@ -448,6 +631,60 @@ class TransportAgent(Agent):
         """
         return await request_path(self, origin, destination, self.route_host)
 
+    def prefetch_route(self, origin, dest):
+        """
+        Requests a route in the background, so it is ready when the transport moves (see :func:`fetch_route`).
+
+        Args:
+            origin (list): the coordinates of the origin of the route
+            dest (list): the coordinates of the destination of the route
+        """
+        key = (tuple(origin), tuple(dest))
+        if origin != dest and key not in self.prefetched_routes:
+            self.prefetched_routes[key] = asyncio.ensure_future(self.request_path(origin, dest))
+
+    def prefetch_next_leg(self):
+        """
+        Requests in the background the route from the stop the transport is going to to the following stop.
+        """
+        if len(self.itinerary) > 1:
+            self.prefetch_route(self.itinerary.stops[0].position, self.itinerary.stops[1].position)
+
+    def discard_prefetched_routes(self, positions=None):
+        """
+        Cancels the routes requested in the background.
+
+        Args:
+            positions (list, optional): cancel only the routes from or to these coordinates
+        """
+        points = None if positions is None else {tuple(position) for position in positions}
+        for key in list(self.prefetched_routes):
+            if points is None or key[0] in points or key[1] in points:
+                self.prefetched_routes.pop(key).cancel()
+
+    async def fetch_route(self, origin, dest):
+        """
+        Returns a route, from the prefetched routes if it was requested in the background.
+
+        Args:
+            origin (list): the coordinates of the origin of the route
+            dest (list): the coordinates of the destination of the route
+
+        Returns:
+            list, float, float: the path, its distance and its estimated duration (None if there was an error)
+        """
+        task = self.prefetched_routes.pop((tuple(origin), tuple(dest)), None)
+        if task is not None:
+            try:
+                route = await task
+            except CancelledError:
+                route = (None, None, None)
+            if route[0] is not None:
+                if metrics.enabled:
+                    metrics.inc("route_prefetch_hits_total")
+                return route
+        return await self.request_path(origin, dest)
+
     def set_initial_position(self, coords):
         self.set("current_pos", coords)
 
@@ -461,15 +698,19 @@ class TransportAgent(Agent):
         if coords:
             self.set("current_pos", coords)
         else:
-            self.set("current_pos", random_position())
+            self.set("current_pos", random_position(self.name))
 
         logger.debug("Transport {} position is {}".format(self.agent_id, self.get("current_pos")))
-        if self.status == TRANSPORT_MOVING_TO_DESTINATION:
-            await self.inform_customer(CUSTOMER_LOCATION, {"location": self.get("current_pos")})
+        for customer_id in self.itinerary.onboard:
+            await self.inform_customer(CUSTOMER_LOCATION, {"location": self.get("current_pos")}, customer_id)
         if self.is_in_destination():
             logger.info("Transport {} has arrived to destination. Status: {}".format(self.agent_id, self.status))
             if self.status == TRANSPORT_MOVING_TO_STATION:
                 await self.arrived_to_station()
+            elif self.rebalancing:
+                self.rebalancing = False
+                self.set("path", None)
+                self.chunked_path = None
             else:
                 await self.arrived_to_destination()
 
@@ -501,21 +742,72 @@ class TransportAgent(Agent):
         return self.dest == self.get_position()
 
     def set_km_expense(self, expense=0):
-        self.current_autonomy_km -= expense
+        fleet_energy.debit(self.energy_index, expense)
 
     def set_autonomy(self, autonomy, current_autonomy=None):
         self.max_autonomy_km = autonomy
         self.current_autonomy_km = current_autonomy if current_autonomy is not None else autonomy
 
+    def set_capacity(self, capacity=1, queued_jobs=0):
+        """
+        Sets the number of customers the transport can carry at once. Transports with more than one place accept new
+        customers while they serve other ones (see :mod:`simfleet.pooling`).
+
+        Args:
+            capacity (int): the number of places for customers
+            queued_jobs (int): the customers the transport accepts besides its capacity, served after the current ones
+        """
+        self.itinerary.capacity = capacity
+        self.itinerary.queued_jobs = queued_jobs
+
+    def set_max_charge_rate(self, max_charge_rate=None):
+        """
+        Sets the maximum charge rate of the transport (in km of autonomy per second, the units of the power of the
+        stations). Stations never charge the transport faster.
+
+        Args:
+            max_charge_rate (float, optional): the maximum charge rate or None if unlimited
+        """
+        self.max_charge_rate = max_charge_rate
+
+    def set_energy_model(self, config=None):
+        """
+        Sets the energy consumption of the transport. See :func:`simfleet.energy.create_energy_model`.
+
+        Args:
+            config (dict, optional): the parameters of the energy model
+        """
+        self.energy_model = create_energy_model(config)
+
     def get_autonomy(self):
         return self.current_autonomy_km
 
+    def get_soc(self):
+        """
+        Returns the state of charge of the transport.
+
+        Returns:
+            float: the autonomy of the transport over its maximum autonomy (0 to 1)
+        """
+        return self.current_autonomy_km / self.max_autonomy_km if self.max_autonomy_km else 0.0
+
     def calculate_km_expense(self, origin, start, dest=None):
-        fir_distance = distance_in_meters(origin, start)
-        sec_distance = distance_in_meters(start, dest)
-        if dest is None:
-            sec_distance = 0
-        return (fir_distance + sec_distance) // 1000
+        """
+        Estimates the autonomy the transport would consume to drive (in a straight line) from ``origin`` to ``start``
+        and then to ``dest``. The autonomy is only debited as the transport moves along its routes.
+
+        Args:
+            origin (list): the coordinates of the origin
+            start (list): the coordinates of the first stop
+            dest (list, optional): the coordinates of the second stop
+
+        Returns:
+            float: the estimated km of autonomy
+        """
+        meters = distance_in_meters(origin, start)
+        if dest is not None:
+            meters += distance_in_meters(start, dest)
+        return self.energy_model.km(meters, self.get("speed_in_kmh"))
 
     def to_json(self):
         """
@@ -666,22 +958,58 @@ class TransportStrategyBehaviour(StrategyBehaviour):
         self.set("current_customer", customer_id)
         self.agent.current_customer_orig = origin
         self.agent.current_customer_dest = dest
+        self.agent.itinerary.append(customer_id, origin, dest)
+        self.agent.prefetch_next_leg()  # the route to the destination is requested while going to the customer
         await self.send(reply)
         self.agent.num_assignments += 1
+        metrics.inc("assignments_total")
         try:
             await self.agent.move_to(self.agent.current_customer_orig)
         except AlreadyInDestination:
             await self.agent.arrived_to_destination()
         except PathRequestException as e:
             logger.error("Raising PathRequestException in pick_up_customer for {}".format(self.agent.name))
+            self.agent.remove_job(customer_id)
             raise e
 
+    async def add_customer(self, customer_id, origin, dest):
+        """
+        Adds a customer to the itinerary of a transport that is serving other customers, with the cheapest insertion
+        of its pickup and its dropoff (after the current customers if the transport has no free place). If the pickup
+        is the next stop the transport goes there first, otherwise the route after the next stop is prefetched.
+
+        Args:
+            customer_id (str): the id of the customer
+            origin (list): the coordinates of the current location of the customer
+            dest (list): the coordinates of the target destination of the customer
+
+        Returns:
+            bool: whether the customer was added (it may no longer fit in the transport)
+        """
+        insertion = self.agent.itinerary.insertion(self.get("current_pos"), origin, dest) \
+            if self.agent.itinerary else None
+        if insertion is None:
+            return False
+        detour, i, j = insertion
+        logger.info("Transport {} adds customer {} to its itinerary ({:.0f} m of detour)".format(
+            self.agent.name, customer_id, detour))
+        await self.agent.inform_customer(TRANSPORT_MOVING_TO_CUSTOMER, customer_id=customer_id)
+        self.agent.itinerary.insert(customer_id, origin, dest, i, j)
+        self.agent.num_assignments += 1
+        metrics.inc("assignments_total")
+        if i == 0:  # the new pickup is the next stop
+            await self.agent.go_to_next_stop()
+        else:
+            self.agent.prefetch_next_leg()
+        return True
+
     async def send_confirmation_travel(self, station_id):
         logger.info("Transport {} sent confirmation to station {}".format(self.agent.name, station_id))
         reply = Message()
         reply.to = station_id
         reply.set_metadata("protocol", REQUEST_PROTOCOL)
         reply.set_metadata("performative", ACCEPT_PERFORMATIVE)
+        reply.body = json.dumps(self.agent.charge_request())
         await self.send(reply)
 
     async def go_to_the_station(self, station_id, dest):
@@ -713,8 +1041,6 @@ class TransportStrategyBehaviour(StrategyBehaviour):
         # informs the TravelBehaviour of the station that the transport is coming
 
         self.agent.num_charges += 1
-        travel_km = self.agent.calculate_km_expense(self.get("current_pos"), dest)
-        self.agent.set_km_expense(travel_km)
         try:
             logger.debug("{} move_to station {}".format(self.agent.name, station_id))
             await self.agent.move_to(self.agent.current_station_dest)
@@ -738,29 +1064,189 @@ class TransportStrategyBehaviour(StrategyBehaviour):
         return True
 
     def check_and_decrease_autonomy(self, customer_orig, customer_dest):
+        """
+        Checks that the transport has autonomy for a trip. The autonomy of the trip is debited as the transport moves.
+        """
         autonomy = self.agent.get_autonomy()
         travel_km = self.agent.calculate_km_expense(self.get("current_pos"), customer_orig, customer_dest)
         if autonomy - travel_km < MIN_AUTONOMY:
             logger.warning("{} has not enough autonomy to do travel ({} for {} km).".format(self.agent.name,
                                                                                             autonomy, travel_km))
             return False
-        self.agent.set_km_expense(travel_km)
         return True
 
-    async def send_get_stations(self, content=None):
+    def station_expected_wait(self, station):
+        """
+        Estimates how long the transport would wait in a station before it starts charging, from the live
+        availability published by the station in the directory. Every transport in the queue is assumed to need as
+        much charge as this one.
+
+        Args:
+            station (dict): the station as returned by the directory (``self.agent.stations``)
+
+        Returns:
+            float: the expected wait in seconds (0 if the station has a free place or publishes no availability)
+        """
+        if station.get("available_places") is None or station["available_places"] > 0:
+            return 0.0
+        places = max(station.get("places") or 1, 1)
+        need = self.agent.max_autonomy_km - self.agent.current_autonomy_km
+        charge_time = need / station["charge"] if station.get("charge") else 0.0
+        return (station.get("queue_length", 0) // places + 1) * charge_time
+
+    def choose_station(self, stations=None):
+        """
+        Chooses the station where the transport would start charging first: the one with the shortest travel time
+        (in a straight line at the speed of the transport) plus expected wait (see ``station_expected_wait``).
 
+        Args:
+            stations (dict, optional): the stations by jid (``self.agent.stations`` if None)
+
+        Returns:
+            str: the jid of the chosen station (None if there are no stations)
+        """
+        stations = self.agent.stations if stations is None else stations
+        if not stations:
+            return None
+        speed = kmh_to_ms(self.agent.get("speed_in_kmh"))
+
+        def expected_start(jid):
+            station = stations[jid]
+            travel = distance_in_meters(station["position"], self.agent.get_position()) / speed
+            return travel + self.station_expected_wait(station)
+
+        return min(stations, key=expected_start)
+
+    def charge_duration(self, station):
+        """
+        Returns the seconds a station (as returned by the directory) needs to charge the transport completely.
+
+        Args:
+            station (dict): the station
+
+        Returns:
+            float: the duration of the charge (0 if the station publishes no power)
+        """
+        need = self.agent.max_autonomy_km - self.agent.current_autonomy_km
+        return need / station["charge"] if station.get("charge") else 0.0
+
+    def earliest_slots(self, stations=None, duration=None):
+        """
+        Computes the earliest charging window of every station that the transport could book, from the windows the
+        stations publish in the directory, so a single directory query is enough to compare all the stations. The
+        window of a station starts when the transport could arrive to it (in a straight line at its speed) or later.
+
+        Args:
+            stations (dict, optional): the stations by jid (``self.agent.stations`` if None)
+            duration (float, optional): the length of the window in seconds (the time to charge the transport
+                completely in every station if None)
+
+        Returns:
+            dict: the start (timestamp) of the earliest window of every station by jid
+        """
+        stations = self.agent.stations if stations is None else stations
+        if not stations:
+            return {}
+        now, speed = time.time(), kmh_to_ms(self.agent.get("speed_in_kmh"))
+        slots = {}
+        for jid, station in stations.items():
+            arrival = now + distance_in_meters(station["position"], self.agent.get_position()) / speed
+            calendar = SlotCalendar.from_windows(station.get("places") or 1, station.get("windows"))
+            length = self.charge_duration(station) if duration is None else duration
+            slots[jid] = calendar.earliest(arrival, length)[0]
+        return slots
+
+    async def reserve_station(self, station_id, start, duration=None):
+        """
+        Asks a station to book the earliest charging window that starts at ``start`` or later. The station answers
+        with the booked window using the REQUEST_PROTOCOL and the RESERVE_PERFORMATIVE, which the strategy stores with
+        ``self.agent.set_reservation(content)``.
+
+        Args:
+            station_id (str): the jid of the station
+            start (float): the earliest start of the window (timestamp)
+            duration (float, optional): the length of the window in seconds (the time to charge the transport
+                completely in the station if None)
+        """
+        if duration is None:
+            duration = self.charge_duration((self.agent.stations or {}).get(station_id, {}))
+        msg = Message()
+        msg.to = str(station_id)
+        msg.set_metadata("protocol", REQUEST_PROTOCOL)
+        msg.set_metadata("performative", RESERVE_PERFORMATIVE)
+        msg.body = json.dumps({"start": start, "duration": duration})
+        await self.send(msg)
+
+    async def cancel_reservation(self):
+        """
+        Cancels the charging window booked by the transport (before it arrives to the station).
+        """
+        if self.agent.reservation is None:
+            return
+        msg = Message()
+        msg.to = str(self.agent.reservation["station_id"])
+        msg.set_metadata("protocol", REQUEST_PROTOCOL)
+        msg.set_metadata("performative", CANCEL_PERFORMATIVE)
+        msg.body = json.dumps({})
+        await self.send(msg)
+        self.agent.reservation = None
+
+    def stations_query(self, content=None, radius=None, status=None, limit=None):
         if content is None or len(content) == 0:
             content = self.agent.request
+        if radius is None and status is None and limit is None:
+            return content
+        query = {"type": content, "radius": radius, "status": status, "limit": limit}
+        if radius is not None or limit is not None:
+            query["position"] = self.agent.get_position()
+        return json.dumps({key: value for key, value in query.items() if value is not None})
+
+    async def send_get_stations(self, content=None, radius=None, status=None, limit=None):
+        """
+        Asks the directory for the stations. Without filters the directory answers with all the stations.
+
+        Args:
+            content (str, optional): the type of station (``self.agent.request`` if None)
+            radius (float, optional): only stations within this distance (in km) of the transport
+            status (str or list, optional): only stations with this status (e.g. ``FREE_STATION``)
+            limit (int, optional): only the closest ``limit`` stations
+        """
         msg = Message()
         msg.to = str(self.agent.directory_id)
         msg.set_metadata("protocol", QUERY_PROTOCOL)
         msg.set_metadata("performative", REQUEST_PERFORMATIVE)
-        msg.body = content
+        msg.body = self.stations_query(content, radius, status, limit)
         await self.send(msg)
         logger.debug("Transport {} asked for stations to Directory {} for type {}.".format(self.agent.name,
                                                                                            self.agent.directory_id,
                                                                                            self.agent.request))
 
+    async def subscribe_stations(self, content=None, radius=None, status=None):
+        """
+        Subscribes to the stations of the directory. The directory answers with the current stations (an inform
+        message) and then sends only the stations that are added, updated (e.g. their status) or removed (update
+        messages, see ``TransportAgent.update_stations``).
+
+        Args:
+            content (str, optional): the type of station (``self.agent.request`` if None)
+            radius (float, optional): only stations within this distance (in km) of the current position
+            status (str or list, optional): only stations with this status (e.g. ``FREE_STATION``)
+        """
+        msg = Message()
+        msg.to = str(self.agent.directory_id)
+        msg.set_metadata("protocol", QUERY_PROTOCOL)
+        msg.set_metadata("performative", SUBSCRIBE_PERFORMATIVE)
+        msg.body = self.stations_query(content, radius, status)
+        await self.send(msg)
+
+    async def unsubscribe_stations(self, content=None):
+        msg = Message()
+        msg.to = str(self.agent.directory_id)
+        msg.set_metadata("protocol", QUERY_PROTOCOL)
+        msg.set_metadata("performative", UNSUBSCRIBE_PERFORMATIVE)
+        msg.body = content or self.agent.request
+        await self.send(msg)
+
     async def send_proposal(self, customer_id, content=None):
         """
         Send a ``spade.message.Message`` with a proposal to a customer to pick up him.
@@ -779,6 +1265,7 @@ class TransportStrategyBehaviour(StrategyBehaviour):
         reply.set_metadata("performative", PROPOSE_PERFORMATIVE)
         reply.body = json.dumps(content)
         await self.send(reply)
+        log_event(PROPOSAL, self.agent.name, customer_id, self.agent.get_position())
 
     async def cancel_proposal(self, customer_id, content=None):
         """
@@ -15,6 +15,10 @@ from spade.message import Message
 from spade.template import Template
 
 from .helpers import distance_in_meters, kmh_to_ms
+from .metrics import registry as metrics
+from .replay import get_replay, record_route
+from .routecache import get_route_cache
+from .routeclient import get_route_policy
 
 TRANSPORT_WAITING = "TRANSPORT_WAITING"
 TRANSPORT_MOVING_TO_CUSTOMER = "TRANSPORT_MOVING_TO_CUSTOMER"
@@ -159,8 +163,12 @@ async def request_path(agent, origin, destination, route_host):
     behav = RequestRouteBehaviour(msg, origin, destination, route_host)
     agent.add_behaviour(behav, template)
 
-    while not behav.is_killed():
-        await asyncio.sleep(0.01)
+    try:
+        while not behav.is_killed():
+            await asyncio.sleep(0.01)
+    except asyncio.CancelledError:  # the route is no longer needed
+        behav.kill()
+        raise
 
     if behav.exit_code is {} or "type" in behav.exit_code and behav.exit_code["type"] == "error":
         return None, None, None
@@ -244,25 +252,25 @@ def avg(array):
     return (sum(array_wo_nones, 0.0) / len(array_wo_nones)) if len(array_wo_nones) > 0 else 0.0
 
 
-async def request_route_to_server(origin, destination, route_host="http://router.project-osrm.org/"):
+async def fetch_route_from_server(origin, destination, route_host, timeout=None):
     """
-    Queries the OSRM for a path.
+    Requests a path to the OSRM once.
 
     Args:
         origin (list): origin coordinate (longitude, latitude)
         destination (list): target coordinate (longitude, latitude)
         route_host (string): route to host server of OSRM service
+        timeout (float, optional): seconds before the request is considered failed
 
     Returns:
-        list, float, float = the path, the distance of the path and the estimated duration
+        list, float, float = the path, the distance of the path and the estimated duration (None if the request failed)
     """
+    url = route_host + "route/v1/car/{src1},{src2};{dest1},{dest2}?geometries=geojson&overview=full"
+    src1, src2, dest1, dest2 = origin[1], origin[0], destination[1], destination[0]
+    url = url.format(src1=src1, src2=src2, dest1=dest1, dest2=dest2)
+    start = time.perf_counter()
     try:
-
-        url = route_host + "route/v1/car/{src1},{src2};{dest1},{dest2}?geometries=geojson&overview=full"
-        src1, src2, dest1, dest2 = origin[1], origin[0], destination[1], destination[0]
-        url = url.format(src1=src1, src2=src2, dest1=dest1, dest2=dest2)
-
-        async with aiohttp.ClientSession() as session:
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=timeout)) as session:
             async with session.get(url) as response:
                 result = await response.json()
 
@@ -272,7 +280,49 @@ async def request_route_to_server(origin, destination, route_host="http://router
         distance = result["routes"][0]["distance"]
         if path[-1] != destination:
             path.append(destination)
+        if metrics.enabled:
+            metrics.observe("route_request_seconds", time.perf_counter() - start, outcome="success")
         return path, distance, duration
     except Exception as e:
-        logger.exception("Exception while getting route with call {}. Exception: {}".format(url, e))
+        logger.debug("Error requesting route with call {}: {!r}".format(url, e))
+        if metrics.enabled:
+            metrics.observe("route_request_seconds", time.perf_counter() - start, outcome="error")
+        return None, None, None
+
+
+async def request_route_to_server(origin, destination, route_host="http://router.project-osrm.org/"):
+    """
+    Queries the OSRM for a path, following the route policy of the process (see :mod:`simfleet.routeclient`).
+
+    Args:
+        origin (list): origin coordinate (longitude, latitude)
+        destination (list): target coordinate (longitude, latitude)
+        route_host (string): route to host server of OSRM service
+
+    Returns:
+        list, float, float = the path, the distance of the path and the estimated duration
+    """
+    replay = get_replay()
+    if replay is not None:
+        return replay.route(origin, destination)
+
+    cache = get_route_cache()
+    if cache is not None:
+        route = await cache.get(origin, destination)
+        if route is not None:
+            if metrics.enabled:
+                metrics.inc("route_cache_hits_total")
+            record_route(origin, destination, *route)
+            return route
+
+    async def fetch(origin, destination, timeout):
+        route = await fetch_route_from_server(origin, destination, route_host, timeout)
+        if cache is not None and route[0] is not None:
+            cache.put(origin, destination, *route)  # fallback routes are never cached
+        return route
+
+    path, distance, duration = await get_route_policy().request(fetch, origin, destination)
+    if path is None:
         return None, None, None
+    record_route(origin, destination, path, distance, duration)
+    return path, distance, duration
@@ -3,6 +3,12 @@
 
 """Tests for `simfleet` package."""
 
+import json
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
 from click.testing import CliRunner
 
 from simfleet import cli
@@ -14,3 +20,928 @@ def test_command_line_interface():
     help_result = runner.invoke(cli.main, ['--help'])
     assert help_result.exit_code == 0
     assert '--help' in help_result.output
+
+
+def test_generate_scenario(tmpdir):
+    """Test that the scenario generator writes a valid and reproducible config."""
+    runner = CliRunner()
+    outputs = []
+    for filename in ["a.json", "b.json"]:
+        output = str(tmpdir.join(filename))
+        result = runner.invoke(cli.main, ['generate', '-o', output, '--transports', '3', '--customers', '20',
+                                          '--stations', '2', '--demand', 'hotspot', '--arrival-rate', '0:1,10:5',
+                                          '--seed', '42'])
+        assert result.exit_code == 0
+        with open(output) as f:
+            outputs.append(json.load(f))
+    assert outputs[0] == outputs[1]
+    scenario = outputs[0]
+    assert len(scenario["transports"]) == 3
+    assert len(scenario["customers"]) == 20
+    assert len(scenario["stations"]) == 2
+    delays = [customer["delay"] for customer in scenario["customers"]]
+    assert delays == sorted(delays)
+
+    result = runner.invoke(cli.main, ['generate', '-o', str(tmpdir.join("c.json")), '--arrival-rate', '0:1,10'])
+    assert result.exit_code == 2
+    assert "Invalid value for '--arrival-rate'" in result.output
+
+
+def test_benchmark_helpers():
+    """Test the percentiles, the comparison against a baseline and the stub route server of the benchmark."""
+    import urllib.request
+
+    from simfleet.bench import StubRouteServer, compare, percentile
+
+    assert percentile([], 50) is None
+    assert percentile([5, 1, 3, 2, 4], 50) == 3
+    assert percentile([5, 1, 3, 2, 4], 100) == 5
+    assert percentile(list(range(101)), 95) == 95
+
+    baseline = {"scenarios": {"tiny": {"startup_time": 2.0, "messages_per_second": 100, "peak_rss_kb": 0},
+                              "small": {"error": "failed"}}}
+    results = {"scenarios": {"tiny": {"startup_time": 1.0, "messages_per_second": 150, "peak_rss_kb": 10},
+                             "small": {"startup_time": 1.0}, "medium": {"startup_time": 1.0}}}
+    rows = {row[1]: row for row in compare(results, baseline)}
+    assert {row[0] for row in rows.values()} == {"tiny"}
+    assert rows["startup_time"] == ["tiny", "startup_time", 2.0, 1.0, "-50.0%"]
+    assert rows["messages_per_second"][4] == "+50.0%"
+    assert rows["peak_rss_kb"][4] == "-"
+    rows = {row[1]: row for row in compare({"scenarios": {"a": {"peak_rss_kb": None}}},
+                                           {"scenarios": {"a": {"peak_rss_kb": 2.0}}})}
+    assert rows["peak_rss_kb"] == ["a", "peak_rss_kb", 2.0, None, "-"]
+
+    router = StubRouteServer(points=3)
+    router.start()
+    try:
+        with urllib.request.urlopen(router.url + "route/v1/car/0.0,39.0;0.01,39.0") as response:
+            route = json.loads(response.read())["routes"][0]
+    finally:
+        router.stop()
+    assert route["geometry"]["coordinates"] == [[0.0, 39.0], [0.005, 39.0], [0.01, 39.0]]
+    assert route["duration"] == pytest.approx(route["distance"] / 10)
+    assert router.requests == 1
+
+
+def test_behaviour_busy_time():
+    """Test that instrumented behaviours only account the time they spend running."""
+    import asyncio
+    import time
+
+    from spade.behaviour import CyclicBehaviour
+
+    from simfleet.metrics import MetricsRegistry, instrument_behaviour, registry
+
+    class SleepyBehaviour(CyclicBehaviour):
+        async def run(self):
+            time.sleep(0.01)
+            await asyncio.sleep(0.2)
+            return "done"
+
+    registry.enabled = True
+    try:
+        behaviour = SleepyBehaviour()
+        instrument_behaviour(behaviour)
+        assert asyncio.run(behaviour.run()) == "done"
+    finally:
+        registry.enabled = False
+    histogram = registry.histogram("behaviour_run_seconds", behaviour="SleepyBehaviour")
+    assert histogram.count == 1
+    assert 0.01 <= histogram.sum < 0.1
+    assert MetricsRegistry().snapshot() == {"counters": {}, "gauges": {}, "histograms": {}}
+
+
+def test_prometheus_text_format():
+    """Test that the metrics are rendered in the Prometheus text format."""
+    from simfleet.metrics import MetricsRegistry
+
+    registry = MetricsRegistry()
+    registry.move("customers", None, "CUSTOMER_WAITING")
+    registry.move("customers", "CUSTOMER_WAITING", "CUSTOMER_IN_TRANSPORT")
+    registry.inc("distance_meters_total", 1500)
+    registry.observe("route_request_seconds", 0.03, outcome="success")
+    text = registry.to_text()
+    assert '# TYPE simfleet_customers gauge' in text
+    assert 'simfleet_customers{status="CUSTOMER_WAITING"} 0.0' in text
+    assert 'simfleet_customers{status="CUSTOMER_IN_TRANSPORT"} 1.0' in text
+    assert 'simfleet_distance_meters_total 1500.0' in text
+    assert 'simfleet_route_request_seconds_bucket{outcome="success",le="0.05"} 1' in text
+    assert 'simfleet_route_request_seconds_count{outcome="success"} 1' in text
+
+
+def test_headless_mode(tmpdir, monkeypatch):
+    """Test that --headless runs without the web interface and the icons, serving only the exporter with --metrics."""
+    import asyncio
+    from types import SimpleNamespace
+
+    from simfleet.metrics import registry as metrics
+    from simfleet.simulator import SimulatorAgent
+
+    simulators = []
+
+    class Simulator(object):
+        def __init__(self, config, agentjid):
+            self.config, self.running = config, False
+            simulators.append(self)
+
+        def start(self):
+            pass
+
+        def run(self):
+            self.running = True
+
+        def is_simulation_finished(self):
+            return True
+
+        def stop(self):
+            return SimpleNamespace(result=lambda: None)
+
+    monkeypatch.setattr(cli, "SimulatorAgent", Simulator)
+    monkeypatch.setattr(cli, "quit_spade", lambda: None)
+    config = str(tmpdir.join("config.json"))
+    with open(config, "w") as f:
+        json.dump({"transports": [], "customers": []}, f)
+    result = CliRunner().invoke(cli.main, ['--config', config, '--headless', '--max-time', '60'])
+    assert result.exit_code == 0
+    assert simulators[0].config.headless and simulators[0].running  # --headless implies --autorun
+
+    routes = []
+    simulator = SimpleNamespace(config=SimpleNamespace(headless=True), shards=None, is_shard=lambda: False,
+                                submit=lambda coro: coro.close(),
+                                web=SimpleNamespace(add_get=lambda *args, **kwargs: routes.append(args[0])), _icons=None)
+    asyncio.run(SimulatorAgent.setup(simulator))
+    assert routes == []
+    monkeypatch.setattr(metrics, "enabled", True)
+    simulator.config = SimpleNamespace(headless=True, http_ip="127.0.0.1", http_port=9000)
+    simulator.stop_sampling, simulator.prometheus_controller = None, None
+    simulator.web.start = lambda **kwargs: routes.append(kwargs["port"])
+    asyncio.run(SimulatorAgent.setup(simulator))
+    assert routes == ["/metrics/prometheus", 9000]  # only the Prometheus exporter
+    del routes[:]
+    agent = SimpleNamespace(set_icon=lambda icon: routes.append(icon))
+    SimulatorAgent.set_icon(simulator, agent, "taxi")
+    assert routes == []
+
+
+def test_sweep_variant_isolation(tmpdir):
+    """Test that sweep variants resize the fleet and get their own agent names."""
+    from simfleet.config import SimfleetConfig
+    from simfleet.sweep import apply_params, expand_grid, isolate_names
+
+    scenario = str(tmpdir.join("scenario.json"))
+    CliRunner().invoke(cli.main, ['generate', '-o', scenario, '--fleets', '2', '--transports', '4', '--seed', '1'])
+    variants = expand_grid({"transports": [2, 4], "transport_strategy": ["a.B"]})
+    assert variants == [{"transport_strategy": "a.B", "transports": 2}, {"transport_strategy": "a.B", "transports": 4}]
+
+    config = SimfleetConfig(scenario)
+    apply_params(config, variants[0])
+    isolate_names(config, "run0_")
+    assert config.transport_strategy == "a.B"
+    assert [t["name"] for t in config["transports"]] == ["run0_transport0", "run0_transport1"]
+    assert [t["fleet"] for t in config["transports"]] == ["run0_fleet0@127.0.0.1", "run0_fleet1@127.0.0.1"]
+    assert config.directory_name == "run0_directory"
+
+    config = SimfleetConfig(scenario)
+    apply_params(config, {"fleets": 1})
+    assert [f["name"] for f in config["fleets"]] == ["fleet0"]
+    assert len(config["transports"]) == 4
+    assert {t["fleet"] for t in config["transports"]} == {"fleet0@127.0.0.1"}
+    apply_params(config, {"fleets": 0})
+    assert config["transports"] == []
+
+
+def test_route_cache(tmpdir):
+    """Test that the route cache writes in the background and skips the writes while the file is locked."""
+    import asyncio
+    import sqlite3
+
+    from simfleet.routecache import RouteCache
+
+    filename = str(tmpdir.join("routes.sqlite"))
+    cache = RouteCache(filename, timeout=0.1)
+    cache.put([39.1, -0.1], [39.2, -0.2], [[39.1, -0.1], [39.2, -0.2]], 100.0, 10.0)
+    cache.close()
+
+    cache = RouteCache(filename, timeout=0.1)
+    assert asyncio.run(cache.get([39.1, -0.1], [39.2, -0.2])) == ([[39.1, -0.1], [39.2, -0.2]], 100.0, 10.0)
+    assert asyncio.run(cache.get([39.3, -0.3], [39.2, -0.2])) is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    other = sqlite3.connect(filename)
+    other.execute("BEGIN IMMEDIATE")
+    cache.put([39.3, -0.3], [39.2, -0.2], [[39.3, -0.3], [39.2, -0.2]], 200.0, 20.0)
+    cache.close()
+    other.rollback()
+    other.close()
+    cache = RouteCache(filename)
+    assert asyncio.run(cache.get([39.3, -0.3], [39.2, -0.2])) is None
+    cache.close()
+
+
+def test_partition_scenario(tmpdir):
+    """Test that the agents of a scenario are split among shards."""
+    from simfleet.config import SimfleetConfig
+    from simfleet.shards import partition_scenario
+
+    scenario = str(tmpdir.join("scenario.json"))
+    CliRunner().invoke(cli.main, ['generate', '-o', scenario, '--fleets', '3', '--transports', '30', '--customers',
+                                  '60', '--stations', '6', '--seed', '1'])
+    config = SimfleetConfig(scenario)
+
+    shards = partition_scenario(config, 3, by="geography")
+    assert sum(len(shard["transports"]) + len(shard["customers"]) + len(shard["stations"]) for shard in shards) == 96
+    assert all(30 <= len(shard["transports"]) + len(shard["customers"]) + len(shard["stations"]) <= 34
+               for shard in shards)
+    west = max(agent["position"][1] for section in shards[0].values() for agent in section)
+    east = min(agent["position"][1] for section in shards[1].values() for agent in section)
+    assert west <= east
+
+    shards = partition_scenario(config, 2, by="fleet")
+    assert {t["fleet"] for t in shards[0]["transports"]} == {"fleet0@127.0.0.1", "fleet2@127.0.0.1"}
+    assert [len(shard["customers"]) for shard in shards] == [30, 30]
+
+
+def test_worker_retries_the_coordinator(monkeypatch):
+    """Test that a worker retries the download of its config while the coordinator is starting."""
+    import io
+    import urllib.error
+
+    from simfleet import shards
+
+    calls = []
+
+    def urlopen(url):
+        calls.append(url)
+        if len(calls) < 3:
+            raise urllib.error.URLError("connection refused")
+        return io.BytesIO(b'{"simulation_name": "big"}')
+
+    monkeypatch.setattr(shards.urllib.request, "urlopen", urlopen)
+    monkeypatch.setattr(shards.time, "sleep", lambda seconds: None)
+    assert shards.fetch_shard_config("http://127.0.0.1:9000/", 2) == {"simulation_name": "big"}
+    assert calls == ["http://127.0.0.1:9000/shards/2"] * 3
+    del calls[:]
+    with pytest.raises(urllib.error.URLError):
+        shards.fetch_shard_config("http://127.0.0.1:9000/", 2, retries=0)
+
+
+def test_stats_are_typed():
+    """Test that the stats keep numbers as typed columns and are serialized to JSON as numbers."""
+    from simfleet.simulator import TRANSPORT_STATS, stats_dataframe, stats_to_json
+
+    df = stats_dataframe(TRANSPORT_STATS, {"name": ["t0", "t1"], "assignments": [2, 0], "distance": [1500.25, 0],
+                                           "waiting_in_station_time": [0, 3.5], "charging_time": [0, 10],
+                                           "consumed_autonomy": [1.5, 0], "shared_trips": [1, 0],
+                                           "status": ["FREE", "IN_STATION"]})
+    assert list(df.columns) == list(TRANSPORT_STATS)
+    assert str(df["assignments"].dtype) == "int64"
+    assert str(df["distance"].dtype) == "float64"
+
+    data = json.loads(stats_to_json({"simulation": pd.DataFrame({"Avg Distance": [750.125]}), "transports": df}))
+    assert data["simulation"] == {"Avg Distance": 750.125}
+    assert data["transports"]["0"]["distance"] == 1500.25
+    assert data["transports"]["1"]["assignments"] == 0
+
+
+def test_event_log(tmpdir):
+    """Test that the events are buffered and written to disk in CSV and JSON lines formats."""
+    from simfleet.eventlog import DROPOFF, EventLog, PICKUP, REQUEST
+
+    for extension in ["csv", "jsonl"]:
+        filename = str(tmpdir.join("events." + extension))
+        log = EventLog(filename, buffer_size=2)
+        log.start()
+        log.log(REQUEST, "customer0@127.0.0.1", position=[39.47, -0.37])
+        log.log(PICKUP, "customer0@127.0.0.1", "transport0@127.0.0.1", [39.47, -0.37])
+        log.log(DROPOFF, "transport0", "customer0", [39.48, -0.38])
+        log.close()
+        if extension == "csv":
+            events = pd.read_csv(filename)
+        else:
+            events = pd.read_json(filename, lines=True)
+        assert list(events["event"]) == [REQUEST, PICKUP, DROPOFF]
+        assert list(events["agent"]) == ["customer0", "customer0", "transport0"]
+        assert events["peer"][1] == "transport0"
+        assert events["latitude"][2] == 39.48
+
+
+def test_record_and_replay(tmpdir):
+    """Test that random draws, routes and messages of a recorded simulation are answered from the log."""
+    import asyncio
+
+    from spade.message import Message
+
+    from simfleet.helpers import random_position
+    from simfleet.replay import Replay, get_recorder, set_recorder, set_replay
+    from simfleet.utils import request_route_to_server
+
+    filename = str(tmpdir.join("record.jsonl"))
+    set_recorder(filename, seed=42, config={"simulation_name": "recorded"})
+    draws = [random_position("customer0"), random_position("transport0"), random_position("customer0")]
+    get_recorder().message(Message(to="transport0@127.0.0.1", sender="customer0@127.0.0.1", body="{}",
+                                   metadata={"protocol": "REQUEST", "performative": "accept"}))
+    get_recorder().write("route", origin=draws[0], destination=draws[1], path=[draws[0], draws[1]], distance=10.0,
+                         duration=2.0)
+    set_recorder(None)
+
+    replay = Replay(filename)
+    assert replay.seed == 42
+    assert replay.config == {"simulation_name": "recorded"}
+    assert [event["metadata"]["performative"] for event in replay.events] == ["accept"]
+    set_replay(replay)
+    try:
+        assert random_position("customer0") == draws[0]
+        assert random_position("transport0") == draws[1]
+        assert random_position("customer0") == draws[2]
+        loop = asyncio.new_event_loop()
+        route = loop.run_until_complete(request_route_to_server(draws[0], draws[1]))
+        loop.close()
+        assert route == ([draws[0], draws[1]], 10.0, 2.0)
+    finally:
+        set_replay(None)
+
+
+def test_trajectory_roundtrip(tmpdir):
+    """Test that transport positions are delta encoded in the trajectory file and decoded back."""
+    from simfleet.trajectory import TrajectoryWriter, index_filename, read_trajectory
+
+    filename = str(tmpdir.join("run.traj"))
+    writer = TrajectoryWriter(filename, interval=0.5, keyframe_every=3)
+    ticks = [
+        [("t0", [39.47, -0.37], "TRANSPORT_WAITING"), ("t1", [39.48, -0.38], "TRANSPORT_WAITING")],
+        [("t0", [39.470010, -0.370020], "TRANSPORT_MOVING_TO_CUSTOMER"), ("t1", [39.48, -0.38], "TRANSPORT_WAITING")],
+        [("t0", [39.470020, -0.370040], "TRANSPORT_MOVING_TO_CUSTOMER"), ("t1", [39.6, -0.5], "TRANSPORT_WAITING")],
+        [("t0", [39.470030, -0.370060], "TRANSPORT_MOVING_TO_CUSTOMER"), ("t1", [39.6, -0.5], "TRANSPORT_WAITING")],
+    ]
+    for transports in ticks:
+        writer.write_tick(transports)
+    writer.close()
+
+    with open(index_filename(filename)) as f:
+        index = json.load(f)
+    assert index["ticks"] == 4
+    assert [tick for tick, _ in index["keyframes"]] == [0, 2, 3]  # tick 2 moves t1 too far for a delta
+
+    decoded = list(read_trajectory(filename))
+    assert [tick for tick, _ in decoded] == [0, 1, 2, 3]
+    for (_, positions), transports in zip(decoded, ticks):
+        for name, position, status in transports:
+            assert positions[name]["status"] == status
+            assert positions[name]["position"] == [round(coord, 6) for coord in position]
+
+    filename = str(tmpdir.join("large.traj"))
+    writer = TrajectoryWriter(filename)
+    writer.write_tick([("t{}".format(i), [39.47, -0.37], "TRANSPORT_WAITING") for i in range(70000)])
+    writer.close()
+    (_, positions), = read_trajectory(filename)
+    assert len(positions) == 70000
+    assert positions["t69999"]["position"] == [39.47, -0.37]
+
+
+def test_checkpoint_roundtrip(tmpdir):
+    """Test that a checkpoint restores the scenario, the clock and the customers of a simulation."""
+    from types import SimpleNamespace
+
+    from simfleet.checkpoint import read_checkpoint, restore_snapshot, resume_config, take_snapshot, \
+        write_checkpoint
+    from simfleet.config import SimfleetConfig
+
+    config = SimfleetConfig(name="long")
+    config.update({"customers": [{"name": "c0", "position": [39.47, -0.37], "destination": [39.48, -0.38]},
+                                 {"name": "c1", "position": [39.46, -0.36], "destination": [39.45, -0.35]},
+                                 {"name": "c2", "position": [39.46, -0.36], "destination": [39.45, -0.35],
+                                  "delay": 3600}]})
+
+    def customer(status, position, **times):
+        fields = dict(init_time=None, waiting_for_pickup_time=None, assignment_time=None, pickup_time=None,
+                      end_time=None, transport_assigned=None, dest=None, is_launched=True)
+        fields.update(times)
+        return SimpleNamespace(status=status, current_pos=position, **fields)
+
+    start = 1000.0
+    customers = {"c0": customer("CUSTOMER_IN_DEST", [39.48, -0.38], init_time=1001.0, waiting_for_pickup_time=1002.0,
+                                assignment_time=1002.0, pickup_time=1010.0, end_time=1050.0),
+                 "c1": customer("CUSTOMER_IN_TRANSPORT", [39.455, -0.355], init_time=1003.0, pickup_time=1040.0),
+                 "c2": customer("CUSTOMER_WAITING", None, is_launched=False)}
+    simulator = SimpleNamespace(config=config, simulation_init_time=start, get_simulation_time=lambda: 60.0,
+                                transport_agents={}, customer_agents=customers, station_agents={})
+    filename = str(tmpdir.join("run.json.gz"))
+    write_checkpoint(filename, take_snapshot(simulator))
+
+    resumed = SimfleetConfig()
+    snapshot = resume_config(resumed, filename)
+    assert snapshot == read_checkpoint(filename)
+    assert resumed.resume == filename
+    assert resumed.simulation_name == "long"
+    assert resumed["customers"][1]["position"] == [39.455, -0.355]
+    assert resumed["customers"][2] == config["customers"][2]  # not launched yet
+
+    fresh = {name: customer("CUSTOMER_WAITING", None) for name in customers}
+    start = restore_snapshot(SimpleNamespace(config=resumed, transport_agents={}, customer_agents=fresh,
+                                             station_agents={}), snapshot)
+    assert fresh["c0"].status == "CUSTOMER_IN_DEST"
+    assert fresh["c0"].end_time - fresh["c0"].init_time == pytest.approx(49.0)
+    assert fresh["c1"].status == "CUSTOMER_WAITING"
+    assert fresh["c1"].init_time == pytest.approx(start + 3.0)
+    assert fresh["c1"].pickup_time is None
+    assert fresh["c1"].current_pos == [39.455, -0.355]
+    assert fresh["c2"].init_time is None
+
+
+def test_warm_start_registers_agents():
+    """Test that a warm start fills the registries of the directory, managers and customers without messages."""
+    from types import SimpleNamespace
+
+    from simfleet.customer import CustomerAgent
+    from simfleet.directory import DirectoryAgent
+    from simfleet.fleetmanager import FleetManagerAgent
+    from simfleet.simulator import SimulatorAgent
+    from simfleet.station import StationAgent
+
+    directory = DirectoryAgent("directory@localhost", "secret")
+    manager = FleetManagerAgent("fleet@localhost", "secret")
+    manager.set_fleet_type("taxi")
+    manager.set_icon("taxi.png")
+
+    class Transport(object):
+        def __init__(self, name, fleet_type):
+            self.name, self.jid, self.fleet_type = name, "{}@localhost".format(name), fleet_type
+            self.fleetmanager_id, self.registration, self.icon = "fleet@localhost", False, None
+
+        def set_registration(self, status, content=None):
+            self.registration, self.icon = status, content["icon"]
+
+    customer = CustomerAgent("customer@localhost", "secret")
+    customer.set_fleet_type("taxi")
+    station = StationAgent("station@localhost", "secret")
+    station.set_position([39.47, -0.37])
+    station.set_power(50)
+    simulator = SimpleNamespace(directory_agent=directory, manager_agents={"fleet": manager},
+                                transport_agents={"t0": Transport("t0", "taxi"), "t1": Transport("t1", "bus")},
+                                customer_agents={"customer": customer}, station_agents={"station": station})
+    SimulatorAgent.warm_start(simulator)
+
+    services = directory.get("service_agents")
+    assert list(services["taxi"]) == ["fleet@localhost"]
+    assert services["station"]["station@localhost"]["charge"] == 50
+    assert manager.registration and station.registration
+    assert list(manager.get("transport_agents")) == ["t0"]
+    assert manager.transports_in_fleet == 1
+    assert simulator.transport_agents["t0"].registration and simulator.transport_agents["t0"].icon == "taxi.png"
+    assert not simulator.transport_agents["t1"].registration
+    assert customer.fleetmanagers == services["taxi"]
+
+
+def test_directory_queries_and_subscriptions():
+    """Test the spatial and status filters of the directory and the incremental notifications of subscribers."""
+    from simfleet.directory import DirectoryAgent, parse_query
+
+    directory = DirectoryAgent("directory@localhost", "secret")
+    for index, (position, status) in enumerate([([39.470, -0.370], "FREE_STATION"),
+                                                ([39.475, -0.375], "BUSY_STATION"),
+                                                ([39.480, -0.380], "FREE_STATION"),
+                                                ([39.900, -0.900], "FREE_STATION")]):
+        directory.register_service({"jid": "s{}@localhost".format(index), "type": "station", "status": status,
+                                    "position": position, "charge": 50})
+    directory.register_service({"jid": "fleet@localhost", "type": "taxi"})
+
+    assert parse_query("station") == ("station", {})
+    service_type, filters = parse_query(json.dumps({"type": "station", "position": [39.471, -0.371], "radius": 2}))
+    assert service_type == "station"
+    assert list(directory.services.query(service_type, filters)) == ["s0@localhost", "s1@localhost", "s2@localhost"]
+    filters["status"] = "FREE_STATION"
+    assert list(directory.services.query("station", filters)) == ["s0@localhost", "s2@localhost"]
+    assert list(directory.services.query("station", {"position": [39.9, -0.9], "limit": 1})) == ["s3@localhost"]
+    assert len(directory.services.query("station")) == 4
+
+    directory.services.subscribe("t0@localhost", "station", {"status": "FREE_STATION"})
+    directory.services.subscribe("t1@localhost", "station")
+    notifications = dict(directory.update_service({"jid": "s1@localhost", "type": "station",
+                                                   "status": "FREE_STATION"}))
+    assert list(notifications["t0@localhost"]["added"]) == ["s1@localhost"]
+    assert notifications["t1@localhost"]["updated"]["s1@localhost"]["status"] == "FREE_STATION"
+    notifications = dict(directory.update_service({"jid": "s0@localhost", "type": "station",
+                                                   "status": "BUSY_STATION"}))
+    assert notifications["t0@localhost"]["removed"] == ["s0@localhost"]
+    assert directory.update_service({"jid": "s0@localhost", "type": "station", "status": "BUSY_STATION"}) == []
+    notifications = dict(directory.deregister_service("station", "s2@localhost"))
+    assert notifications["t1@localhost"]["removed"] == ["s2@localhost"]
+    assert "s2@localhost" not in directory.services.query("station", {"position": [39.48, -0.38], "radius": 1})
+
+
+def test_choose_station_by_expected_wait():
+    """Test that transports choose the station where they would start charging first."""
+    from simfleet.station import StationAgent
+    from simfleet.transport import TransportStrategyBehaviour
+
+    class Transport(object):
+        max_autonomy_km, current_autonomy_km, stations = 100, 10, None
+
+        def get(self, key):
+            return {"speed_in_kmh": 36}[key]  # 10 m/s
+
+        def get_position(self):
+            return [39.47, -0.37]
+
+    station = StationAgent("station@localhost", "secret")
+    station.set_places(2)
+    station.set_status("BUSY_STATION")
+    station.set_available_places(0)
+    for transport in ["t1@localhost", "t2@localhost", "t3@localhost"]:
+        station.enqueue(transport)
+    assert station.availability() == {"status": "BUSY_STATION", "places": 2, "available_places": 0,
+                                      "queue_length": 3, "windows": []}
+
+    behaviour = TransportStrategyBehaviour()
+    behaviour.agent = Transport()
+    busy = dict(station.availability(), jid="busy@localhost", position=[39.47, -0.37], charge=1)
+    free = dict(busy, jid="free@localhost", position=[39.48, -0.37], available_places=1, queue_length=0)
+    assert behaviour.station_expected_wait(busy) == 2 * 90  # two rounds of 90 seconds of charge
+    assert behaviour.station_expected_wait(free) == 0
+    assert behaviour.choose_station({"busy@localhost": busy, "free@localhost": free}) == "free@localhost"
+    free["position"] = [39.6, -0.37]  # more than 180 s away
+    assert behaviour.choose_station({"busy@localhost": busy, "free@localhost": free}) == "busy@localhost"
+
+
+def test_station_queue_policies():
+    """Test the order of the queue policies and the queue times of a station."""
+    from simfleet.queues import create_queue
+    from simfleet.station import StationAgent
+
+    queue = create_queue("shortest_charge_first")
+    for transport, need in [("t1", 30), ("t2", 10), ("t3", 20), ("t4", 10)]:
+        queue.push(transport, need)
+    queue.remove("t3")
+    assert list(queue) == ["t2", "t4", "t1"]
+    assert [queue.pop().transport for _ in range(3)] == ["t2", "t4", "t1"]
+    assert queue.pop() is None
+
+    # two places of three are reserved for fleet "blue": other fleets only take the last free place
+    queue = create_queue({"policy": "reserved", "fleet": "blue", "slots": 2})
+    assert queue.can_charge("red@localhost", 3, {})
+    assert not queue.can_charge("red@localhost", 2, {"t0": "red@localhost"})
+    assert queue.can_charge("blue@localhost", 2, {"t0": "red@localhost"})
+    queue.push("t1", fleet="red@localhost")
+    queue.push("t2", fleet="blue@localhost")
+    assert queue.pop(1, {"t0": "blue@localhost"}).transport == "t2"  # the fleet goes first
+    assert queue.pop(1, {"t0": "blue@localhost"}) is None  # the place is reserved
+    assert queue.pop(1, {"t0": "blue@localhost", "t3": "blue@localhost"}).transport == "t1"
+
+    station = StationAgent("station@localhost", "secret")
+    station.set_places(1)
+    station.set_available_places(0)
+    station.total_busy_time = 0.0
+    station.enqueue("t1@localhost", 10)
+    station.enqueue("t2@localhost", 20)
+    station.waiting_list.entries["t1@localhost"].time -= 30  # t1 waited 30 seconds
+    assert station.dequeue(available_places=1).transport == "t1@localhost"
+    assert station.dequeue("t2@localhost").transport == "t2@localhost"  # t2 left the queue
+    assert station.queue_length == 0 and station.max_queue_length == 2
+    assert station.queue_time_stats()[1] == pytest.approx(30, abs=1)
+
+
+def test_charging_reservations():
+    """Test that booked windows keep walk-in and queued charges out of them."""
+    import asyncio
+
+    from simfleet.reservations import SlotCalendar
+    from simfleet.station import StationAgent
+    from simfleet.transport import TransportStrategyBehaviour
+
+    calendar = SlotCalendar(2)
+    assert calendar.book("t1", 100, 50) == ("t1", 0, 100, 150)
+    assert calendar.book("t2", 120, 50) == ("t2", 1, 120, 170)
+    assert calendar.book("t3", 110, 30) == ("t3", 0, 150, 180)  # both places are busy until 150
+    assert calendar.earliest(0, 100) == (0, 0)
+    assert calendar.earliest(0, 130) == (170, 1)
+    assert calendar.free_places(100, 110) == 1
+    calendar.cancel("t1")
+    assert calendar.book("t4", 100, 50, exact=True).place == 0
+    calendar.prune(175)
+    assert calendar.windows() == [[0, 150, 180]] and calendar.booking("t4") is None
+
+    station = StationAgent("station@localhost", "secret")
+    station.set_places(1)
+    station.set_power(1)
+    now = time.time()
+    booking = station.reserve("t1@localhost", now + 30, 60)
+    assert booking.start == pytest.approx(now + 30, abs=1)
+    # a walk-in that would charge into the booked window waits, the booked transport may arrive a bit early
+    assert station.can_start_charging("t2@localhost", need=10)
+    assert not station.can_start_charging("t2@localhost", need=60)
+    assert station.can_start_charging("t1@localhost", need=60)
+
+    class Transport(object):
+        max_autonomy_km, current_autonomy_km = 100, 40
+
+        def get(self, key):
+            return {"speed_in_kmh": 36}[key]
+
+        def get_position(self):
+            return [39.47, -0.37]
+
+    behaviour = TransportStrategyBehaviour()
+    behaviour.agent = Transport()
+    stations = {"station@localhost": dict(station.availability(), position=[39.47, -0.37], charge=1)}
+    assert behaviour.earliest_slots(stations)["station@localhost"] == pytest.approx(booking.end)
+    assert behaviour.earliest_slots(stations, duration=10)["station@localhost"] == pytest.approx(now, abs=1)
+
+    # a released place goes to the first queued transport whose charge ends before the booked window
+    sent = []
+
+    async def send(msg):
+        sent.append(msg.to)
+
+    station.send = send
+    station.set_available_places(1)
+    station.enqueue("t2@localhost", 60)
+    station.enqueue("t3@localhost", 10)
+    asyncio.run(station.serve_queue())
+    assert [str(to) for to in sent] == ["t3@localhost"]
+    assert list(station.waiting_list) == ["t2@localhost"] and list(station.charging) == ["t3@localhost"]
+    # a charge that overlaps every place of the calendar is not assigned
+    assert not asyncio.run(station.assigning_place("t2@localhost", need=60))
+    assert station.get_available_places() == 0 and "t2@localhost" not in station.charging
+
+
+def test_charging_models():
+    """Test the closed-form CCCV charge and the rescheduling of shared power."""
+    import math
+    from simfleet.charging import ChargingSession, CCCVModel, share_power
+    from simfleet.station import StationAgent
+
+    model = CCCVModel(taper_from=0.8, min_rate=0.5)
+    # 80 s at 1 km/s up to 80 km, then the power tapers from 1 to 0.5 km/s
+    assert model.duration(0, 100, 100, 1) == pytest.approx(80 + 40 * math.log(2))
+    for seconds in [30, 80, 95]:
+        assert model.duration(0, model.level_after(0, seconds, 100, 1), 100, 1) == pytest.approx(seconds)
+    assert share_power(10, [2, None, None]) == [2, 4, 4]
+
+    station = StationAgent("station@localhost", "secret")
+    station.set_places(2)
+    station.set_power(10)
+    station.set_charging_model("linear", shared_power=True)
+    scheduled = []  # the ChargeBehaviour timeouts, without running the agent
+    station.add_behaviour, station.has_behaviour = scheduled.append, scheduled.__contains__
+    station.remove_behaviour = scheduled.remove
+    now = time.time()
+    station.sessions["t1"] = ChargingSession("t1", 0, 100, 100)
+    station.reschedule_charges()
+    assert station.sessions["t1"].end == pytest.approx(now + 10, abs=0.5)
+    station.sessions["t2"] = ChargingSession("t2", 50, 100, 100, max_rate=2)
+    station.reschedule_charges()  # t2 takes 2 km/s and t1 is rescheduled with the other 8 km/s
+    assert station.sessions["t1"].power == 8 and station.sessions["t2"].power == 2
+    assert station.sessions["t1"].end == pytest.approx(now + 100 / 8, abs=0.5)
+    assert station.sessions["t2"].end == pytest.approx(now + 25, abs=0.5)
+    assert scheduled == [station.sessions["t1"].behaviour, station.sessions["t2"].behaviour]
+
+
+def test_charging_without_power():
+    """Test that a charge without power is not scheduled and resumes when it gets power."""
+    from simfleet.charging import ChargingSession, CCCVModel, LinearModel
+    from simfleet.station import StationAgent
+
+    assert CCCVModel().level_after(50, 30, 100, 0) == 50
+    assert LinearModel().level_after(50, 30, 100, 0) == 50
+
+    station = StationAgent("station@localhost", "secret")
+    station.set_power(10)
+    station.set_charging_model("cccv")
+    scheduled = []
+    station.add_behaviour, station.has_behaviour = scheduled.append, scheduled.__contains__
+    station.remove_behaviour = scheduled.remove
+    station.sessions["t1"] = ChargingSession("t1", 0, 100, 100, max_rate=0)
+    station.sessions["t2"] = ChargingSession("t2", 0, 100, 100)
+    station.reschedule_charges()
+    assert station.sessions["t1"].behaviour is None and scheduled == [station.sessions["t2"].behaviour]
+    station.set_power(0)
+    station.reschedule_charges()
+    assert scheduled == [] and station.sessions["t2"].power == 0
+    station.set_power(10)
+    station.sessions["t1"].max_rate = 5
+    station.reschedule_charges()
+    assert len(scheduled) == 2 and station.sessions["t1"].power == 5
+
+
+def test_energy_model_and_fleet_soc():
+    """Test the consumption of the energy model and the SoC arrays of the fleet."""
+    from simfleet.energy import EnergyModel, FleetEnergy
+
+    model = EnergyModel(consumption=1.5, speed_factor=0.5, reference_speed=50)
+    assert model.km(2000) == pytest.approx(3.0)
+    assert model.km(2000, speed_in_kmh=100) == pytest.approx(3.0 * 2.5)
+
+    fleet = FleetEnergy(size=2)
+    indexes = [fleet.register("t{}".format(i), 100, 100) for i in range(5)]  # the arrays grow
+    assert indexes == [0, 1, 2, 3, 4] and len(fleet) == 5
+    for _ in range(10):  # ten steps of a route of 60 km
+        fleet.debit(indexes[1], 6)
+    fleet.debit(indexes[3], 150)
+    assert fleet.soc().tolist() == pytest.approx([1.0, 0.4, 1.0, 0.0, 1.0])
+    assert fleet.below(0.5) == ["t1", "t3"]
+    assert fleet.consumed[indexes[3]] == 150
+    assert fleet.register("t1", 80, 100) == 1 and fleet.soc()[1] == pytest.approx(0.8)
+
+
+def test_predictive_charging_plan():
+    """Test the demand estimate and the transports sent to charge ahead of time."""
+    import asyncio
+    from types import SimpleNamespace
+
+    from simfleet.directory import DirectoryAgent, parse_query
+    from simfleet.fleetmanager import ChargingDispatchBehaviour, DemandEstimator, plan_charging
+
+    demand = DemandEstimator(half_life=60)
+    for second in range(0, 600, 10):  # a request every 10 seconds
+        demand.record(now=1000 + second)
+    assert demand.rate(now=1600) == pytest.approx(0.1, rel=0.1)
+    assert demand.rate(now=1600 + 600) < demand.rate(now=1600) / 1000
+
+    soc = [0.9, 0.2, 0.5, 0.1, 0.3, 0.55]
+    available = [True, True, True, True, False, True]
+    # no demand: the lowest transports below 0.6 are sent while the stations have places
+    assert plan_charging(soc, available, 0.0, 600, 2).tolist() == [3, 1]
+    assert plan_charging(soc, available, 0.0, 600, 10).tolist() == [3, 1, 2, 5]
+    # the demand keeps 3 of the 5 available transports busy
+    assert plan_charging(soc, available, 0.005, 600, 10).tolist() == [3, 1]
+    assert plan_charging(soc, available, 0.05, 600, 10).tolist() == []
+
+    sent = []
+
+    async def send(msg):
+        sent.append(msg)
+
+    dispatcher = SimpleNamespace(agent=SimpleNamespace(directory_id="directory@localhost"), send=send)
+    asyncio.run(ChargingDispatchBehaviour.ask_stations(dispatcher, limit=4))
+    directory = DirectoryAgent("directory@localhost", "secret")
+    for index, status in enumerate(["FREE_STATION", "BUSY_STATION"] + ["FREE_STATION"] * 5):
+        directory.register_service({"jid": "s{}@localhost".format(index), "type": "station", "status": status})
+    assert list(directory.services.query(*parse_query(sent[0].body))) == ["s0@localhost", "s2@localhost",
+                                                                          "s3@localhost", "s4@localhost"]
+
+
+def test_rebalancing_plan():
+    """Test that idle transports in excess are moved to the closest under-served cells."""
+    from simfleet.rebalancing import DemandGrid, FleetPositions, plan_rebalancing
+
+    grid = DemandGrid([39.47, -0.37], cell_size=500, cells=10, half_life=60)
+    assert grid.cell([39.47, -0.37]).tolist() == [[5, 5]]
+    assert grid.cell([[0, -10], [90, 10]]).tolist() == [[0, 0], [9, 9]]  # clipped to the grid
+    assert grid.cell(grid.center_of([[2, 7]])).tolist() == [[2, 7]]
+    for second in range(10):
+        grid.record(grid.center_of([[2, 7]])[0], now=1000 + second)
+    grid.record(grid.center_of([[8, 1]])[0], now=1010)
+    assert grid.demand(now=1070)[2, 7] == pytest.approx(5, rel=0.1)
+
+    demand = np.zeros((10, 10))
+    demand[2, 7], demand[8, 1] = 3, 1
+    cells = [[5, 5], [5, 5], [5, 5], [8, 1], [2, 7]]
+    moves = plan_rebalancing(demand, cells, [True] * 5)
+    assert sorted(moves) == [(0, (2, 7)), (1, (2, 7)), (2, (2, 7))]  # the idle transports of a cell without demand
+    assert plan_rebalancing(demand, cells, [False, True, False, True, True], max_moves=1) == [(1, (2, 7))]
+    assert plan_rebalancing(np.zeros((10, 10)), cells, [True] * 5) == []
+
+    positions = FleetPositions(size=1)
+    first, second = positions.register("a@host"), positions.register("b@host")
+    positions.move(first, [39.47, -0.37])
+    positions.set_idle(first, True)
+    positions.set_idle(second, True)
+    assert positions.idle_transports(["a@host", "b@host", "c@host"]) == ["a@host"]  # b has no position
+
+
+def test_ride_pooling_insertion():
+    """Test the cheapest insertion of a customer in a shared itinerary."""
+    from simfleet.pooling import Itinerary, distance_matrix, PICKUP, DROPOFF
+
+    def at(lon):
+        return [39.0, lon]
+
+    itinerary = Itinerary(capacity=2)
+    itinerary.append("a", at(0.01), at(0.05))
+    # b is picked up and dropped on the way of a without any detour
+    detour, i, j = itinerary.insertion(at(0.0), at(0.02), at(0.03))
+    assert (i, j) == (1, 1) and detour == pytest.approx(0, abs=1)
+    itinerary.insert("b", at(0.02), at(0.03), i, j)
+    assert [(stop.customer, stop.kind) for stop in itinerary.stops] == [("a", PICKUP), ("b", PICKUP),
+                                                                        ("b", DROPOFF), ("a", DROPOFF)]
+    assert itinerary.loads().tolist() == [0, 1, 2, 1, 0]
+    positions = [stop.position for stop in itinerary.stops]
+    assert np.allclose(itinerary.matrix, distance_matrix(positions, positions))
+
+    # a third customer never shares the transport with both a and b: it is picked up after b is dropped
+    assert itinerary.insertion(at(0.0), at(0.025), at(0.06))[1:] == (3, 4)
+    assert Itinerary(capacity=1).insertion(at(0.0), at(0.02), at(0.03))[1:] == (0, 0)
+
+    assert itinerary.pop().customer == "a" and itinerary.onboard == {"a"}
+    itinerary.remove("b")
+    assert [stop.customer for stop in itinerary.stops] == ["a"] and itinerary.matrix.shape == (1, 1)
+
+
+def test_itinerary_queued_jobs():
+    """Test that busy transports chain at most their queued jobs."""
+    from simfleet.pooling import Itinerary
+
+    itinerary = Itinerary(capacity=1, queued_jobs=1)
+    itinerary.append("a", [39.0, 0.01], [39.0, 0.05])
+    # the next job is chained after the dropoff of the current customer
+    assert itinerary.insertion([39.0, 0.0], [39.0, 0.02], [39.0, 0.03])[1:] == (2, 2)
+    itinerary.insert("b", [39.0, 0.02], [39.0, 0.03], 2, 2)
+    assert itinerary.queued() == 1
+    assert itinerary.insertion([39.0, 0.0], [39.0, 0.06], [39.0, 0.07]) is None  # no more jobs are queued
+    assert Itinerary(capacity=1).insertion([39.0, 0.0], [39.0, 0.02], [39.0, 0.03]) is not None
+    single = Itinerary(capacity=1)  # without queued jobs a busy transport takes no other customer
+    single.append("a", [39.0, 0.01], [39.0, 0.05])
+    assert single.insertion([39.0, 0.0], [39.0, 0.02], [39.0, 0.03]) is None
+    itinerary.pop()
+    itinerary.pop()
+    assert itinerary.insertion([39.0, 0.05], [39.0, 0.06], [39.0, 0.07]) is not None
+
+
+def test_route_prefetching():
+    """Test that prefetched routes are reused and discarded with cancelled jobs."""
+    import asyncio
+    from types import SimpleNamespace
+    from simfleet.pooling import Itinerary
+    from simfleet.transport import TransportAgent
+
+    requests = []
+
+    async def request_path(origin, dest):
+        requests.append((origin, dest))
+        await asyncio.sleep(0)
+        return [origin, dest], 100.0, 10.0
+
+    async def trips():
+        agent = SimpleNamespace(itinerary=Itinerary(capacity=1, queued_jobs=1), prefetched_routes={},
+                                request_path=request_path)
+        for name in ["prefetch_route", "prefetch_next_leg", "discard_prefetched_routes", "fetch_route", "remove_job"]:
+            setattr(agent, name, getattr(TransportAgent, name).__get__(agent))
+        agent.itinerary.append("a", [0, 1], [0, 2])
+        agent.prefetch_next_leg()  # to the destination of a while going to pick it up
+        agent.itinerary.append("b", [0, 3], [0, 4])
+        agent.prefetch_route([0, 2], [0, 3])
+        assert len(agent.prefetched_routes) == 2
+        agent.remove_job("b")  # b cancels its trip
+        assert list(agent.prefetched_routes) == [((0, 1), (0, 2))]
+        assert await agent.fetch_route([0, 1], [0, 2]) == ([[0, 1], [0, 2]], 100.0, 10.0)
+        assert agent.prefetched_routes == {}
+        assert await agent.fetch_route([0, 2], [0, 5]) == ([[0, 2], [0, 5]], 100.0, 10.0)
+
+    asyncio.run(trips())
+    assert requests == [([0, 1], [0, 2]), ([0, 2], [0, 5])]  # the cancelled route was never requested
+
+
+def test_route_policy_circuit_breaker():
+    """Test the retries, the circuit breaker and the fallback of the route policy."""
+    import asyncio
+    from simfleet.routeclient import RoutePolicy
+
+    calls = []
+
+    async def fetch(origin, destination, timeout):
+        calls.append(timeout)
+        return None, None, None  # the router is down
+
+    policy = RoutePolicy(retries=3, base_delay=0, threshold=2, reset_timeout=60, timeout=5)
+    assert asyncio.run(policy.request(fetch, [39.0, 0.0], [39.0, 0.01])) == (None, None, None)
+    assert calls == [5, 5]  # the circuit opened after two failures
+    assert policy.counts == {"error": 2, "retry": 2, "rejected": 1}
+
+    policy.fallback = True
+    path, distance, duration = asyncio.run(policy.request(fetch, [39.0, 0.0], [39.0, 0.01]))
+    assert len(calls) == 2  # no request while the circuit is open
+    assert path == [[39.0, 0.0], [39.0, 0.01]]
+    assert distance == pytest.approx(865, rel=0.01)
+    assert duration == pytest.approx(distance / (30 / 3.6))
+
+    policy.breaker.opened_at -= 60  # the router is probed again
+
+    async def healthy(origin, destination, timeout):
+        return [origin, destination], 100.0, 10.0
+
+    assert asyncio.run(policy.request(healthy, [39.0, 0.0], [39.0, 0.01]))[1] == 100.0
+    assert policy.breaker.state == "closed"
+
+    async def stopped(origin, destination, timeout):
+        raise asyncio.CancelledError
+
+    async def broken(origin, destination, timeout):
+        raise ValueError
+
+    for _ in range(3):  # cancelled jobs do not open the circuit
+        with pytest.raises(asyncio.CancelledError):
+            asyncio.run(policy.request(stopped, [39.0, 0.0], [39.0, 0.01]))
+    assert policy.breaker.state == "closed" and policy.breaker.failures == 0
+
+    policy.breaker.failure()
+    policy.breaker.failure()
+    policy.breaker.opened_at -= 60
+    with pytest.raises(asyncio.CancelledError):  # the probe is cancelled: the next request probes the server
+        asyncio.run(policy.request(stopped, [39.0, 0.0], [39.0, 0.01]))
+    assert policy.breaker.state == "open"
+    with pytest.raises(ValueError):  # the probe fails: the circuit opens again
+        asyncio.run(policy.request(broken, [39.0, 0.0], [39.0, 0.01]))
+    assert policy.breaker.state == "open" and not policy.breaker.allow()
+    policy.breaker.opened_at -= 60
+    assert asyncio.run(policy.request(healthy, [39.0, 0.0], [39.0, 0.01]))[1] == 100.0
+    assert 0 <= RoutePolicy(base_delay=1, max_delay=3).backoff(5) <= 3